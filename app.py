@@ -1,9 +1,14 @@
 import jinja2
 from brain import Brain
+from context_manager import ContextManager, RollingSummarizer
 from message import Message
 import re
 import argparse
-from llm_functions import get_input_from_user, llm_call, summarize_conversation
+import atexit
+from llm_cache import CACHE_MODES, configure_cache
+from llm_functions import get_input_from_user, llm_call, prompt_cache_stats, summarize_incremental
+from session_journal import COMPACT_AFTER_RECORDS, JOURNAL_FILE, SessionJournal
+from tracing import configure_tracing, get_tracer
 from tui.llm_engineer import LLMEngineer
 import os  # Importing os for file operations
 
@@ -70,6 +75,13 @@ def plan_executor(plan_filename: str, workspace: str) -> None:
     history.append(Message('user', 'Hey there, Baby LLM here. What are we building today?'))
 
     brain = Brain(workspace)
+    context_manager = ContextManager(
+        "NousResearch/Hermes-3-Llama-3.1-405B-Turbo",
+        RollingSummarizer(
+            lambda previous_summary, msgs: summarize_incremental("NousResearch/Hermes-3-Llama-3.1-405B-Turbo", previous_summary, msgs, provider='together'),
+            log_path=os.path.join(workspace, '.composer_summaries.jsonl'),
+        ),
+    )
 
     def convert_msg_for_brain(msg: Message) -> Message:
         """Converts a Message into a format suitable for the Brain."""
@@ -82,40 +94,40 @@ def plan_executor(plan_filename: str, workspace: str) -> None:
 
     print('Starting execution ...')
     iter = 0
+    atexit.register(brain.close)
     while True:
-        if len(history) > 10:
-            summary = summarize_conversation("NousResearch/Hermes-3-Llama-3.1-405B-Turbo", history, provider='together')
-            history = [history[0], Message('user', summary)] + history[-3:]
-
-        # Use LLM to generate a message for the brain
-        #llm_response = llm_call("claude-3-5-sonnet-20240620", history, temperature=0.8, provider='anthropic')
-        #llm_response = llm_call("Qwen/Qwen2-72B-Instruct", history, temperature=0.8, provider='together')
-        llm_response = llm_call("NousResearch/Hermes-3-Llama-3.1-405B-Turbo", history, temperature=0.8, provider='together', max_tokens=1024)
-        print("COMPOSER MESSAGE")
-        print(llm_response)
-
-        history.append(Message('assistant', llm_response))
-
-        # Check and log any log summary
-        log_start_tag = "<|LOG_SUMMARY_START|>"
-        log_end_tag = "<|LOG_SUMMARY_END|>"
-        log_start_idx = llm_response.find(log_start_tag)
-        log_end_idx = llm_response.find(log_end_tag)
+        with get_tracer().span('plan.iteration', iteration=iter):
+            history = context_manager.maybe_compact(history)
+
+            # Use LLM to generate a message for the brain
+            #llm_response = llm_call("claude-3-5-sonnet-20240620", history, temperature=0.8, provider='anthropic')
+            #llm_response = llm_call("Qwen/Qwen2-72B-Instruct", history, temperature=0.8, provider='together')
+            llm_response = llm_call("NousResearch/Hermes-3-Llama-3.1-405B-Turbo", history, temperature=0.8, provider='together', max_tokens=1024)
+            print("COMPOSER MESSAGE")
+            print(llm_response)
+
+            history.append(Message('assistant', llm_response))
+
+            # Check and log any log summary
+            log_start_tag = "<|LOG_SUMMARY_START|>"
+            log_end_tag = "<|LOG_SUMMARY_END|>"
+            log_start_idx = llm_response.find(log_start_tag)
+            log_end_idx = llm_response.find(log_end_tag)
         
-        if log_start_idx != -1 and log_end_idx != -1:
-            log_content = llm_response[log_start_idx + len(log_start_tag):log_end_idx].strip()
-            with open('log.txt', 'a') as log_file:
-                log_file.write(log_content + "\n")
-
-        # Check for the job finish tag
-        if "<|JOB_FINISH|>" in llm_response:
-            break
-
-        # Send the last message to the brain and get the response
-        brain_output = brain.run(convert_msg_for_brain(history[-1]))
-        if not brain_output: brain_output = '<NO MESSAGE FROM USER. INITIATE CONVERSATION>'
-        user_message = Message('user', brain_output)
-        history.append(user_message)
+            if log_start_idx != -1 and log_end_idx != -1:
+                log_content = llm_response[log_start_idx + len(log_start_tag):log_end_idx].strip()
+                with open('log.txt', 'a') as log_file:
+                    log_file.write(log_content + "\n")
+
+            # Check for the job finish tag
+            if "<|JOB_FINISH|>" in llm_response:
+                break
+
+            # Send the last message to the brain and get the response
+            brain_output = brain.run(convert_msg_for_brain(history[-1]))
+            if not brain_output: brain_output = '<NO MESSAGE FROM USER. INITIATE CONVERSATION>'
+            user_message = Message('user', brain_output)
+            history.append(user_message)
         iter += 1
         if iter % 10 == 0:
             print('Iteration:', iter)
@@ -130,18 +142,26 @@ if __name__ == "__main__":
     parser.add_argument('--plan_composer', action='store_true', help='Run the plan composer.')
     parser.add_argument('--plan_executor', type=str, default=None, help='Filepath for the plan executor.')
     parser.add_argument('--use_previous_context', action='store_true', help='Use previous context or start fresh.')
+    parser.add_argument('--llm_cache', choices=CACHE_MODES, default=os.environ.get('LLM_CACHE_MODE', 'off'), help='LLM response cache: off, rw (read-write) or replay (read-only, fail on misses).')
+    parser.add_argument('--llm_cache_max_mb', type=int, default=256, help='Size bound of the LLM response cache in MB.')
+    parser.add_argument('--trace', action='store_true', help='Record spans of LLM calls, tools, rewrites and compactions to <workspace>/.llm_trace.jsonl.')
+    parser.add_argument('--trace_otel', action='store_true', help='Also emit the spans through OpenTelemetry (needs opentelemetry-api and a configured SDK).')
 
     args = parser.parse_args()
     workspace = args.workspace
 
-    # Remove previous context files if not using previous context
+    cache = configure_cache(os.path.join(workspace, '.llm_cache.sqlite'), args.llm_cache, args.llm_cache_max_mb * 1024 * 1024)
+    if cache is not None:
+        atexit.register(lambda: print('LLM cache:', cache.stats()))
+    atexit.register(lambda: prompt_cache_stats()['requests'] and print('Prompt cache:', prompt_cache_stats()))
+    if args.trace or args.trace_otel:
+        tracer = configure_tracing(os.path.join(workspace, '.llm_trace.jsonl') if args.trace else None, args.trace_otel)
+        atexit.register(tracer.close)
+
+    # Remove the previous session if not using previous context
+    journal = SessionJournal(os.path.join(workspace, JOURNAL_FILE))
     if not args.use_previous_context:
-        history_file = os.path.join(workspace, '.brain_history')
-        message_list_file = os.path.join(workspace, '.brain_message_list')
-        if os.path.exists(history_file):
-            os.remove(history_file)
-        if os.path.exists(message_list_file):
-            os.remove(message_list_file)
+        journal.clear()
 
     if args.plan_composer:
         # Assuming plan_composer function saves the output in 'composer_plan.txt'
@@ -161,7 +181,14 @@ if __name__ == "__main__":
         exit(0)
     else:
         brain = Brain(workspace)
+        history = journal.load().get('history')
+        if history:
+            brain.history = history
+        if journal.records > COMPACT_AFTER_RECORDS:
+            journal.compact()
+        atexit.register(brain.close)
         while True:
             user_msg = get_input_from_user()
             if not user_msg.content: break
             brain.run(user_msg)
+            journal.sync('history', brain.history)
@@ -0,0 +1,33 @@
+"""
+Runs a 50 turn session of llm_call against the local stub and reports how many connections were opened.
+
+With pooled clients this should print a single connection for all turns.
+
+    python -m benchmarks.connection_reuse
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stub_server import StubServer  # noqa: E402
+from llm_clients import close_clients  # noqa: E402
+from llm_functions import llm_call  # noqa: E402
+from message import Message  # noqa: E402
+
+
+def main(turns: int = 50) -> None:
+    server = StubServer().start()
+    os.environ['OPENAI_API_KEY'] = 'stub'
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    history = [Message('system', 'you are a helpful assistant')]
+    for i in range(turns):
+        history.append(Message('user', f'turn {i}'))
+        history.append(Message('assistant', llm_call('stub-model', history, temperature=0.0)))
+    close_clients()
+    server.shutdown()
+    print(f'turns: {turns}, requests: {server.requests_served}, connections opened: {server.connections_opened}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Compares preparing a request from a 500 message history the old way (merge and serialize everything on every call)
+against the incremental view, over 50 turns that each append a tool output and an assistant message.
+
+    python -m benchmarks.message_view
+"""
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_functions import merge_messages  # noqa: E402
+from message import FileContents, Message  # noqa: E402
+from message_view import prepare_messages  # noqa: E402
+
+FILE_DUMP = '\n'.join(f'def function_{i}(x):\n    return x * {i}\n' for i in range(120))
+
+
+def make_message(i: int) -> Message:
+    if i % 3 == 0:
+        return Message('assistant', f'<|TOOL_CALL_START|>file_reader ... step {i}<|TOOL_CALL_END|>')
+    if i % 3 == 1:
+        return FileContents('user', f'File Contents of module_{i}.py:\n\n```\n{FILE_DUMP}\n```', file_key=f'module_{i}.py', digest=str(i))
+    return Message('user', f'Tool output {i}: ok')
+
+
+def full_prepare(history: list[Message]) -> str:
+    """What every call used to do: merge the whole history and serialize all of it for the cache key."""
+    merged = merge_messages(history)
+    return json.dumps([m.to_dict() for m in merged], sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+
+def incremental_prepare(history: list[Message]) -> list[str]:
+    return prepare_messages(history, 'openai').message_json()
+
+
+def run(prepare, turns: int) -> list[float]:
+    history = [Message('system', 'You are a helpful assistant.')] + [make_message(i) for i in range(1, 500 - 2 * turns)]
+    prepare(history)
+    timings = []
+    for turn in range(turns):
+        history.append(make_message(3 * turn + 1))
+        history.append(make_message(3 * turn + 3))
+        started = time.perf_counter()
+        prepare(history)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main(turns: int = 50) -> None:
+    for name, prepare in (('full', full_prepare), ('incremental', incremental_prepare)):
+        timings = [t * 1e6 for t in run(prepare, turns)]
+        print(f'{name:>12}: mean {statistics.mean(timings):8.1f} us, p50 {statistics.median(timings):8.1f} us, max {max(timings):8.1f} us per call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from context_manager import CHARS_PER_TOKEN, count_text_tokens
+
+# automatic prompt caching the way OpenAI does it: prompts share a cached prefix of at least 1024 tokens, in 128 token steps
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    content = message.get('content')
+    if isinstance(content, list):
+        return '\n'.join(item.get('text', '') for item in content if item.get('type') == 'text')
+    return str(content) if content else ''
+
+
+def request_text(request: Dict[str, Any]) -> str:
+    """All the text of a chat-completions request, for token counting."""
+    return '\n'.join(text for text in map(message_text, request.get('messages', [])) if text)
+
+
+def prefix_digests(request: Dict[str, Any]) -> List[bytes]:
+    """Digests of the prompt's cacheable prefixes, shortest first, the i-th covering CACHE_MIN_TOKENS + i * CACHE_STEP_TOKENS."""
+    text = ''.join(f"<|{message.get('role')}|>{message_text(message)}" for message in request.get('messages', [])).encode('utf-8')
+    first, step = int(CACHE_MIN_TOKENS * CHARS_PER_TOKEN), int(CACHE_STEP_TOKENS * CHARS_PER_TOKEN)
+    digest = hashlib.sha1()
+    digests = []
+    position = 0
+    for end in range(first, len(text) + 1, step):
+        digest.update(text[position:end])
+        position = end
+        digests.append(digest.copy().digest())
+    return digests
+
+
+def split_tokens(text: str) -> List[str]:
+    """Cuts a reply into token sized pieces, for streaming it at a given token rate."""
+    size = max(1, round(CHARS_PER_TOKEN))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, so connection reuse is observable
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.connections_opened += 1
+
+    def handle(self) -> None:
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass  # the client dropped a keep-alive connection
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def send_json(self, payload: Dict[str, Any], status: int = 200) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if not self.path.startswith('/res/v1/web/search'):
+            self.send_json({'error': f'unknown path {self.path}'}, status=404)
+            return
+        with self.server.lock:
+            self.server.searches_served += 1
+            throttle = self.server.search_429s > 0
+            if throttle: self.server.search_429s -= 1
+        if throttle:
+            body = b'{}'
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        time.sleep(self.server.latency)
+        query = parse_qs(urlparse(self.path).query).get('q', [''])[0]
+        self.send_json({'web': {'results': [
+            {'title': f'Result {i} for {query}', 'url': f'https://example.com/{i}', 'description': 'stub', 'extra_snippets': []}
+            for i in range(3)
+        ]}})
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.endswith('/chat/completions'):
+            self.send_json({'error': f'unknown path {self.path}'}, status=404)
+            return
+        started = time.perf_counter()
+        reply = self.server.responder(request) if self.server.responder else self.server.reply
+        model = request.get('model', 'stub')
+        prompt_tokens = count_text_tokens(request_text(request))
+        completion_tokens = count_text_tokens(reply)
+        cached_tokens = min(prompt_tokens, self.server.cached_prefix_tokens(prefix_digests(request)))
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'prompt_tokens_details': {'cached_tokens': cached_tokens},
+        }
+        time.sleep(self.server.latency)
+        if request.get('stream'):
+            try:
+                # like OpenAI, streams only report usage when asked to
+                include_usage = (request.get('stream_options') or {}).get('include_usage', False)
+                self.stream_reply(model, reply, usage if include_usage else None)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client stopped reading, e.g. a rewrite candidate abandoned for a faster one
+                self.close_connection = True
+                with self.server.lock:
+                    self.server.streams_abandoned += 1
+        else:
+            if self.server.token_rate:
+                time.sleep(completion_tokens / self.server.token_rate)
+            self.send_json({
+                'id': 'stub',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'finish_reason': 'stop',
+                    'message': {'role': 'assistant', 'content': reply},
+                }],
+                'usage': usage,
+            })
+        with self.server.lock:
+            self.server.requests_served += 1
+            self.server.prompt_tokens += prompt_tokens
+            self.server.cached_tokens += cached_tokens
+            self.server.completion_tokens += completion_tokens
+            stats = self.server.model_stats.setdefault(model, dict(requests=0, seconds=0.0))
+            stats['requests'] += 1
+            stats['seconds'] += time.perf_counter() - started
+
+    def stream_reply(self, model: str, reply: str, usage: Optional[Dict[str, Any]]) -> None:
+        """
+        Sends the reply as chat-completion chunks over SSE, paced at the server's token rate. Usage, if given, follows
+        in a last chunk without choices, as OpenAI sends it with `stream_options={'include_usage': True}`.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def send_event(payload: str) -> None:
+            data = f'data: {payload}\n\n'.encode('utf-8')
+            self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+            self.wfile.flush()
+
+        created = int(time.time())
+        pieces = split_tokens(reply) + [None]
+        for piece in pieces:
+            chunk = {
+                'id': 'stub',
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'delta': {'role': 'assistant', 'content': piece} if piece is not None else {},
+                    'finish_reason': None if piece is not None else 'stop',
+                }],
+            }
+            send_event(json.dumps(chunk))
+            if piece is not None and self.server.token_rate:
+                time.sleep(1 / self.server.token_rate)
+        if usage is not None:
+            send_event(json.dumps({'id': 'stub', 'object': 'chat.completion.chunk', 'created': created, 'model': model, 'choices': [], 'usage': usage}))
+        send_event('[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    A local stub of the OpenAI-compatible chat-completions (plain and streaming) and Brave search endpoints,
+    counting the connections, requests and tokens it serves. Usage reports cached prompt tokens as OpenAI's automatic
+    prefix caching would, so whether prompts keep a stable prefix across calls shows up in the numbers.
+
+    :param port: Port to listen on, 0 picks a free one.
+    :param reply: The assistant message returned for every request, when there is no responder.
+    :param latency: Seconds to sleep before answering (time to first token when streaming).
+    :param responder: Scripts the replies, called with the decoded request body and returns the assistant message.
+    :param token_rate: Completion tokens generated per second, 0 answers at once.
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, reply: str = '<|RESPONSE_START|>ok<|RESPONSE_END|>', latency: float = 0.0,
+                 responder: Optional[Callable[[Dict[str, Any]], str]] = None, token_rate: float = 0.0):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.reply = reply
+        self.latency = latency
+        self.responder = responder
+        self.token_rate = token_rate
+        self.lock = threading.Lock()
+        self.connections_opened = 0
+        self.requests_served = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.streams_abandoned = 0
+        self._prefixes: set[bytes] = set()
+        # per model: requests served and seconds spent answering them
+        self.model_stats: Dict[str, Dict[str, float]] = {}
+        self.searches_served = 0
+        self.search_429s = 0  # how many of the next search requests get throttled
+
+    def cached_prefix_tokens(self, digests: List[bytes]) -> int:
+        """Tokens of the longest prefix an earlier prompt shared, and remembers this prompt's prefixes."""
+        with self.lock:
+            hits = [i for i, digest in enumerate(digests) if digest in self._prefixes]
+            self._prefixes.update(digests)
+        return CACHE_MIN_TOKENS + hits[-1] * CACHE_STEP_TOKENS if hits else 0
+
+    @property
+    def search_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/res/v1/web/search'
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+    def start(self) -> 'StubServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
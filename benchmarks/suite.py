@@ -0,0 +1,370 @@
+"""
+End-to-end benchmarks against a local stub of the LLM and search endpoints, no real API calls.
+
+Each scenario runs in its own process (so peak memory and module level caches are per scenario), talking to a stub
+started by this process with scripted replies. Reported per scenario: wall time, latency of each stage, requests and
+prompt/completion tokens seen by the stub, and peak RSS.
+
+    python -m benchmarks.suite                                 # all scenarios
+    python -m benchmarks.suite --scenarios multi_tool_turn --latency 0.2 --token-rate 80
+    python -m benchmarks.suite --save-baseline bench_baseline.json
+    python -m benchmarks.suite --compare bench_baseline.json   # exits 1 on a regression past --tolerance
+
+Scenarios:
+    single_file_edit  20 file_writer diffs, half applied locally and half needing the LLM rewriter
+    multi_tool_turn   10 Brain turns, each with three file reads, a search and a file write
+    plan_run          a 50 iteration plan_executor run (composer and Brain both scripted)
+    tui_session       100 turns typed into the TUI, run headless
+"""
+import argparse
+import asyncio
+import contextlib
+import difflib
+import io
+import itertools
+import json
+import os
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stub_server import StubServer  # noqa: E402
+
+BRAIN_PROMPT_START = '# YAML Configuration Primer for Task Completion'
+COMPOSER_PROMPT_START = '# YAML Configuration Primer for LLM-to-LLM Interaction'
+FUNCTIONS = 30
+SOURCE_FILE = '\n'.join(
+    f'def function_{i}(x: int) -> int:\n    """Returns x times {i}."""\n    return x * {i}\n' for i in range(FUNCTIONS)
+)
+# how much of each scenario's wall time and peak memory can grow before --compare reports a regression
+DEFAULT_TOLERANCE = 0.15
+
+
+class Stages:
+    """Collects how long each named stage of a scenario took."""
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = {}
+
+    @contextlib.contextmanager
+    def time(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations.setdefault(name, []).append(time.perf_counter() - started)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        out = {}
+        for name, values in self.durations.items():
+            ordered = sorted(values)
+            out[name] = dict(
+                count=len(values),
+                mean=statistics.mean(values),
+                p50=ordered[len(ordered) // 2],
+                p95=ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                total=sum(values),
+            )
+        return out
+
+
+# -- scripted replies ---------------------------------------------------------------------------------------------
+
+def system_prompt(request: Dict[str, Any]) -> str:
+    messages = request.get('messages', [])
+    if messages and messages[0].get('role') == 'system':
+        return str(messages[0].get('content'))
+    return ''
+
+
+def last_user_text(request: Dict[str, Any]) -> str:
+    for message in reversed(request.get('messages', [])):
+        if message.get('role') == 'user':
+            content = message.get('content')
+            if isinstance(content, list):
+                return '\n'.join(item.get('text', '') for item in content if item.get('type') == 'text')
+            return str(content)
+    return ''
+
+
+def rewriter_reply(request: Dict[str, Any]) -> str:
+    """The file rewriter gets the current file back, with a line added, as if it had merged the diff."""
+    match = re.search(r'CURRENT_FILE_CONTENTS:\n```\n(.*?)\n```', last_user_text(request), re.DOTALL)
+    contents = match.group(1) if match else ''
+    return f'<|UPDATED_FILE_START|>\n{contents}\n# merged by the rewriter\n<|UPDATED_FILE_END|>'
+
+
+def summary_reply(request: Dict[str, Any]) -> str:
+    return 'Main Objective: benchmark.\nCompleted Tasks: earlier steps.\nIn-Progress Tasks: the current step.'
+
+
+def tool_call(name: str, **args: str) -> str:
+    body = f'TOOL_NAME: {name}\n' + ''.join(f'<|{key.upper()}_START|>{value}<|{key.upper()}_END|>\n' for key, value in args.items())
+    return f'<|TOOL_CALL_START|>\n{body}<|TOOL_CALL_END|>'
+
+
+def make_diff(before: str, after: str, filename: str) -> str:
+    return ''.join(difflib.unified_diff(before.splitlines(True), after.splitlines(True), f'a/{filename}', f'b/{filename}'))
+
+
+def brain_reply(request: Dict[str, Any], turn_tools: Callable[[int], List[str]]) -> str:
+    """
+    The Brain answers a user message with tool calls and, once the tool outputs are in, with a response.
+
+    :param turn_tools: Gives the tool calls for the n-th user turn.
+    """
+    messages = request.get('messages', [])
+    last = messages[-1] if messages else {}
+    assistant_turns = sum(1 for message in messages if message.get('role') == 'assistant')
+    if last.get('role') == 'user' and re.search(r'TOOL_OUTPUT|File Contents of|SEARCH_RESULTS|unchanged since', last_user_text(request)):
+        return f'Thought: the tools ran fine.\n<|RESPONSE_START|>Done with step {assistant_turns}.<|RESPONSE_END|>'
+    return 'Thought: let me look at the code first.\n' + '\n'.join(turn_tools(assistant_turns))
+
+
+def route(request: Dict[str, Any], brain: Callable[[Dict[str, Any]], str], composer: Optional[Callable[[Dict[str, Any]], str]] = None) -> str:
+    prompt = system_prompt(request)
+    if prompt.startswith('You are a Language Model. Your will be given diff'):
+        return rewriter_reply(request)
+    if 'running summary of a conversation' in prompt:
+        return summary_reply(request)
+    if composer is not None and prompt.startswith(COMPOSER_PROMPT_START):
+        return composer(request)
+    return brain(request)
+
+
+# -- scenarios ------------------------------------------------------------------------------------------------------
+
+def make_workspace() -> str:
+    workspace = tempfile.mkdtemp(prefix='bench_ws_')
+    for i in range(5):
+        with open(os.path.join(workspace, f'module_{i}.py'), 'w') as f:
+            f.write(SOURCE_FILE)
+    return workspace
+
+
+def multi_tool_tools(turn: int) -> List[str]:
+    before = SOURCE_FILE
+    after = before.replace(f'return x * {turn % FUNCTIONS}\n', f'return x * {turn % FUNCTIONS} + 1\n', 1)
+    return [
+        tool_call('file_reader', filename=f'module_{turn % 5}.py'),
+        tool_call('file_reader', filename=f'module_{(turn + 1) % 5}.py', symbol=f'function_{turn % FUNCTIONS}'),
+        tool_call('file_reader', filename=f'module_{(turn + 2) % 5}.py', lines='1-40'),
+        tool_call('google_search', query=f'python benchmark question {turn}'),
+        tool_call('file_writer', filename=f'scratch_{turn}.py', diff=make_diff('', after, f'scratch_{turn}.py')),
+    ]
+
+
+def responder_for(scenario: str) -> Callable[[Dict[str, Any]], str]:
+    if scenario == 'single_file_edit':
+        return lambda request: route(request, lambda r: '<|RESPONSE_START|>ok<|RESPONSE_END|>')
+    if scenario == 'multi_tool_turn':
+        return lambda request: route(request, lambda r: brain_reply(r, multi_tool_tools))
+    if scenario == 'plan_run':
+        # counted here rather than from the request, the composer history gets compacted
+        iterations = itertools.count()
+
+        def composer(request: Dict[str, Any]) -> str:
+            iteration = next(iterations)
+            if iteration >= 50:
+                return 'Everything in the plan is implemented. <|JOB_FINISH|>'
+            return f'<|BABY_LLM_CONVERSATION_START|>Step {iteration}: check module_{iteration % 5}.py<|BABY_LLM_CONVERSATION_END|>'
+        tools = lambda turn: [tool_call('file_reader', filename=f'module_{turn % 5}.py')]
+        return lambda request: route(request, lambda r: brain_reply(r, tools), composer)
+    if scenario == 'tui_session':
+        tools = lambda turn: [tool_call('file_reader', filename=f'module_{turn % 5}.py', symbol=f'function_{turn % FUNCTIONS}')]
+        return lambda request: route(request, lambda r: brain_reply(r, tools))
+    raise ValueError(f'Unknown scenario {scenario}')
+
+
+def run_single_file_edit(workspace: str, stages: Stages) -> None:
+    from llm_functions import rewrite_file
+
+    filename = 'module_0.py'
+    for i in range(20):
+        with open(os.path.join(workspace, filename)) as f:
+            before = f.read()
+        after = before.replace(f'return x * {i}\n', f'return x * {i} - 1\n', 1)
+        diff = make_diff(before, after, filename)
+        if i % 2:
+            # context that isn't in the file anymore, so the hunk can't be placed and the rewriter is called
+            diff = diff.replace(f' def function_{i}(', f' def renamed_function_{i}(')
+        with stages.time('rewrite_local' if i % 2 == 0 else 'rewrite_llm'):
+            rewrite_file(workspace, filename, diff)
+
+
+def run_multi_tool_turn(workspace: str, stages: Stages) -> None:
+    from brain import Brain
+    from message import Message
+
+    brain = Brain(workspace)
+    try:
+        for turn in range(10):
+            with stages.time('brain_turn'):
+                brain.run(Message('user', f'Please work on step {turn}.'))
+    finally:
+        brain.close()
+
+
+def run_plan(workspace: str, stages: Stages) -> None:
+    import app
+
+    plan_path = os.path.join(workspace, 'plan.md')
+    with open(plan_path, 'w') as f:
+        f.write('# Plan\n\n' + '\n'.join(f'- step {i}: update module_{i % 5}.py' for i in range(50)))
+    # plan_executor waits for Enter every 10 iterations
+    sys.stdin = io.StringIO('\n' * 100)
+    with stages.time('plan_executor'):
+        app.plan_executor(plan_path, workspace)
+
+
+def run_tui_session(workspace: str, stages: Stages) -> None:
+    from textual.widgets import TextArea
+
+    from tui.llm_engineer import LLMEngineer
+
+    async def session() -> None:
+        engineer = LLMEngineer(workspace)
+        async with engineer.run_test(size=(160, 50)) as pilot:
+            for turn in range(100):
+                with stages.time('tui_turn'):
+                    engineer.query_one('#input', TextArea).text = f'Please look at step {turn}.'
+                    engineer.process_input()
+                    while engineer.brain_worker is None or not engineer.brain_worker.is_finished or engineer.pending_inputs:
+                        await pilot.pause(0.005)
+
+    asyncio.run(session())
+
+
+SCENARIOS: Dict[str, Callable[[str, Stages], None]] = {
+    'single_file_edit': run_single_file_edit,
+    'multi_tool_turn': run_multi_tool_turn,
+    'plan_run': run_plan,
+    'tui_session': run_tui_session,
+}
+
+
+# -- running ----------------------------------------------------------------------------------------------------------
+
+def run_child(scenario: str, out_path: str) -> None:
+    """Runs one scenario in this process, against the stub the parent started (see `run_scenario`)."""
+    os.chdir(ROOT)  # prompts are read relative to the repo root
+    workspace = make_workspace()
+    stages = Stages()
+    started = time.perf_counter()
+    # the code under test prints a lot, from worker threads too and through textual, which writes to the real stdout
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    try:
+        SCENARIOS[scenario](workspace, stages)
+    finally:
+        wall = time.perf_counter() - started
+        shutil.rmtree(workspace, ignore_errors=True)
+    with open(out_path, 'w') as f:
+        json.dump(dict(
+            wall_time=wall,
+            stages=stages.summary(),
+            peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        ), f)
+
+
+def run_scenario(scenario: str, latency: float, token_rate: float) -> Dict[str, Any]:
+    server = StubServer(latency=latency, responder=responder_for(scenario), token_rate=token_rate).start()
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY='stub', TOGETHER_API_KEY='stub', OPENAI_BASE_URL=server.base_url, TOGETHER_BASE_URL=server.base_url,
+        BRAVE_SEARCH_AI_API_KEY='stub', BRAVE_SEARCH_URL=server.search_url, LLM_CACHE_MODE='off',
+    )
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as out:
+        out_path = out.name
+    try:
+        subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--child', scenario, '--out', out_path], env=env, cwd=ROOT, check=True)
+        with open(out_path) as f:
+            result = json.load(f)
+    finally:
+        os.remove(out_path)
+        server.shutdown()
+    result.update(
+        llm_requests=server.requests_served,
+        searches=server.searches_served,
+        prompt_tokens=server.prompt_tokens,
+        cached_tokens=server.cached_tokens,
+        completion_tokens=server.completion_tokens,
+        connections_opened=server.connections_opened,
+        streams_abandoned=server.streams_abandoned,
+        llm_by_model={model: dict(stats, mean=stats['seconds'] / stats['requests']) for model, stats in server.model_stats.items()},
+    )
+    return result
+
+
+def print_result(scenario: str, result: Dict[str, Any]) -> None:
+    print(f"\n{scenario}: {result['wall_time']:.2f}s wall, peak RSS {result['peak_rss_mb']:.0f} MB, "
+          f"{result['llm_requests']} LLM requests ({result['prompt_tokens']} prompt, {result.get('cached_tokens', 0)} of them cached / {result['completion_tokens']} completion tokens), "
+          f"{result['searches']} searches, {result['connections_opened']} connections, {result.get('streams_abandoned', 0)} streams abandoned")
+    for name, stage in result['stages'].items():
+        print(f"  {name:<16} n={stage['count']:<4} mean {stage['mean'] * 1000:8.1f} ms  p50 {stage['p50'] * 1000:8.1f} ms  p95 {stage['p95'] * 1000:8.1f} ms")
+    for model, stats in result['llm_by_model'].items():
+        print(f"  llm {model:<44} n={stats['requests']:<4} mean {stats['mean'] * 1000:8.1f} ms")
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float) -> bool:
+    """Prints the change against the baseline, returns False if a scenario regressed past the tolerance."""
+    ok = True
+    print('\nAgainst baseline:')
+    for scenario, result in results.items():
+        if scenario not in baseline:
+            print(f'  {scenario}: not in baseline')
+            continue
+        for metric in ('wall_time', 'peak_rss_mb', 'prompt_tokens', 'llm_requests'):
+            before, after = baseline[scenario][metric], result[metric]
+            change = (after - before) / before if before else 0.0
+            regressed = change > tolerance
+            ok = ok and not regressed
+            print(f"  {scenario:<18} {metric:<14} {before:12.2f} -> {after:12.2f} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS), help='Comma separated scenarios to run.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds before the stub answers (time to first token).')
+    parser.add_argument('--token-rate', type=float, default=400, help='Completion tokens per second generated by the stub, 0 for instant.')
+    parser.add_argument('--save-baseline', type=str, default=None, help='Write the results to this file.')
+    parser.add_argument('--compare', type=str, default=None, help='Compare against a baseline file written by --save-baseline.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Allowed relative growth before a regression is reported.')
+    parser.add_argument('--child', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--out', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.out)
+        return
+
+    results = {}
+    for scenario in args.scenarios.split(','):
+        results[scenario] = run_scenario(scenario, args.latency, args.token_rate)
+        print_result(scenario, results[scenario])
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(dict(settings=dict(latency=args.latency, token_rate=args.token_rate), results=results), f, indent=2)
+        print(f'\nBaseline saved to {args.save_baseline}')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != dict(latency=args.latency, token_rate=args.token_rate):
+            print(f"\nWarning: baseline was recorded with {baseline['settings']}")
+        if not compare(results, baseline['results'], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Appends 5,000 messages to the TUI conversation log, headless, and reports the time per append (the append plus the
+repaint it triggers).
+
+The mix has short log lines, large file dumps and base64 screenshots. With incremental rendering the last appends
+should cost about as much as the first ones.
+
+    python -m benchmarks.tui_render [--messages 5000]
+"""
+import argparse
+import asyncio
+import base64
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from textual.app import App, ComposeResult  # noqa: E402
+
+from message import MessageToPrint  # noqa: E402
+from tui.llm_engineer import BrainWidget  # noqa: E402
+
+FILE_DUMP = '\n'.join(f'    line {i}: value = compute(value, {i})  # padding to look like code' for i in range(2000))
+SCREENSHOT = 'data:image/png;base64,' + base64.b64encode(os.urandom(150_000)).decode()
+
+
+def sample_message(i: int) -> MessageToPrint:
+    if i % 25 == 0:
+        return MessageToPrint('User', [{'type': 'text', 'text': f'screenshot {i}'}, {'type': 'image_url', 'image_url': {'url': SCREENSHOT}}], 'cyan')
+    if i % 10 == 0:
+        return MessageToPrint('Tool Output', f'File Contents of module_{i}.py:\n\n```\n{FILE_DUMP}\n```', 'yellow')
+    return MessageToPrint('Brain', f'step {i}: calling file_reader on module_{i}.py', 'bright_green')
+
+
+class BenchApp(App):
+    def compose(self) -> ComposeResult:
+        yield BrainWidget()
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+async def run(n: int, width: int, height: int) -> None:
+    app = BenchApp()
+    async with app.run_test(size=(width, height)) as pilot:
+        widget = app.query_one(BrainWidget)
+        frame_times = []
+        started = time.perf_counter()
+        for i in range(n):
+            t0 = time.perf_counter()
+            widget.append_message(sample_message(i))
+            await pilot.pause()
+            frame_times.append(time.perf_counter() - t0)
+        total = time.perf_counter() - started
+
+    ms = [t * 1000 for t in frame_times]
+    window = min(500, n)
+    print(f'messages: {n}, total: {total:.2f}s, panels rendered: {widget.panels_rendered}, lines: {widget.virtual_size.height}')
+    print(f'frame time (ms): p50 {percentile(ms, 50):.2f}, p95 {percentile(ms, 95):.2f}, p99 {percentile(ms, 99):.2f}, max {max(ms):.2f}')
+    print(f'mean of first {window}: {statistics.mean(ms[:window]):.2f} ms, mean of last {window}: {statistics.mean(ms[-window:]):.2f} ms')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--width', type=int, default=160)
+    parser.add_argument('--height', type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args.messages, args.width, args.height))
+
+
+if __name__ == '__main__':
+    main()
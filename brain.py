@@ -1,12 +1,25 @@
+import asyncio
 import os
 import re
+import time
 from typing import Callable
-from message import Message, MessageToPrint
-from llm_functions import get_input_from_user, llm_call, rewrite_file, search_brave, summarize_conversation
+from context_manager import ContextManager, RollingSummarizer, estimate_tokens
+from file_cache import WorkspaceFileCache, content_digest
+from file_transaction import recover
+from message import FileContents, Message, MessageToPrint
+from symbol_index import SymbolIndex
+from llm_clients import aclose_clients
+from llm_functions import allm_stream, get_input_from_user, rewrite_file, rewrite_files, search_brave, summarize_incremental
+from tool_executor import ToolExecutor, format_timings
+from tracing import get_tracer
+
+
+# outdated file copies are stubbed once they add up to this many tokens, even if the history isn't compacted yet
+STALE_COPY_FLUSH_TOKENS = 6000
 
 
 class Brain:
-    def __init__(self, workspace: str):
+    def __init__(self, workspace: str, max_tool_workers: int = 4):
         self.workspace = workspace
         self.history = []
         self.MAX_RETRIES = 3
@@ -19,6 +32,29 @@ class Brain:
         self.response_ptrn = re.compile(r"<\|RESPONSE_START\|>(.*?)<\|RESPONSE_END\|>", re.DOTALL)
         self.filename_ptrn = re.compile(r"<\|FILENAME_START\|>(.*?)<\|FILENAME_END\|>", re.DOTALL)
         self.query_ptrn = re.compile(r"<\|QUERY_START\|>(.*?)<\|QUERY_END\|>", re.DOTALL)
+        self.symbol_ptrn = re.compile(r"<\|SYMBOL_START\|>(.*?)<\|SYMBOL_END\|>", re.DOTALL)
+        self.lines_ptrn = re.compile(r"<\|LINES_START\|>(.*?)<\|LINES_END\|>", re.DOTALL)
+        self.file_edit_ptrn = re.compile(r"<\|FILE_EDIT_START\|>(.*?)<\|FILE_EDIT_END\|>", re.DOTALL)
+
+        # tool calls are dispatched here while the response is still streaming, calls touching the same file are serialized
+        self.tool_executor = ToolExecutor(max_workers=max_tool_workers)
+        self.symbol_index = SymbolIndex(workspace)
+        self.file_cache = WorkspaceFileCache(workspace)
+        # latest FileContents injected per file (or slice), to dedupe later reads of the same content
+        self.file_copies: dict[str, FileContents] = {}
+        self.file_dedupe_stats = dict(reused=0, replaced=0, tokens_saved=0)
+        # outdated copies still in the history, stubbed together rather than one by one (see `flush_stale_copies`)
+        self.stale_copies: list[FileContents] = []
+        self.context_manager = ContextManager(
+            "NousResearch/Hermes-3-Llama-3.1-405B-Turbo",
+            RollingSummarizer(self.summarize, log_path=os.path.join(workspace, '.brain_summaries.jsonl')),
+        )
+        # finish a multi-file write that a crash interrupted, so the files are all updated and not just some
+        recovered = recover(workspace)
+        if recovered:
+            print(f"Completed an interrupted multi-file write: {', '.join(recovered)}")
+        # event loop backing the synchronous `run`, created on first use
+        self._loop: asyncio.AbstractEventLoop | None = None
 
         # Initialize system prompt
         self.load_system_prompt()
@@ -28,142 +64,337 @@ class Brain:
             sys_prompt = f.read()
         self.history.append(Message("system", sys_prompt))
 
-    def process_file_reader(self, filename: str, llm_res: str):
-        absolute_fp = f"{self.workspace}/{filename}"
-        if os.path.exists(absolute_fp):
-            with open(absolute_fp, "r") as f:
-                file_contents = f.read()
-            self.history.extend(
-                [
-                    Message("user", f"File Contents:\n\n```\n{file_contents}\n```"),
+    def process_file_reader(self, filename: str | None, llm_res: str, symbol: str | None = None, line_range: str | None = None) -> list[Message]:
+        """
+        Reads a file into the history, either whole or, when a symbol or line range is given, just that slice
+        along with a compact outline of the rest of the file.
+        """
+        start = end = None
+        label = ''
+        other_matches = []
+        if symbol:
+            matches = self.symbol_index.find(symbol, filename)
+            if not matches:
+                where = f" in {filename}" if filename else " in the workspace"
+                outline = self.symbol_index.outline(filename) if filename else ''
+                msg = f"Symbol '{symbol}' was not found{where}."
+                if outline: msg += f"\n\nOutline of {filename}:\n{outline}"
+                return [Message("user", msg)]
+            filename, found = matches[0]
+            start, end, label = found.start, found.end, f"{found.kind} {found.name}"
+            other_matches = [f"{path}: {s.kind} {s.name} (lines {s.start}-{s.end})" for path, s in matches[1:]]
+        elif line_range:
+            range_match = re.match(r"\s*(\d+)\s*(?:-\s*(\d+))?\s*$", line_range)
+            if not range_match:
+                return [Message("user", f"Unable to parse line range '{line_range}', expected something like 10-40.")]
+            start = max(int(range_match.group(1)), 1)
+            end = int(range_match.group(2) or start)
+            if end < start:
+                return [Message("user", f"Invalid line range '{line_range}', the end comes before the start.")]
+            label = "requested range"
+
+        cached = self.file_cache.read(filename)
+        if cached is not None:
+            if start is None:
+                return [
+                    FileContents("user", f"File Contents of {filename}:\n\n```\n{cached.content}\n```", file_key=os.path.normpath(filename), digest=cached.digest),
                 ]
-            )
+            lines = cached.content.split('\n')
+            if start > len(lines):
+                return [Message("user", f"Line {start} is past the end of {filename}, which has {len(lines)} lines.")]
+            end = min(end, len(lines))
+            text = '\n'.join(lines[start - 1:end])
+            msg = f"File Contents of {filename} ({label}, lines {start}-{end} of {len(lines)}):\n\n```\n" + text + "\n```"
+            outline = self.symbol_index.outline(filename, exclude=(start, end))
+            if outline:
+                msg += f"\n\nOutline of the rest of {filename}:\n{outline}"
+            if other_matches:
+                msg += "\n\nOther matches for '" + symbol + "':\n" + '\n'.join(other_matches)
+            return [FileContents("user", msg, file_key=f"{os.path.normpath(filename)}:{start}-{end}", digest=content_digest(text))]
         else:
-            self.history.extend(
-                [
-                    Message(
-                        "user",
-                        "File does not exist. If you want to add content just call file writer. It will handle creation",
-                    ),
-                ]
-            )
+            return [
+                Message(
+                    "user",
+                    "File does not exist. If you want to add content just call file writer. It will handle creation",
+                ),
+            ]
+
+    def append_tool_output(self, message: Message) -> None:
+        """
+        Appends a tool result to the history, deduplicating file reads.
+
+        Re-reading an unchanged file (or slice) adds a short reference instead of another copy. Reading a file that
+        changed marks the outdated copy still in the history to be replaced with a one line note.
+        """
+        if isinstance(message, FileContents):
+            previous = self.file_copies.get(message.file_key)
+            index = next((i for i in range(len(self.history) - 1, -1, -1) if self.history[i] is previous), None) if previous is not None else None
+            if index is not None and previous.digest == message.digest:
+                reference = Message("user", f"File Contents of {message.file_key}: unchanged since it was last read, see the copy above.")
+                self.file_dedupe_stats['reused'] += 1
+                self.file_dedupe_stats['tokens_saved'] += estimate_tokens(message) - estimate_tokens(reference)
+                self.history.append(reference)
+                return
+            if index is not None:
+                self.stale_copies.append(previous)
+            self.file_copies[message.file_key] = message
+        self.history.append(message)
 
-    def process_file_writer(self, filename: str, diff: str, llm_res: str, update_logs: Callable | None = None):
+    def flush_stale_copies(self, force: bool = False) -> None:
+        """
+        Replaces the outdated file copies in the history with one line notes.
+
+        Editing a message in the middle of the history changes the prompt from that point on, so the provider's
+        prompt cache can only serve the part before it. The copies are therefore left in place until the history is
+        compacted anyway (which rewrites it past the system prompt), or until they add up to STALE_COPY_FLUSH_TOKENS,
+        at which point resending them costs more than the cache misses. Called after `maybe_compact`, so the copies
+        that compaction evicts anyway are not stubbed first.
+
+        :param force: Stub them now, whatever their size (the history was just compacted).
+        """
+        stale_tokens = sum(estimate_tokens(copy) for copy in self.stale_copies)
+        if not self.stale_copies or not (force or stale_tokens > STALE_COPY_FLUSH_TOKENS):
+            return
+        stale = {id(copy) for copy in self.stale_copies}
+        replacements = {}
+        for index, message in enumerate(self.history):
+            if id(message) in stale:
+                stub = Message(message.role, f"[Outdated copy of {message.file_key} removed, a newer copy was read later.]")
+                self.file_dedupe_stats['replaced'] += 1
+                self.file_dedupe_stats['tokens_saved'] += estimate_tokens(message) - estimate_tokens(stub)
+                self.history[index] = replacements[id(message)] = stub
+        # a summary being prepared in the background still applies, it was computed from what the stubs replace
+        self.context_manager.substitute(replacements)
+        self.stale_copies = []
+
+    def process_file_writer(self, filename: str, diff: str, llm_res: str, update_logs: Callable | None = None) -> list[Message]:
         out = rewrite_file(self.workspace, filename, diff, update_logs)
-        self.history.extend(
-            [
-                Message("user", f"TOOL_OUTPUT:\n\n{out}"),
-            ]
-        )
+        return [
+            Message("user", f"TOOL_OUTPUT:\n\n{out}"),
+        ]
 
-    def process_search_google(self, query: str, llm_res: str, api_key: str, update_logs: Callable | None = None):
+    def process_multi_file_writer(self, edits: list[tuple[str, str]], llm_res: str, update_logs: Callable | None = None) -> list[Message]:
+        out = rewrite_files(self.workspace, edits, update_logs)
+        return [
+            Message("user", f"TOOL_OUTPUT:\n\n{out}"),
+        ]
+
+    def process_search_google(self, query: str, llm_res: str, api_key: str, update_logs: Callable | None = None) -> list[Message]:
         # Use the search_brave function as a template for Google Search
         results = search_brave(query, api_key)  # Assuming search_brave can be adapted or replaced with a Google-specific function
         formatted_results = "\n\n".join(str(result) for result in results)
 
-        # Append the search results to the history
-        self.history.extend(
-            [
-                Message("user", f"SEARCH_RESULTS:\n\n{formatted_results}"),
-            ]
-        )
         if update_logs:
             update_logs(MessageToPrint(f'Search results for query: "{query}"', formatted_results, "grey85"))
+        return [
+            Message("user", f"SEARCH_RESULTS:\n\n{formatted_results}"),
+        ]
+
+    def summarize(self, previous_summary: str | None, messages: list[Message]) -> str:
+        return summarize_incremental("NousResearch/Hermes-3-Llama-3.1-405B-Turbo", previous_summary, messages, provider='together')
+
+    def describe_tool_call(self, tool_call: str) -> tuple[str, str | list[str] | None]:
+        """
+        :return: A short label for the timing logs, and the key(s) used to serialize calls touching the same file.
+        """
+        tool_name_match = re.search(self.tool_name_ptrn, tool_call)
+        tool_name = tool_name_match.group(1) if tool_name_match else 'unknown'
+        if tool_name == "multi_file_writer":
+            filenames = [match.group(1).strip() for match in self.filename_ptrn.finditer(tool_call)]
+            return f"{tool_name} {', '.join(filenames)}", [os.path.normpath(filename) for filename in filenames]
+        filename_match = re.search(self.filename_ptrn, tool_call)
+        if tool_name in ("file_reader", "file_writer") and filename_match:
+            filename = filename_match.group(1).strip()
+            return f"{tool_name} {filename}", os.path.normpath(filename)
+        return tool_name, None
+
+    def dispatch_tool_call(self, tool_call: str, api_key: str, update_logs: Callable | None = None) -> tuple[list[Message], bool]:
+        """
+        Runs a single tool call.
+
+        :return: The messages to append to the history after the assistant response, and whether the call was
+            well formed (used to reset or decrement the retries).
+        """
+        label, _ = self.describe_tool_call(tool_call)
+        tool_name, _, target = label.partition(' ')
+        with get_tracer().span('tool', tool=tool_name, target=target or None) as span:
+            messages, ok = self._dispatch_tool_call(tool_call, api_key, update_logs)
+            span.set(ok=ok, output_tokens=sum(estimate_tokens(message) for message in messages))
+            if not ok: span.status = 'error'
+            return messages, ok
+
+    def _dispatch_tool_call(self, tool_call: str, api_key: str, update_logs: Callable | None = None) -> tuple[list[Message], bool]:
+        print('TOOL CALL:', tool_call)
+        tool_name_match = re.search(self.tool_name_ptrn, tool_call)
+        if not tool_name_match:
+            return [], True
+        tool_name = tool_name_match.group(1)
+
+        # New Google Search Tool handling
+        if tool_name == "google_search":
+            query_match = re.search(self.query_ptrn, tool_call)
+            if query_match:
+                query = query_match.group(1).strip()
+                return self.process_search_google(query, tool_call, api_key, update_logs), True
+            return [Message('user', f"<|TOOL_RESPONSE_START|>Error: Unable to parse query for google_search tool.|<|TOOL_RESPONSE_END|>")], False
+
+        elif tool_name == "file_reader":
+            filename_match = re.search(self.filename_ptrn, tool_call)
+            symbol_match = re.search(self.symbol_ptrn, tool_call)
+            lines_match = re.search(self.lines_ptrn, tool_call)
+            if filename_match or symbol_match:
+                filename = filename_match.group(1).strip() if filename_match else None
+                symbol = symbol_match.group(1).strip() if symbol_match else None
+                line_range = lines_match.group(1).strip() if lines_match else None
+                out = self.process_file_reader(filename, tool_call, symbol, line_range)
+                if update_logs:
+                    update_logs(MessageToPrint(f'Contents of: "{filename or symbol}"', out[-1].content, "grey85"))
+                return out, True
+            return [Message('user', f"<|TOOL_RESPONSE_START|>Error: Unable to parse filename for file_reader tool.|<|TOOL_RESPONSE_END|>")], False
+
+        elif tool_name == "file_writer":
+            filename_match = re.search(self.filename_ptrn, tool_call)
+            diff_match = re.search(self.diff_ptrn, tool_call)
+            if filename_match and diff_match:
+                filename = filename_match.group(1).strip()
+                diff = diff_match.group(1).strip()
+                return self.process_file_writer(filename, diff, tool_call, update_logs), True
+            return [Message('user', f"<|TOOL_RESPONSE_START|>Error: Unable to parse filename or diff for file_writer tool.|<|TOOL_RESPONSE_END|>")], False
+
+        elif tool_name == "multi_file_writer":
+            edits = []
+            for edit in self.file_edit_ptrn.finditer(tool_call):
+                filename_match = re.search(self.filename_ptrn, edit.group(1))
+                diff_match = re.search(self.diff_ptrn, edit.group(1))
+                if not (filename_match and diff_match):
+                    return [Message('user', f"<|TOOL_RESPONSE_START|>Error: Every edit of multi_file_writer needs a filename and a diff, nothing was written.|<|TOOL_RESPONSE_END|>")], False
+                edits.append((filename_match.group(1).strip(), diff_match.group(1).strip()))
+            if edits:
+                return self.process_multi_file_writer(edits, tool_call, update_logs), True
+            return [Message('user', f"<|TOOL_RESPONSE_START|>Error: Unable to parse the edits for multi_file_writer tool.|<|TOOL_RESPONSE_END|>")], False
+
+        return [Message('user', f"<|TOOL_RESPONSE_START|>Error: Unknown tool '{tool_name}'.|<|TOOL_RESPONSE_END|>")], False
 
     def run(self, user_msg: Message, update_logs: Callable | None = None) -> str | None:
+        """
+        Synchronous wrapper around `arun`, for callers without an event loop (app.py, plan_executor).
+
+        The same private loop is reused across calls, so the async provider clients pooled on it stay alive.
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(self.arun(user_msg, update_logs))
+
+    def close(self) -> None:
+        """
+        Releases what the Brain holds across turns: the tool threads and, if `run` was used, its private loop along
+        with the async clients pooled on it. Streams left suspended (e.g. abandoned by a cancelled turn) are
+        finalized before the loop is closed, rather than destroyed with it.
+        """
+        self.tool_executor.shutdown()
+        if self._loop is None:
+            return
+        try:
+            self._loop.run_until_complete(aclose_clients())
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+        finally:
+            self._loop.close()
+            self._loop = None
+
+    async def arun(self, user_msg: Message, update_logs: Callable | None = None) -> str | None:
+        """
+        Runs the Brain until it responds to the user.
+
+        The response is streamed, and each tool call is dispatched as soon as its <|TOOL_CALL_END|> arrives, while
+        the model is still generating the rest. The raw response shown through `update_logs` is a single
+        MessageToPrint that is updated in place, and passed to `update_logs` again on every new token.
+        Tool calls run on worker threads, so `update_logs` has to be safe to call from any thread.
+
+        The turn can be cancelled; tool calls that haven't started are dropped and a note is left in the history so
+        the model knows the previous turn did not complete.
+        """
+
+        with get_tracer().span('brain.turn', llm_calls=0, tool_calls=0) as span:
+            self.history.append(user_msg)
+            user_turn = False
+            max_retries = self.MAX_RETRIES
+            llm_res = None
+            api_key = os.environ['BRAVE_SEARCH_AI_API_KEY']
+            pending: list[asyncio.Future] = []
+
+            try:
+                while not user_turn:
+                    # summarize the older part of the history once it grows past the model's token budget, a summary
+                    # prepared in the background is swapped in here when ready
+                    history = self.history
+                    self.history = await asyncio.to_thread(self.context_manager.maybe_compact, self.history)
+                    compacted = self.history is not history
+                    self.flush_stale_copies(force=compacted)
+                    if update_logs and compacted:
+                        update_logs(MessageToPrint('Context Compacted', str(self.context_manager.metrics), "grey70"))
+
+
+                    print(f"\033[93m{self.history[-1]}\033[0m")
+                    #llm_res = llm_call("claude-3-5-sonnet-20240620", self.history, temperature=0.8, provider='anthropic')
+                    #llm_res = llm_call("Qwen/Qwen2-72B-Instruct", self.history, temperature=0.8, provider='together')
+                    raw_response = MessageToPrint('Brain Raw Response', '', "light_yellow3")
+                    llm_res = ''
+                    scan_pos = 0
+                    pending = []
+                    tools_started = 0.0
+                    span.attributes['llm_calls'] += 1
+                    async for delta in allm_stream("NousResearch/Hermes-3-Llama-3.1-405B-Turbo", self.history, temperature=0.8, provider='together', max_tokens=1024):
+                        llm_res += delta
+                        print("\033[95m" + delta + "\033[0m", end='', flush=True)
+                        if update_logs:
+                            raw_response.content = llm_res
+                            update_logs(raw_response)
+                        # dispatch every tool call that got completed by this delta
+                        for match in self.tool_call_ptrn.finditer(llm_res, scan_pos):
+                            scan_pos = match.end()
+                            label, key = self.describe_tool_call(match.group(1))
+                            if not pending: tools_started = time.perf_counter()
+                            future = self.tool_executor.submit(label, self.dispatch_tool_call, match.group(1), api_key, update_logs, key=key)
+                            pending.append(asyncio.wrap_future(future))
+                    print()
 
-        self.history.append(user_msg)
-        user_turn = False
-        max_retries = self.MAX_RETRIES
-        llm_res = None
-        api_key = os.environ['BRAVE_SEARCH_AI_API_KEY']
-
-        while not user_turn:
-            # check if history is more than 10, and then summarize the histor
-            if len(self.history) > 10:
-                summary = summarize_conversation("NousResearch/Hermes-3-Llama-3.1-405B-Turbo", self.history, provider='together')
-                self.history = [self.history[0], Message('user', summary)] + self.history[-3:]
-
-
-            print(f"\033[93m{self.history[-1]}\033[0m")
-            #llm_res = llm_call("claude-3-5-sonnet-20240620", self.history, temperature=0.8, provider='anthropic')
-            #llm_res = llm_call("Qwen/Qwen2-72B-Instruct", self.history, temperature=0.8, provider='together')
-            llm_res = llm_call("NousResearch/Hermes-3-Llama-3.1-405B-Turbo", self.history, temperature=0.8, provider='together', max_tokens=1024)
-            print("\033[95m" + str(llm_res) + "\033[0m")
-            if update_logs:
-                update_logs(MessageToPrint('Brain Raw Response', llm_res, "light_yellow3"))
-
-            tool_calls = re.findall(self.tool_call_ptrn, llm_res)
-            if tool_calls:
-                self.history.append(Message('assistant', llm_res))
-                user_turn = False
-                max_retries = self.MAX_RETRIES
-                for tool_call in tool_calls:
-                    print('TOOL CALL:', tool_call)
-                    tool_name_match = re.search(self.tool_name_ptrn, tool_call)
-                    if tool_name_match:
-                        tool_name = tool_name_match.group(1)
-
-                        # New Google Search Tool handling
-                        if tool_name == "google_search":
-                            query_match = re.search(self.query_ptrn, tool_call)
-                            if query_match:
-                                query = query_match.group(1).strip()
-                                self.process_search_google(query, tool_call, api_key, update_logs)
-                                user_turn = False
-                                max_retries = self.MAX_RETRIES
-                            else:
-                                self.history.append(Message('user', f"<|TOOL_RESPONSE_START|>Error: Unable to parse query for google_search tool.|<|TOOL_RESPONSE_END|>"))
-                                user_turn = False
-                                max_retries -= 1
-
-                        elif tool_name == "file_reader":
-                            filename_match = re.search(self.filename_ptrn, tool_call)
-                            if filename_match:
-                                filename = filename_match.group(1).strip()
-                                self.process_file_reader(filename, tool_call)
-                                if update_logs:
-                                    update_logs(MessageToPrint(f'Contents of: "{filename}"', self.history[-1].content, "grey85"))
-                                user_turn = False
-                                max_retries = self.MAX_RETRIES
-                            else:
-                                self.history.append(Message('user', f"<|TOOL_RESPONSE_START|>Error: Unable to parse filename for file_reader tool.|<|TOOL_RESPONSE_END|>"))
-                                user_turn = False
-                                max_retries -= 1
-
-                        elif tool_name == "file_writer":
-                            filename_match = re.search(self.filename_ptrn, tool_call)
-                            diff_match = re.search(self.diff_ptrn, tool_call)
-                            if filename_match and diff_match:
-                                filename = filename_match.group(1).strip()
-                                diff = diff_match.group(1).strip()
-                                self.process_file_writer(filename, diff, tool_call, update_logs)
-                                user_turn = False
-                                max_retries = self.MAX_RETRIES
-                            else:
-                                self.history.append(Message('user', f"<|TOOL_RESPONSE_START|>Error: Unable to parse filename or diff for file_writer tool.|<|TOOL_RESPONSE_END|>"))
-                                user_turn = False
-                                max_retries -= 1
+                    if pending:
+                        self.history.append(Message('assistant', llm_res))
+                        user_turn = False
+                        max_retries = self.MAX_RETRIES
+                        # results go into the history in the order the calls were made, whatever order they finished in
+                        results = await asyncio.gather(*pending)
+                        span.attributes['tool_calls'] += len(results)
+                        for timed in results:
+                            messages, ok = timed.result
+                            for message in messages:
+                                self.append_tool_output(message)
+                            max_retries = self.MAX_RETRIES if ok else max_retries - 1
+                        pending = []
+                        timings = format_timings(results, tools_started)
+                        print(timings)
+                        if update_logs:
+                            update_logs(MessageToPrint('Tool Timings', timings, "grey70"))
 
+                    else:
+                        response_match = re.search(self.response_ptrn, llm_res)
+                        if response_match:
+                            response = response_match.group(1).strip()
+                            self.history.append(Message("assistant", llm_res))
+                            print("\033[92m" + response + "\033[0m")
+                            return response
+                            user_turn = True
+                            max_retries = self.MAX_RETRIES
                         else:
-                            self.history.append(Message('user', f"<|TOOL_RESPONSE_START|>Error: Unknown tool '{tool_name}'.|<|TOOL_RESPONSE_END|>"))
-                            user_turn = False
+                            user_turn = True
                             max_retries -= 1
+            except asyncio.CancelledError:
+                for future in pending:
+                    future.cancel()
+                self.history.append(Message('user', 'The previous turn was cancelled by the user before it completed. Any tool calls that already ran may have taken effect.'))
+                raise
 
-            else:
-                response_match = re.search(self.response_ptrn, llm_res)
-                if response_match:
-                    response = response_match.group(1).strip()
-                    self.history.append(Message("assistant", llm_res))
-                    print("\033[92m" + response + "\033[0m")
-                    return response
-                    user_turn = True
-                    max_retries = self.MAX_RETRIES
-                else:
-                    user_turn = True
-                    max_retries -= 1
-
-        return llm_res
+            return llm_res
 
 if __name__ == '__main__':
     brain = Brain('../hello_world')
@@ -0,0 +1,267 @@
+import json
+import math
+import re
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from message import Message
+from tracing import get_tracer
+
+
+# flat cost we charge for an image, providers bill roughly this much for a downscaled screenshot
+IMAGE_TOKENS = 1000
+# per message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# calibrated on our prompts (mixed prose and code) against cl100k_base, used when tiktoken isn't available
+CHARS_PER_TOKEN = 3.6
+
+# history size (in tokens) at which the conversation gets compacted, per model
+MODEL_TOKEN_BUDGETS = {
+    "NousResearch/Hermes-3-Llama-3.1-405B-Turbo": 24_000,
+    "gpt-4o-2024-08-06": 48_000,
+    "gpt-4o-mini": 48_000,
+    "claude-3-5-sonnet-20240620": 64_000,
+}
+DEFAULT_TOKEN_BUDGET = 16_000
+
+# marks the message holding the running summary, so the next compaction knows what to fold into
+SUMMARY_PREFIX = "CONVERSATION_SUMMARY:\n"
+DATA_URL_PTRN = re.compile(r"data:[\w/+.-]+;base64,[A-Za-z0-9+/=]+")
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # not installed, or the encoding can't be fetched offline
+    _encoding = None
+
+
+def count_text_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def estimate_tokens(message: Message) -> int:
+    """
+    Estimates how many prompt tokens the message costs.
+
+    The estimate is cached on the message and only recomputed when its content is replaced.
+
+    :param message: The message to estimate.
+    :return: The estimated token count.
+    """
+    content = message.content
+    cache = message.token_cache
+    if cache is not None and cache[0] == id(content) and cache[1] == len(content):
+        return cache[2]
+
+    if isinstance(content, list):
+        tokens = 0
+        for item in content:
+            if item.get('type') == 'text':
+                tokens += count_text_tokens(item['text'])
+            else:
+                tokens += IMAGE_TOKENS
+    else:
+        tokens = count_text_tokens(str(content))
+    tokens += MESSAGE_OVERHEAD_TOKENS
+
+    message.token_cache = (id(content), len(content), tokens)
+    return tokens
+
+
+def strip_binary(message: Message) -> Message:
+    """Returns a copy of the message with images and inline base64 payloads replaced by short placeholders."""
+    if isinstance(message.content, list):
+        parts = [item['text'] if item.get('type') == 'text' else '[image omitted]' for item in message.content]
+        content = '\n'.join(parts)
+    else:
+        content = str(message.content)
+    return Message(message.role, DATA_URL_PTRN.sub('[binary data omitted]', content))
+
+
+class RollingSummarizer:
+    """
+    Keeps a running summary up to date by folding in only the messages evicted since the last compaction.
+
+    Every generation of the summary is kept in `generations` (and appended to `log_path` when given) so the
+    compactions can be audited later.
+
+    :param summarize: Called with the previous summary (None the first time) and the evicted messages.
+    :param log_path: Optional JSONL file the summary generations are appended to.
+    """
+
+    def __init__(self, summarize: Callable[[Optional[str], list[Message]], str], log_path: Optional[str] = None):
+        self.summarize = summarize
+        self.log_path = log_path
+        self.generations: list[dict] = []
+
+    def fold(self, previous_summary: Optional[str], evicted: list[Message]) -> str:
+        summary, generation = self.summarize_evicted(previous_summary, evicted)
+        self.record(generation)
+        return summary
+
+    def summarize_evicted(self, previous_summary: Optional[str], evicted: list[Message]) -> tuple[str, dict]:
+        """Computes the next summary without recording it, so a speculative result can still be thrown away."""
+        stripped = [strip_binary(message) for message in evicted]
+        started = time.time()
+        with get_tracer().span('summarize', evicted_messages=len(evicted)):
+            summary = self.summarize(previous_summary, stripped)
+        generation = dict(
+            created=started,
+            duration=time.time() - started,
+            evicted_messages=len(evicted),
+            evicted_tokens=sum(estimate_tokens(message) for message in evicted),
+            sent_tokens=sum(estimate_tokens(message) for message in stripped) + (count_text_tokens(previous_summary) if previous_summary else 0),
+            summary=summary,
+        )
+        return summary, generation
+
+    def record(self, generation: dict) -> None:
+        generation = dict(generation=len(self.generations) + 1, **generation)
+        self.generations.append(generation)
+        if self.log_path:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(generation) + '\n')
+
+
+class ContextManager:
+    """
+    Decides when a conversation has to be compacted, based on its estimated token count rather than its length.
+
+    Once the history passes `prefetch_ratio` of the budget, the next summary is computed speculatively on a
+    background thread, and swapped in by `maybe_compact` at a later turn boundary. If the history changed in a way
+    that invalidates it (the summarized prefix is no longer there) it is thrown away. `metrics` counts how often a
+    ready summary was used, how often we had to wait for one, and how often we fell back to summarizing in line.
+
+    :param model: The model the history is sent to, used to pick the token budget.
+    :param summarizer: Folds evicted messages into the running summary.
+    :param budget: Compaction is triggered once the history exceeds this many tokens.
+    :param keep_recent_tokens: How many tokens of the most recent messages are kept verbatim.
+    :param prefetch_ratio: Fraction of the budget at which a summary starts being computed in the background.
+    """
+
+    def __init__(self, model: str, summarizer: RollingSummarizer, budget: Optional[int] = None, keep_recent_tokens: Optional[int] = None, prefetch_ratio: float = 0.75):
+        self.model = model
+        self.summarizer = summarizer
+        self.budget = budget or MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+        self.keep_recent_tokens = keep_recent_tokens or self.budget // 4
+        self.prefetch_ratio = prefetch_ratio
+        self.metrics = dict(speculative_ready=0, speculative_waited=0, speculative_discarded=0, sync_fallback=0)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='summarizer')
+        # (summarized prefix of the history, length of its system head, future of (summary, generation))
+        self._speculation: Optional[tuple[list[Message], int, Future]] = None
+
+    def history_tokens(self, history: list[Message]) -> int:
+        return sum(estimate_tokens(message) for message in history)
+
+    def substitute(self, replacements: dict[int, Message]) -> None:
+        """
+        Records that messages of the history were replaced in place, so a summary being prepared in the background
+        from the originals still applies to the history.
+
+        :param replacements: id() of each replaced message -> the message that took its place.
+        """
+        if self._speculation is None:
+            return
+        prefix, head_len, future = self._speculation
+        self._speculation = ([replacements.get(id(message), message) for message in prefix], head_len, future)
+
+    def needs_compaction(self, history: list[Message]) -> bool:
+        return self.history_tokens(history) > self.budget
+
+    def split(self, history: list[Message]) -> tuple[list[Message], Optional[str], list[Message], list[Message]]:
+        """
+        Splits the history into the system prompt, the running summary, the messages to evict and the recent ones.
+
+        The recent window is the longest tail that fits in `keep_recent_tokens`, and always holds the last message.
+        """
+        head = history[:1] if history and history[0].role == 'system' else []
+        body = history[len(head):]
+        previous_summary = None
+        if body and isinstance(body[0].content, str) and body[0].content.startswith(SUMMARY_PREFIX):
+            previous_summary = body[0].content[len(SUMMARY_PREFIX):]
+            body = body[1:]
+        recent_start = len(body)
+        recent_tokens = 0
+        while recent_start > 0:
+            tokens = estimate_tokens(body[recent_start - 1])
+            if recent_start < len(body) and recent_tokens + tokens > self.keep_recent_tokens:
+                break
+            recent_tokens += tokens
+            recent_start -= 1
+        return head, previous_summary, body[:recent_start], body[recent_start:]
+
+    def compact(self, history: list[Message]) -> list[Message]:
+        """
+        Folds everything between the running summary and the recent window into the summary.
+
+        :param history: The conversation history.
+        :return: The compacted history, or the history unchanged if there is nothing to evict.
+        """
+        head, previous_summary, evicted, recent = self.split(history)
+        if not evicted:
+            return history
+        with get_tracer().span('compaction', mode='inline', tokens_before=self.history_tokens(history)) as span:
+            summary = self.summarizer.fold(previous_summary, evicted)
+            compacted = head + [Message('user', SUMMARY_PREFIX + summary)] + recent
+            span.set(tokens_after=self.history_tokens(compacted))
+        return compacted
+
+    def maybe_compact(self, history: list[Message]) -> list[Message]:
+        """
+        Called at every turn boundary. Swaps in a finished speculative summary, compacts in line if the history
+        is over budget and no usable speculation exists, and starts a new speculation when getting close.
+
+        May block while waiting on an in-flight summary or summarizing in line.
+
+        :param history: The conversation history.
+        :return: The history to use for the next call.
+        """
+        history = self._take_speculation(history)
+        if self.needs_compaction(history):
+            self.metrics['sync_fallback'] += 1
+            history = self.compact(history)
+        self._prefetch(history)
+        return history
+
+    def _take_speculation(self, history: list[Message]) -> list[Message]:
+        if self._speculation is None:
+            return history
+        prefix, head_len, future = self._speculation
+        compatible = len(history) >= len(prefix) and all(a is b for a, b in zip(prefix, history))
+        if not compatible:
+            future.cancel()
+            self._speculation = None
+            self.metrics['speculative_discarded'] += 1
+            return history
+        if not future.done() and not self.needs_compaction(history):
+            return history  # not needed yet, let it finish in the background
+        self._speculation = None
+        mode = 'speculative_ready' if future.done() else 'speculative_waited'
+        self.metrics[mode] += 1
+        # for a summary that wasn't ready yet, the span covers the wait
+        with get_tracer().span('compaction', mode=mode, tokens_before=self.history_tokens(history)) as span:
+            try:
+                summary, generation = future.result()
+            except Exception as e:
+                print(f"\033[91mBackground summarization failed: {e}\033[0m")
+                self.metrics['speculative_discarded'] += 1
+                span.status = 'error'
+                span.error = str(e)
+                return history
+            self.summarizer.record(generation)
+            compacted = history[:head_len] + [Message('user', SUMMARY_PREFIX + summary)] + history[len(prefix):]
+            span.set(tokens_after=self.history_tokens(compacted))
+        return compacted
+
+    def _prefetch(self, history: list[Message]) -> None:
+        if self._speculation is not None or self.history_tokens(history) <= self.budget * self.prefetch_ratio:
+            return
+        head, previous_summary, evicted, recent = self.split(history)
+        if not evicted:
+            return
+        prefix = history[:len(history) - len(recent)]
+        future = self._executor.submit(self.summarizer.summarize_evicted, previous_summary, evicted)
+        self._speculation = (prefix, len(head), future)
@@ -0,0 +1,229 @@
+import dataclasses
+import re
+from bisect import bisect_left
+from typing import List, Optional, Tuple
+
+
+HUNK_HEADER_PTRN = re.compile(r"^@@\s*-(\d+)(?:,\d+)?(?:\s+\+\d+(?:,\d+)?)?\s*@@")
+# how many lines of context to keep around a change block when a hunk has to be split
+SPLIT_CONTEXT = 3
+
+
+@dataclasses.dataclass
+class Hunk:
+    """
+    A single hunk of a (possibly sloppy) unified diff.
+
+    :param lines: The hunk body as (op, text) pairs, where op is one of ' ', '-' or '+'.
+    :param start_hint: 0-based line number from the `@@` header, if the diff had one.
+    """
+    lines: List[Tuple[str, str]]
+    start_hint: Optional[int] = None
+
+    @property
+    def has_changes(self) -> bool:
+        return any(op != ' ' for op, _ in self.lines)
+
+    def __str__(self) -> str:
+        return '\n'.join(op + text for op, text in self.lines)
+
+
+def _normalize(line: str) -> str:
+    return ' '.join(line.split())
+
+
+def _indent(line: str) -> str:
+    return line[:len(line) - len(line.lstrip())]
+
+
+def parse_diff(diff: str) -> List[Hunk]:
+    """
+    Parses the diff emitted by the Brain into hunks.
+
+    The diffs are written by an LLM, so the parser is lenient: code fences and file headers are skipped,
+    `@@` headers are optional, and lines without a '+', '-' or ' ' prefix are treated as context.
+
+    :param diff: The raw text between <|DIFF_START|> and <|DIFF_END|>.
+    :return: The hunks that contain at least one added or removed line.
+    """
+    raw_lines = diff.strip('\n').split('\n')
+    if raw_lines and raw_lines[0].strip().startswith('```'): raw_lines = raw_lines[1:]
+    if raw_lines and raw_lines[-1].strip().startswith('```'): raw_lines = raw_lines[:-1]
+
+    hunks = []
+    current = Hunk([])
+    for i, line in enumerate(raw_lines):
+        next_line = raw_lines[i + 1] if i + 1 < len(raw_lines) else ''
+        if line.startswith('diff --git') or line.startswith('index '):
+            continue
+        if line.startswith('--- ') and next_line.startswith('+++ '):
+            continue
+        if line.startswith('+++ ') and i > 0 and raw_lines[i - 1].startswith('--- '):
+            continue
+        if line.startswith('\\ '):
+            continue  # git's "\ No newline at end of file", not part of the file
+        if line.startswith('@@'):
+            hunks.append(current)
+            header_match = HUNK_HEADER_PTRN.match(line)
+            current = Hunk([], max(int(header_match.group(1)) - 1, 0) if header_match else None)
+            continue
+        if line.startswith('+') or line.startswith('-') or line.startswith(' '):
+            current.lines.append((line[0], line[1:]))
+        else:
+            current.lines.append((' ', line))
+    hunks.append(current)
+
+    return [hunk for hunk in hunks if hunk.has_changes]
+
+
+def _split_hunk(hunk: Hunk) -> List[Hunk]:
+    """Splits a hunk into one hunk per contiguous change block, each with its adjacent context."""
+    blocks = []
+    i = 0
+    lines = hunk.lines
+    while i < len(lines):
+        if lines[i][0] == ' ':
+            i += 1
+            continue
+        start = i
+        while i < len(lines) and lines[i][0] != ' ':
+            i += 1
+        ctx_start = start
+        while ctx_start > 0 and lines[ctx_start - 1][0] == ' ' and start - ctx_start < SPLIT_CONTEXT:
+            ctx_start -= 1
+        ctx_end = i
+        while ctx_end < len(lines) and lines[ctx_end][0] == ' ' and ctx_end - i < SPLIT_CONTEXT:
+            ctx_end += 1
+        blocks.append(Hunk(lines[ctx_start:ctx_end], hunk.start_hint))
+    return blocks
+
+
+def _find_matches(file_lines: List[str], hunk: Hunk) -> List[List[int]]:
+    """
+    Finds every place in the file where the hunk's context and removed lines appear.
+
+    Matching ignores whitespace differences and blank lines. Each match is returned as the list of file line
+    indices that the non-blank context/removed lines of the hunk map onto.
+    """
+    needle = [_normalize(text) for op, text in hunk.lines if op != '+' and text.strip()]
+    if not needle:
+        return []
+    nonblank = [i for i, line in enumerate(file_lines) if line.strip()]
+    haystack = [_normalize(file_lines[i]) for i in nonblank]
+
+    matches = []
+    for start in range(len(haystack) - len(needle) + 1):
+        if haystack[start:start + len(needle)] == needle:
+            matches.append(nonblank[start:start + len(needle)])
+    return matches
+
+
+def _reindent(text: str, diff_indent: str, file_indent: str) -> str:
+    """Shifts an added line by the offset between an anchor line's indentation in the diff and in the file."""
+    if not text.strip():
+        return ''
+    if len(file_indent) > len(diff_indent) and file_indent.startswith(diff_indent):
+        return file_indent[len(diff_indent):] + text
+    if len(diff_indent) > len(file_indent) and diff_indent.startswith(file_indent):
+        extra = diff_indent[len(file_indent):]
+        return text[len(extra):] if text.startswith(extra) else text
+    return text
+
+
+def _apply_at(file_lines: List[str], hunk: Hunk, mapping: List[int]) -> Tuple[List[str], int]:
+    """
+    Replaces the matched region of the file with the hunk's result.
+
+    Context lines are taken from the file (so their original whitespace survives), blank lines inside the
+    matched region are preserved, and added lines are re-indented by the offset between the diff and the file at
+    the nearest context or removed line (the preceding one on a tie), since a sloppy diff can be off by a different
+    amount at each nesting level.
+
+    :return: The updated file lines and the index right after the replaced region.
+    """
+    # hunk line index -> file line it is anchored to, for the non-blank context and removed lines
+    anchors = [i for i, (op, text) in enumerate(hunk.lines) if op != '+' and text.strip()]
+    anchor_file_line = dict(zip(anchors, mapping))
+
+    def reindent(position: int, text: str) -> str:
+        after = bisect_left(anchors, position)
+        nearest = min(anchors[max(after - 1, 0):after + 1], key=lambda anchor: (abs(anchor - position), anchor > position))
+        return _reindent(text, _indent(hunk.lines[nearest][1]), _indent(file_lines[anchor_file_line[nearest]]))
+
+    replacement = []
+    pointer = mapping[0]
+    anchor_idx = 0
+    for position, (op, text) in enumerate(hunk.lines):
+        if op == '+':
+            replacement.append(reindent(position, text))
+            continue
+        if not text.strip():
+            continue
+        target = mapping[anchor_idx]
+        anchor_idx += 1
+        if op == ' ':
+            replacement.extend(file_lines[pointer:target + 1])
+        else:
+            replacement.extend(file_lines[pointer:target])
+        pointer = target + 1
+
+    end = mapping[-1] + 1
+    return file_lines[:mapping[0]] + replacement + file_lines[end:], mapping[0] + len(replacement)
+
+
+def _apply_hunk(file_lines: List[str], hunk: Hunk, cursor: int) -> Optional[Tuple[List[str], int]]:
+    if not any(op != '+' and text.strip() for op, text in hunk.lines):
+        # pure addition without any context, we can only place it if the file is empty
+        if any(line.strip() for line in file_lines):
+            return None
+        added = [text for op, text in hunk.lines if op == '+']
+        return added, len(added)
+
+    matches = _find_matches(file_lines, hunk)
+    if not matches:
+        return None
+    expected = hunk.start_hint if hunk.start_hint is not None else cursor
+    # prefer the match closest to where we expect the hunk, favouring ones after the previous hunk
+    best = min(matches, key=lambda m: (m[0] < cursor, abs(m[0] - expected)))
+    return _apply_at(file_lines, hunk, best)
+
+
+def apply_hunks(contents: str, hunks: List[Hunk]) -> Tuple[str, List[Hunk], int]:
+    """
+    Applies the hunks to the file contents, locating each one by fuzzy context matching.
+
+    A hunk that cannot be placed as a whole is split into its individual change blocks, and each of those is
+    placed on its own.
+
+    :param contents: The current file contents.
+    :param hunks: The hunks returned by `parse_diff`.
+    :return: The updated contents, the hunks that could not be placed, and the number of hunks applied.
+    """
+    trailing_newline = contents.endswith('\n') or not contents
+    file_lines = contents.split('\n')
+    if trailing_newline: file_lines = file_lines[:-1]
+
+    failed = []
+    applied = 0
+    cursor = 0
+    for hunk in hunks:
+        result = _apply_hunk(file_lines, hunk, cursor)
+        if result is not None:
+            file_lines, cursor = result
+            applied += 1
+            continue
+        sub_hunks = _split_hunk(hunk)
+        if len(sub_hunks) < 2:
+            failed.append(hunk)
+            continue
+        for sub_hunk in sub_hunks:
+            result = _apply_hunk(file_lines, sub_hunk, cursor)
+            if result is None:
+                failed.append(sub_hunk)
+            else:
+                file_lines, cursor = result
+                applied += 1
+
+    new_contents = '\n'.join(file_lines)
+    if trailing_newline and file_lines: new_contents += '\n'
+    return new_contents, failed, applied
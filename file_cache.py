@@ -0,0 +1,66 @@
+import dataclasses
+import hashlib
+import os
+import threading
+from typing import Dict, Optional
+
+
+@dataclasses.dataclass
+class CachedFile:
+    """
+    A file's contents as last read from disk.
+
+    :param content: The file contents.
+    :param digest: Short sha256 of the contents.
+    :param mtime_ns: Modification time the contents were read at.
+    :param size: File size the contents were read at.
+    """
+    content: str
+    digest: str
+    mtime_ns: int
+    size: int
+
+
+def content_digest(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8', errors='replace')).hexdigest()[:16]
+
+
+class WorkspaceFileCache:
+    """
+    Caches workspace files keyed by path, re-reading one only when its mtime or size changed.
+
+    :param workspace: Root directory the paths are relative to.
+    """
+
+    def __init__(self, workspace: str):
+        self.workspace = workspace
+        self._files: Dict[str, CachedFile] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, rel_path: str) -> Optional[CachedFile]:
+        """
+        :param rel_path: Path relative to the workspace.
+        :return: The cached file, or None if it doesn't exist.
+        """
+        rel_path = os.path.normpath(rel_path)
+        abs_path = os.path.join(self.workspace, rel_path)
+        try:
+            stat = os.stat(abs_path)
+        except FileNotFoundError:
+            with self._lock:
+                self._files.pop(rel_path, None)
+            return None
+        with self._lock:
+            cached = self._files.get(rel_path)
+            if cached is not None and cached.mtime_ns == stat.st_mtime_ns and cached.size == stat.st_size:
+                self.hits += 1
+                return cached
+            self.misses += 1
+        with open(abs_path, 'r') as f:
+            content = f.read()
+        cached = CachedFile(content, content_digest(content), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            self._files[rel_path] = cached
+        return cached
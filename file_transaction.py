@@ -0,0 +1,167 @@
+"""
+All-or-nothing writes of several workspace files.
+
+    python file_transaction.py <workspace>    # finish or undo a transaction interrupted by a crash
+"""
+import argparse
+import json
+import os
+import shutil
+import uuid
+from typing import Dict, List, Optional
+
+
+# redo log of the transaction being committed, in the workspace
+TXN_JOURNAL = '.file_txn.json'
+
+
+def _fsync_dir(path: str) -> None:
+    try:
+        fd = os.open(path or '.', os.O_RDONLY)
+    except OSError:
+        return  # not supported on this platform
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_durable(path: str, content: str) -> None:
+    with open(path, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def atomic_write(path: str, content: str) -> None:
+    """Replaces the file in one step: readers (and a crash) see either the old or the new contents, never a mix."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        _write_durable(tmp_path, content)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class FileTransaction:
+    """
+    Writes a set of files so that either all of them or none of them change.
+
+    Every new file is staged next to its target (same directory, so the final rename can't cross file systems). Once
+    all are staged, a journal listing the renames is written, and the files are renamed over their targets. The
+    journal is the commit point:
+      - a failure before it is written removes the staged files, the workspace is untouched;
+      - a failure while renaming restores the files already renamed from their previous contents;
+      - a crash after it is written is completed by `recover` (the staged files are durable), so the workspace never
+        stays half-written.
+
+    Used as a context manager, leaving the block with an exception (whatever it is, e.g. an encoding error while
+    staging or a cancellation) aborts what wasn't committed.
+
+    :param workspace: Directory the paths are relative to, and where the journal is kept.
+    """
+
+    def __init__(self, workspace: str):
+        self.workspace = workspace
+        self.journal_path = os.path.join(workspace, TXN_JOURNAL)
+        # target path -> (staged path, previous contents or None for a new file)
+        self._staged: Dict[str, tuple[str, Optional[str]]] = {}
+
+    def stage(self, filename: str, content: str, previous: Optional[str]) -> None:
+        """
+        :param filename: Path relative to the workspace.
+        :param content: The new contents.
+        :param previous: The contents the new ones were computed from (None if the file doesn't exist), restored if
+            the commit fails halfway.
+        """
+        path = os.path.join(self.workspace, filename)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        staged_path = f"{path}.{uuid.uuid4().hex[:8]}.txn"
+        # registered first, so `abort` also removes a file whose write failed halfway
+        self._staged[path] = (staged_path, previous)
+        _write_durable(staged_path, content)
+        if os.path.exists(path):
+            shutil.copymode(path, staged_path)
+
+    def __enter__(self) -> 'FileTransaction':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.abort()
+
+    def commit(self) -> None:
+        """Renames every staged file over its target, all or nothing."""
+        entries = [dict(target=path, staged=staged) for path, (staged, _) in self._staged.items()]
+        try:
+            _write_durable(self.journal_path + '.tmp', json.dumps(entries))
+            os.replace(self.journal_path + '.tmp', self.journal_path)
+            _fsync_dir(self.workspace)
+        except BaseException:
+            self.abort()
+            raise
+
+        done: List[str] = []
+        try:
+            for path, (staged, _) in self._staged.items():
+                os.replace(staged, path)
+                done.append(path)
+            for directory in {os.path.dirname(path) for path in done}:
+                _fsync_dir(directory)
+        except BaseException:
+            # put back what was already replaced, the rest is still staged and gets removed
+            for path in done:
+                previous = self._staged[path][1]
+                if previous is None:
+                    os.remove(path)
+                else:
+                    atomic_write(path, previous)
+            self.abort()
+            raise
+        os.remove(self.journal_path)
+        self._staged = {}
+
+    def abort(self) -> None:
+        """Removes the staged files, leaving every target as it was."""
+        for staged, _ in self._staged.values():
+            if os.path.exists(staged):
+                os.remove(staged)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._staged = {}
+
+
+def recover(workspace: str) -> List[str]:
+    """
+    Completes a transaction whose commit was interrupted (the process died after the journal was written).
+
+    :return: The files that were written by the recovery.
+    """
+    journal_path = os.path.join(workspace, TXN_JOURNAL)
+    if not os.path.exists(journal_path):
+        return []
+    # written with a rename, so it is either complete or absent
+    with open(journal_path) as f:
+        entries = json.load(f)
+    recovered = []
+    for entry in entries:
+        if os.path.exists(entry['staged']):
+            os.replace(entry['staged'], entry['target'])
+            recovered.append(entry['target'])
+    os.remove(journal_path)
+    return recovered
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Complete a multi-file write interrupted by a crash.')
+    parser.add_argument('workspace', type=str, help='Workspace directory.')
+    args = parser.parse_args()
+    recovered = recover(args.workspace)
+    print(f"recovered {len(recovered)} file(s)" + ''.join(f"\n  {path}" for path in recovered))
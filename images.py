@@ -0,0 +1,206 @@
+import base64
+import dataclasses
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+
+# what PIL raises for data it can't decode (UnidentifiedImageError and truncated files are OSErrors)
+DECODE_ERRORS = (OSError, SyntaxError, Image.DecompressionBombError)
+# ((magic bytes, offset), ...), mime type
+IMAGE_SIGNATURES = [
+    (((b'\x89PNG\r\n\x1a\n', 0),), 'image/png'),
+    (((b'\xff\xd8\xff', 0),), 'image/jpeg'),
+    (((b'GIF87a', 0),), 'image/gif'),
+    (((b'GIF89a', 0),), 'image/gif'),
+    (((b'RIFF', 0), (b'WEBP', 8)), 'image/webp'),
+]
+EXTENSIONS = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/gif': 'gif', 'image/webp': 'webp'}
+
+
+def detect_mime(data: bytes) -> Optional[str]:
+    for parts, mime in IMAGE_SIGNATURES:
+        if all(data[offset:offset + len(magic)] == magic for magic, offset in parts):
+            return mime
+    return None
+
+
+@dataclasses.dataclass
+class ImageConfig:
+    """
+    How images are prepared before they go into the history.
+
+    :param max_side: Longest side in pixels, larger images are downscaled.
+    :param max_bytes: Byte budget of an encoded image, it is recompressed (and downscaled further) until it fits.
+    :param jpeg_quality: Starting quality when an image has to be recompressed as JPEG.
+    :param keep_turns: Images older than this many user turns are left out of requests, 0 keeps them all.
+    :param cache_dir: Where processed images are stored, by content hash.
+    """
+    max_side: int = int(os.environ.get('IMAGE_MAX_SIDE', 1568))
+    max_bytes: int = int(os.environ.get('IMAGE_MAX_BYTES', 1_000_000))
+    jpeg_quality: int = 85
+    keep_turns: int = int(os.environ.get('IMAGE_KEEP_TURNS', 0))
+    cache_dir: str = os.environ.get('IMAGE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'llm_engineer', 'images'))
+
+
+def _fits(data: bytes, config: ImageConfig, size: Tuple[int, int]) -> bool:
+    return len(data) <= config.max_bytes and max(size) <= config.max_side
+
+
+def process_image(data: bytes, config: ImageConfig) -> Tuple[bytes, str]:
+    """
+    Downscales and recompresses an image to fit the config, images that already fit are kept byte for byte.
+
+    :return: The encoded image and its mime type.
+    """
+    mime = detect_mime(data) or 'image/png'
+    image = Image.open(io.BytesIO(data))
+    if _fits(data, config, image.size) and mime in EXTENSIONS:
+        return data, mime
+
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((config.max_side, config.max_side))
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    quality = config.jpeg_quality
+    while True:
+        out = io.BytesIO()
+        if has_alpha:
+            image.save(out, format='PNG', optimize=True)
+            mime = 'image/png'
+        else:
+            image.convert('RGB').save(out, format='JPEG', quality=quality, optimize=True)
+            mime = 'image/jpeg'
+        encoded = out.getvalue()
+        if len(encoded) <= config.max_bytes or max(image.size) <= 64:
+            return encoded, mime
+        # lower the quality first, then the resolution
+        if not has_alpha and quality > 50:
+            quality -= 15
+        else:
+            image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)))
+
+
+class ImageStore:
+    """
+    Content-addressed store of processed images.
+
+    The history only holds `image_ref` items (digest, mime type, name); the base64 payload is built when a request is
+    prepared, from a small in-memory LRU or else from the processed file in `cache_dir`. Adding the same image twice
+    processes it once.
+
+    :param config: Size limits and cache location.
+    :param memory_items: How many encoded images are kept in memory.
+    """
+
+    def __init__(self, config: Optional[ImageConfig] = None, memory_items: int = 32):
+        self.config = config or ImageConfig()
+        self.memory_items = memory_items
+        self._encoded: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, digest: str, mime: str) -> str:
+        return os.path.join(self.config.cache_dir, f"{digest}.{EXTENSIONS.get(mime, 'bin')}")
+
+    def add_file(self, file_path: str) -> dict:
+        """
+        Processes an image file (or reuses the stored result) and returns the content item referencing it.
+
+        :raises ValueError: If the file isn't an image we recognize, or it can't be decoded.
+        """
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        if detect_mime(data) is None:
+            raise ValueError(f"{file_path} is not a PNG, JPEG, GIF or WebP image")
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        for mime in EXTENSIONS:
+            if os.path.exists(self._path(digest, mime)):
+                self.hits += 1
+                break
+        else:
+            self.misses += 1
+            try:
+                encoded, mime = process_image(data, self.config)
+            except DECODE_ERRORS as e:
+                raise ValueError(f"{file_path} could not be decoded as an image: {e}") from e
+            os.makedirs(self.config.cache_dir, exist_ok=True)
+            tmp_path = self._path(digest, mime) + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(encoded)
+            os.replace(tmp_path, self._path(digest, mime))
+        return {'type': 'image_ref', 'image_ref': {'digest': digest, 'mime': mime, 'name': os.path.basename(file_path)}}
+
+    def load_base64(self, ref: dict) -> Optional[str]:
+        """The base64 payload of a referenced image, None if it is no longer in the cache dir."""
+        digest = ref['digest']
+        with self._lock:
+            encoded = self._encoded.get(digest)
+            if encoded is not None:
+                self._encoded.move_to_end(digest)
+                return encoded
+        path = self._path(digest, ref['mime'])
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            encoded = base64.b64encode(f.read()).decode('utf-8')
+        with self._lock:
+            self._encoded[digest] = encoded
+            if len(self._encoded) > self.memory_items:
+                self._encoded.popitem(last=False)
+        return encoded
+
+    def materialize(self, item: dict, provider: str) -> dict:
+        """
+        Turns an image item into the provider's format: `image_ref`s get their payload, and data URLs (histories
+        from before refs) are converted for anthropic.
+        """
+        if item['type'] == 'image_ref':
+            ref = item['image_ref']
+            mime, encoded = ref['mime'], self.load_base64(ref)
+            if encoded is None:
+                return {'type': 'text', 'text': f"[image {ref['name']} is no longer available]"}
+        elif item['type'] == 'image_url' and item['image_url']['url'].startswith('data:'):
+            header, encoded = item['image_url']['url'].split(',', 1)
+            mime = header[len('data:'):].split(';')[0]
+        else:
+            return item
+        if provider == 'anthropic':
+            return {'type': 'image', 'source': {'type': 'base64', 'media_type': mime, 'data': encoded}}
+        return {'type': 'image_url', 'image_url': {'url': f"data:{mime};base64,{encoded}"}}
+
+
+def describe_image(item: dict) -> str:
+    """Short text standing in for an image, for displays and for images dropped from a request."""
+    if item['type'] == 'image_ref':
+        return f"[image {item['image_ref']['name']}]"
+    return '[image]'
+
+
+_store: Optional[ImageStore] = None
+_store_lock = threading.Lock()
+
+
+def configure_images(**kwargs: Any) -> ImageStore:
+    """
+    Replaces the shared image store.
+
+    :param kwargs: Any of the `ImageConfig` fields.
+    """
+    global _store
+    with _store_lock:
+        _store = ImageStore(ImageConfig(**kwargs))
+    return _store
+
+
+def get_image_store() -> ImageStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ImageStore()
+        return _store
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+
+CACHE_MODES = ('off', 'rw', 'replay')
+
+
+class ReplayMiss(RuntimeError):
+    """Raised in replay mode when a call has no recorded response."""
+
+
+class LLMCache:
+    """
+    Content-addressed, size-bounded store of LLM responses backed by SQLite.
+
+    Modes:
+      - rw: serve hits from the cache, record misses.
+      - replay: serve hits from the cache, raise `ReplayMiss` on misses. Nothing is written.
+
+    :param path: SQLite file to store the responses in.
+    :param mode: 'rw' or 'replay'.
+    :param max_bytes: Once the stored responses exceed this, the least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str, mode: str = 'rw', max_bytes: int = 256 * 1024 * 1024):
+        if mode not in ('rw', 'replay'):
+            raise ValueError(f"Unsupported cache mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # tool threads call llm_call concurrently
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, '
+            'created REAL NOT NULL, last_access REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+
+    @staticmethod
+    def key(provider: str, model: str, message_json: List[str], temperature: float, stop_tokens: List[str], max_tokens: int) -> str:
+        """
+        Stable hash of everything that determines the response.
+
+        :param message_json: The merged messages (including the system prompt), each already serialized to JSON.
+        """
+        digest = hashlib.sha256(json.dumps(
+            [provider, model, temperature, sorted(stop_tokens), max_tokens],
+            sort_keys=True, ensure_ascii=False, separators=(',', ':'),
+        ).encode('utf-8'))
+        for message in message_json:
+            digest.update(b'\n')
+            digest.update(message.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.mode == 'replay':
+                    raise ReplayMiss(f"No recorded response for {key} in {self.path}")
+                return None
+            self.hits += 1
+            if self.mode == 'rw':
+                self._db.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        if self.mode != 'rw':
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses (key, response, size, created, last_access) VALUES (?, ?, ?, ?, ?)',
+                (key, response, len(response.encode('utf-8')), now, now),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute('SELECT key, size FROM responses ORDER BY last_access').fetchall():
+            self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, total = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return dict(mode=self.mode, hits=self.hits, misses=self.misses, entries=entries, bytes=total)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+_cache: Optional[LLMCache] = None
+
+
+def configure_cache(path: str, mode: str = 'rw', max_bytes: int = 256 * 1024 * 1024) -> Optional[LLMCache]:
+    """
+    Sets the process-wide response cache used by `llm_call` and the streaming calls.
+
+    :param path: SQLite file to store the responses in, usually under the workspace.
+    :param mode: One of 'off', 'rw' or 'replay'.
+    :param max_bytes: Size bound for the stored responses.
+    :return: The cache, or None when the mode is 'off'.
+    """
+    global _cache
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Cache mode must be one of {CACHE_MODES}, got {mode}")
+    if _cache is not None:
+        _cache.close()
+    _cache = LLMCache(path, mode, max_bytes) if mode != 'off' else None
+    return _cache
+
+
+def get_cache() -> Optional[LLMCache]:
+    return _cache
+
+
+if os.environ.get('LLM_CACHE_MODE', 'off') != 'off':
+    configure_cache(os.environ.get('LLM_CACHE_PATH', '.llm_cache.sqlite'), os.environ['LLM_CACHE_MODE'])
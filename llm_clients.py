@@ -0,0 +1,160 @@
+import asyncio
+import atexit
+import dataclasses
+import os
+import threading
+import weakref
+from typing import Any, Dict, Optional, Tuple
+
+import anthropic
+import httpx
+import openai
+
+
+# provider -> (api key env var, base url env var, default base url)
+PROVIDERS: Dict[str, Tuple[str, str, Optional[str]]] = {
+    'openai': ('OPENAI_API_KEY', 'OPENAI_BASE_URL', None),
+    'together': ('TOGETHER_API_KEY', 'TOGETHER_BASE_URL', 'https://api.together.xyz/v1'),
+    'anthropic': ('ANTHROPIC_API_KEY', 'ANTHROPIC_BASE_URL', None),
+}
+
+
+@dataclasses.dataclass
+class PoolConfig:
+    """
+    Connection pool settings shared by every provider client.
+
+    :param max_connections: Upper bound on concurrent connections per client.
+    :param max_keepalive_connections: How many idle connections are kept open for reuse.
+    :param keepalive_expiry: Seconds an idle connection is kept before it is closed.
+    :param connect_timeout: Seconds to wait for a connection to be established.
+    :param read_timeout: Seconds to wait for the provider to respond.
+    """
+    max_connections: int = int(os.environ.get('LLM_POOL_SIZE', 20))
+    max_keepalive_connections: int = int(os.environ.get('LLM_POOL_KEEPALIVE', 10))
+    keepalive_expiry: float = float(os.environ.get('LLM_POOL_KEEPALIVE_EXPIRY', 60))
+    connect_timeout: float = float(os.environ.get('LLM_CONNECT_TIMEOUT', 10))
+    read_timeout: float = float(os.environ.get('LLM_READ_TIMEOUT', 600))
+
+
+_config = PoolConfig()
+_clients: Dict[Tuple[str, Optional[str], str], Any] = {}
+# async clients hold connections bound to the event loop they were created on, so they are kept per loop
+_async_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, Optional[str], str], Any]]' = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def configure_pool(**kwargs: Any) -> None:
+    """
+    Updates the pool settings. Already created clients are closed, so the next call picks up the new settings.
+
+    :param kwargs: Any of the `PoolConfig` fields.
+    """
+    global _config
+    _config = dataclasses.replace(_config, **kwargs)
+    close_clients()
+
+
+def _pool_kwargs() -> Dict[str, Any]:
+    return dict(
+        limits=httpx.Limits(
+            max_connections=_config.max_connections,
+            max_keepalive_connections=_config.max_keepalive_connections,
+            keepalive_expiry=_config.keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(_config.read_timeout, connect=_config.connect_timeout),
+    )
+
+
+def _client_key(provider: str) -> Tuple[str, Optional[str], str]:
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown provider: {provider}")
+    key_env, base_url_env, default_base_url = PROVIDERS[provider]
+    return provider, os.environ.get(base_url_env, default_base_url), os.environ[key_env]
+
+
+def get_client(provider: str) -> Any:
+    """
+    Returns the process-wide client for the provider, creating it on first use.
+
+    Clients are keyed by (provider, base url, api key), so changing the environment yields a fresh client
+    instead of silently reusing one configured for another endpoint.
+
+    :param provider: One of the keys of `PROVIDERS`.
+    :return: An `openai.OpenAI` or `anthropic.Anthropic` client backed by a keep-alive connection pool.
+    """
+    key = _client_key(provider)
+    _, base_url, api_key = key
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            http_client = httpx.Client(**_pool_kwargs())
+            if provider == 'anthropic':
+                client = anthropic.Anthropic(api_key=api_key, base_url=base_url, http_client=http_client)
+            else:
+                client = openai.OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+            _clients[key] = client
+    return client
+
+
+def get_async_client(provider: str) -> Any:
+    """
+    Async counterpart of `get_client`, must be called from within a running event loop.
+
+    :param provider: One of the keys of `PROVIDERS`.
+    :return: An `openai.AsyncOpenAI` or `anthropic.AsyncAnthropic` client pooled for the running loop.
+    """
+    key = _client_key(provider)
+    _, base_url, api_key = key
+    loop = asyncio.get_running_loop()
+
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            http_client = httpx.AsyncClient(**_pool_kwargs())
+            if provider == 'anthropic':
+                client = anthropic.AsyncAnthropic(api_key=api_key, base_url=base_url, http_client=http_client)
+            else:
+                client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+            clients[key] = client
+    return client
+
+
+def drain_response(response: httpx.Response) -> None:
+    """
+    Reads the rest of a streaming response's body, so closing it returns the connection to the pool.
+
+    The sync openai client closes a stream's response as soon as it reads `[DONE]`, without reading the end of the HTTP
+    body, and a response closed with its body unread drops its connection: every streamed call would open a new one.
+    (The async client drains it itself.) Callers therefore stop reading the stream at its last chunk and call this
+    before closing it. Only for streams that were read to the end, an abandoned one should drop its connection.
+    """
+    if response.is_closed:
+        return
+    try:
+        for _ in response.stream:
+            pass
+    except httpx.HTTPError:
+        pass  # the connection gets dropped on close, the output was complete anyway
+
+
+def close_clients() -> None:
+    """Closes every pooled sync client and its open connections."""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+async def aclose_clients() -> None:
+    """Closes the async clients pooled for the running event loop."""
+    with _lock:
+        clients = list(_async_clients.pop(asyncio.get_running_loop(), {}).values())
+    for client in clients:
+        await client.close()
+
+
+atexit.register(close_clients)
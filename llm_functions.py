@@ -1,171 +1,404 @@
+import contextvars
 import dataclasses
 import difflib
 import json
-import openai
-import anthropic
 import os
 import re
-import requests  # Importing requests library for making HTTP requests
-from typing import Optional, Callable, List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Optional, AsyncIterator, Callable, Iterator, List
+from context_manager import count_text_tokens, estimate_tokens
+from diff_applier import apply_hunks, parse_diff
+from file_transaction import FileTransaction, atomic_write
+from images import get_image_store
+from llm_cache import get_cache
+from llm_clients import drain_response, get_async_client, get_client
 from message import Message, MessageToPrint
+from message_view import PreparedMessages, merge_contents, prepare_messages
+from rewrite_validation import validate_rewrite
+from search import SearchResult, get_search_client
+from tracing import Span, get_tracer
 
 
 END_OF_INPUT = "<|ROHAN_OUT|>"
+# Anthropic caches the prompt up to a block carrying this, for 5 minutes since its last use
+CACHE_CONTROL = {'type': 'ephemeral'}
 
-@dataclasses.dataclass
-class SearchResult:
+# file rewrites requested concurrently from the llm, the first valid one is used
+REWRITE_MODEL = 'gpt-4o-mini'
+REWRITE_TEMPERATURE = 0.8
+REWRITE_CANDIDATES = int(os.environ.get('REWRITE_CANDIDATES', 3))
+# shared by all rewrites, tool threads rewriting different files at once get their candidates from here
+_rewrite_pool = ThreadPoolExecutor(max_workers=12, thread_name_prefix='rewriter')
+
+# files of a multi-file edit whose diffs are merged at once
+MAX_PARALLEL_EDITS = 8
+# the diff shown in a multi-file edit report is cut after this many lines
+MAX_REPORT_DIFF_LINES = 400
+
+# asks OpenAI-style providers for a last stream chunk carrying the request's usage
+STREAM_OPTIONS = {'include_usage': True}
+# provider-side prompt cache usage, as reported by the providers, over all calls of the process
+prompt_cache_totals = dict(requests=0, prompt_tokens=0, cached_tokens=0, cache_write_tokens=0)
+_prompt_cache_lock = threading.Lock()
+
+
+def merge_messages(messages: list[Message]) -> list[Message]:
     """
-    Dataclass to represent the search results from Brave Search API.
-    
-    :param title: The title of the search result.
-    :param url: The URL of the search result.
-    :param description: A brief description of the search result.
-    :param extra_snippets: Additional snippets related to the search result.
+    Merges consecutive messages from the same role into one, joining text with a newline.
+
+    The input messages are left untouched, merged messages are new objects. Requests go through
+    `message_view.prepare_messages`, which does the same incrementally.
+
+    :param messages: A list of Message objects containing the conversation history.
+    :return: The merged list of messages.
     """
-    title: str
-    url: str
-    description: str
-    extra_snippets: list
-
-    def __str__(self) -> str:
-        """
-        Returns a string representation of the search result.
-
-        :return: A string representation of the search result.
-        """
-        return (
-            f"Title: {self.title}\n"
-            f"URL: {self.url}\n"
-            f"Description: {self.description}\n"
-            f"Extra Snippets: {', '.join(self.extra_snippets)}"
-        )
+    merged_messages: list[Message] = []
+    i = 0
+    while i < len(messages):
+        j = i + 1
+        while j < len(messages) and messages[j].role == messages[i].role:
+            j += 1
+        merged_messages.append(Message(messages[i].role, merge_contents([m.content for m in messages[i:j]])))
+        i = j
+    return merged_messages
+
 
+def _stop_list(stop_tokens: str | list[str] | None) -> list[str]:
+    if stop_tokens is None: return []
+    if isinstance(stop_tokens, str): return [stop_tokens, ]
+    return stop_tokens
 
-def llm_call(model: str, messages: list[Message], temperature: float, provider: str = 'openai', stop_tokens: str | list[str] | None = None, max_tokens: int = 4096) -> str:
+
+def llm_call(model: str, messages: list[Message], temperature: float, provider: str = 'openai', stop_tokens: str | list[str] | None = None, max_tokens: int = 4096, prompt_cache: bool = True) -> str:
     """
     Calls the OpenAI API to get a response based on the model and messages provided.
 
     :param model: The name of the model to call.
     :param messages: A list of Message objects containing the conversation history.
     :param temperature: The temperature setting for randomness in the response.
+    :param prompt_cache: Mark the prompt prefix for provider-side caching (Anthropic `cache_control` breakpoints on the
+        system prompt and the last message; OpenAI-style providers cache stable prefixes on their own).
     :return: The content of the response from the model.
     """
-    # loop over messages, and see if consecutive user or assistant messages are present, if yes, then merge them into one with '\n\n' as sep
-    merged_messages = []
-    current_message = None
-
-    for message in messages:
-        if current_message is not None and message.role == current_message.role:
-            if isinstance(current_message.content, list):
-                if isinstance(message.content, list):
-                    current_message.content += message.content
-                else:
-                    current_message.content += [dict(type='text', text=message.content),]
-            else:
-                if isinstance(message.content, list):
-                    current_message.content = [dict(type='text', text=current_message.content),] + message.content
-                else:
-                    current_message.content += '\n' + message.content
-        else:
-            if current_message:
-                merged_messages.append(current_message)
-            current_message = message
-
-    if current_message:
-        merged_messages.append(current_message)
-    messages = merged_messages
-
+    with get_tracer().span('llm_call', provider=provider, model=model, stream=False) as span:
+        prepared = prepare_messages(messages, provider)
+        system_msg, messages = prepared.system_msg, prepared.messages
+        cache_key = _cache_key(provider, model, prepared, temperature, stop_tokens, max_tokens)
+        if cache_key is not None:
+            cached = get_cache().get(cache_key)
+            if cached is not None:
+                span.set(cache='hit')
+                return cached
+
+        ret = _llm_call(get_client(provider), model, system_msg, messages, temperature, provider, stop_tokens, max_tokens, prompt_cache, span)
+        _estimate_usage(span, messages, ret)
+        if cache_key is not None: get_cache().put(cache_key, ret)
+        return ret
+
+
+def _llm_call(client, model: str, system_msg: str | None, messages: list[Message], temperature: float, provider: str, stop_tokens: str | list[str] | None, max_tokens: int, prompt_cache: bool, span: Span) -> str:
     if provider == 'anthropic':
-        client = anthropic.Anthropic(api_key=os.environ['ANTHROPIC_API_KEY'])
-        if messages[0].role == 'system':
-            system_msg = messages[0].content
-            messages = messages[1:]
-        # Send a message to Claude 3.5 Sonnet
         response = client.messages.create(
             model=model,
-            system=system_msg,
-            max_tokens=4096,
-            messages=[dataclasses.asdict(x) for x in messages],
+            max_tokens=max_tokens,
+            temperature=temperature,
+            messages=_anthropic_messages(messages, prompt_cache),
+            **_anthropic_kwargs(system_msg, stop_tokens, prompt_cache),
         )
-        # Print the response
+        _add_usage(span, response.usage, response.stop_reason)
         return response.content[0].text
-    if provider == 'openai':
-        client = openai.OpenAI(
-            api_key=os.environ["OPENAI_API_KEY"]
-        )  # Initialize OpenAI client
-    elif provider == 'together':
-        client = openai.OpenAI(
-            api_key=os.environ["TOGETHER_API_KEY"],
-            base_url='https://api.together.xyz/v1'
-        )
-        new_messages = []
-        for x in messages:
-            content = []
-            if isinstance(x.content, list):
-                for c in x.content:
-                    if c['type'] == 'image':
-                        raise ValueError("Together doesn't have an image processor")
-                    content.append(c['text'].strip())
-                new_messages.append(Message(x.role, ('\n'.join(content)).strip()))
-            else:
-                new_messages.append(x)
-        messages = new_messages
 
-    if stop_tokens is None: stop_tokens = []
-    elif isinstance(stop_tokens, str): stop_tokens = [stop_tokens, ]
     ret = ''
     for _ in range(3):
         res = client.chat.completions.create(
             model=model,
-            messages=[dataclasses.asdict(x) for x in messages],
+            messages=[x.to_dict() for x in messages],
             temperature=temperature,
             max_tokens=max_tokens,
-            stop=stop_tokens,
+            stop=_stop_list(stop_tokens),
         )
         # check for finish reason, and re-request, if needed
         finish_reason = res.choices[0].finish_reason
+        _add_usage(span, res.usage, finish_reason)
+        ret += res.choices[0].message.content
         if finish_reason == 'length':
             messages = messages + [Message(role='assistant', content=res.choices[0].message.content), ]
         else:
-            return ret + res.choices[0].message.content
+            return ret
+    return ret
+
+
+def llm_stream(model: str, messages: list[Message], temperature: float, provider: str = 'openai', stop_tokens: str | list[str] | None = None, max_tokens: int = 4096, prompt_cache: bool = True, response_cache: bool = True) -> Iterator[str]:
+    """
+    Streaming counterpart of `llm_call`, yields the response text as it is generated.
+
+    :param model: The name of the model to call.
+    :param messages: A list of Message objects containing the conversation history.
+    :param temperature: The temperature setting for randomness in the response.
+    :param prompt_cache: See `llm_call`.
+    :param response_cache: Look the call up in (and record it to) the response cache, if one is configured. Off for
+        calls whose responses the caller still has to accept, it stores the accepted one itself.
+    :return: A generator of text deltas, which concatenated give the same result as `llm_call`.
+    """
+    # not made the current span, the caller runs its own code (and starts its own spans) between deltas
+    tracer = get_tracer()
+    span = tracer.start_span('llm_call', provider=provider, model=model, stream=True)
+    try:
+        prepared = prepare_messages(messages, provider)
+        system_msg, messages = prepared.system_msg, prepared.messages
+        cache_key = _cache_key(provider, model, prepared, temperature, stop_tokens, max_tokens) if response_cache else None
+        if cache_key is not None:
+            cached = get_cache().get(cache_key)
+            if cached is not None:
+                span.set(cache='hit')
+                yield cached
+                tracer.end_span(span)
+                return
+
+        content = ''
+        for delta in _llm_stream(get_client(provider), model, system_msg, messages, temperature, provider, stop_tokens, max_tokens, prompt_cache, span):
+            if not content: span.set(ttft=time.perf_counter() - span.started)
+            content += delta
+            yield delta
+        _estimate_usage(span, messages, content)
+        # only a fully consumed stream gets recorded
+        if cache_key is not None: get_cache().put(cache_key, content)
+    except BaseException as e:
+        tracer.end_span(span, e)
+        raise
+    tracer.end_span(span)
+
+
+def _llm_stream(client, model: str, system_msg: str | None, messages: list[Message], temperature: float, provider: str, stop_tokens: str | list[str] | None, max_tokens: int, prompt_cache: bool, span: Span) -> Iterator[str]:
+    if provider == 'anthropic':
+        with client.messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            messages=_anthropic_messages(messages, prompt_cache),
+            **_anthropic_kwargs(system_msg, stop_tokens, prompt_cache),
+        ) as stream:
+            yield from stream.text_stream
+            final = stream.get_final_message()
+            _add_usage(span, final.usage, final.stop_reason)
+        return
+
+    for _ in range(3):
+        chunks = client.chat.completions.create(
+            model=model,
+            messages=[x.to_dict() for x in messages],
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stop=_stop_list(stop_tokens),
+            stream=True,
+            # without it, OpenAI-style streams don't report usage (tokens, cached prompt tokens) at all
+            stream_options=STREAM_OPTIONS,
+        )
+        content = ''
+        finish_reason = None
+        usage = None
+        # closes the response (freeing the connection) when the caller stops reading early
+        with chunks:
+            for chunk in chunks:
+                # providers that report usage on streams put it on the last chunk, which may have no choices
+                usage = getattr(chunk, 'usage', None) or usage
+                if not chunk.choices:
+                    if usage is not None:
+                        # only [DONE] follows, drain the body ourselves so the connection is reused
+                        drain_response(chunks.response)
+                        break
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    content += delta
+                    yield delta
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+        _add_usage(span, usage, finish_reason)
+        # same continuation as llm_call when the response got cut off
+        if finish_reason == 'length':
+            messages = messages + [Message(role='assistant', content=content), ]
+        else:
+            return
+
+
+async def allm_stream(model: str, messages: list[Message], temperature: float, provider: str = 'openai', stop_tokens: str | list[str] | None = None, max_tokens: int = 4096, prompt_cache: bool = True, response_cache: bool = True) -> AsyncIterator[str]:
+    """
+    Async counterpart of `llm_stream`, built on the async provider clients.
+
+    :param model: The name of the model to call.
+    :param messages: A list of Message objects containing the conversation history.
+    :param temperature: The temperature setting for randomness in the response.
+    :param prompt_cache: See `llm_call`.
+    :param response_cache: See `llm_stream`.
+    :return: An async generator of text deltas.
+    """
+    tracer = get_tracer()
+    span = tracer.start_span('llm_call', provider=provider, model=model, stream=True)
+    try:
+        prepared = prepare_messages(messages, provider)
+        system_msg, messages = prepared.system_msg, prepared.messages
+        cache_key = _cache_key(provider, model, prepared, temperature, stop_tokens, max_tokens) if response_cache else None
+        if cache_key is not None:
+            cached = get_cache().get(cache_key)
+            if cached is not None:
+                span.set(cache='hit')
+                yield cached
+                tracer.end_span(span)
+                return
+
+        content = ''
+        async for delta in _allm_stream(get_async_client(provider), model, system_msg, messages, temperature, provider, stop_tokens, max_tokens, prompt_cache, span):
+            if not content: span.set(ttft=time.perf_counter() - span.started)
+            content += delta
+            yield delta
+        _estimate_usage(span, messages, content)
+        if cache_key is not None: get_cache().put(cache_key, content)
+    except BaseException as e:
+        tracer.end_span(span, e)
+        raise
+    tracer.end_span(span)
+
+
+async def _allm_stream(client, model: str, system_msg: str | None, messages: list[Message], temperature: float, provider: str, stop_tokens: str | list[str] | None, max_tokens: int, prompt_cache: bool, span: Span) -> AsyncIterator[str]:
+    if provider == 'anthropic':
+        async with client.messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            messages=_anthropic_messages(messages, prompt_cache),
+            **_anthropic_kwargs(system_msg, stop_tokens, prompt_cache),
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            final = await stream.get_final_message()
+            _add_usage(span, final.usage, final.stop_reason)
+        return
+
+    for _ in range(3):
+        chunks = await client.chat.completions.create(
+            model=model,
+            messages=[x.to_dict() for x in messages],
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stop=_stop_list(stop_tokens),
+            stream=True,
+            # without it, OpenAI-style streams don't report usage (tokens, cached prompt tokens) at all
+            stream_options=STREAM_OPTIONS,
+        )
+        content = ''
+        finish_reason = None
+        usage = None
+        async with chunks:
+            async for chunk in chunks:
+                usage = getattr(chunk, 'usage', None) or usage
+                if not chunk.choices: continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    content += delta
+                    yield delta
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+        _add_usage(span, usage, finish_reason)
+        if finish_reason == 'length':
+            messages = messages + [Message(role='assistant', content=content), ]
+        else:
+            return
+
+
+def _cache_key(provider: str, model: str, prepared: PreparedMessages, temperature: float, stop_tokens: str | list[str] | None, max_tokens: int) -> str | None:
+    """Key of the call in the response cache, None when caching is off."""
+    cache = get_cache()
+    if cache is None:
+        return None
+    return cache.key(provider, model, prepared.message_json(), temperature, _stop_list(stop_tokens), max_tokens)
+
+
+def _anthropic_messages(messages: list[Message], prompt_cache: bool) -> list[dict]:
+    """
+    The request messages, with a cache breakpoint on the last one when caching: the next call of the conversation
+    extends this prompt, so it reads everything up to here from the cache and only pays for what was appended.
+    """
+    dicts = [x.to_dict() for x in messages]
+    if prompt_cache and dicts:
+        # a copy, the formatted messages are shared with the incremental view
+        last = dict(dicts[-1])
+        content = last['content']
+        blocks = [dict(type='text', text=content)] if isinstance(content, str) else [dict(item) for item in content]
+        if blocks:
+            blocks[-1]['cache_control'] = CACHE_CONTROL
+            last['content'] = blocks
+        dicts[-1] = last
+    return dicts
+
+
+def _add_usage(span: Span, usage: Any, finish_reason: str | None) -> None:
+    """Adds one request's token usage (OpenAI or Anthropic style, None if not reported) to the call's span."""
+    attributes = span.attributes
+    attributes['requests'] = attributes.get('requests', 0) + 1
+    attributes['finish_reason'] = finish_reason
+    if usage is None:
+        return
+    completion_tokens = getattr(usage, 'completion_tokens', None) or getattr(usage, 'output_tokens', None) or 0
+    if hasattr(usage, 'input_tokens'):
+        # anthropic counts the cached part of the prompt separately from input_tokens
+        cached_tokens = getattr(usage, 'cache_read_input_tokens', None) or 0
+        cache_write_tokens = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        prompt_tokens = (usage.input_tokens or 0) + cached_tokens + cache_write_tokens
+    else:
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0
+        cache_write_tokens = 0
+        prompt_tokens = usage.prompt_tokens or 0
+    for key, value in (('prompt_tokens', prompt_tokens), ('completion_tokens', completion_tokens), ('cached_tokens', cached_tokens), ('cache_write_tokens', cache_write_tokens)):
+        attributes[key] = attributes.get(key, 0) + value
+    with _prompt_cache_lock:
+        prompt_cache_totals['requests'] += 1
+        prompt_cache_totals['prompt_tokens'] += prompt_tokens
+        prompt_cache_totals['cached_tokens'] += cached_tokens
+        prompt_cache_totals['cache_write_tokens'] += cache_write_tokens
+
+
+def prompt_cache_stats() -> dict:
+    """How much of the prompts the providers served from their prompt cache, over all calls that reported usage."""
+    with _prompt_cache_lock:
+        stats = dict(prompt_cache_totals)
+    stats['hit_rate'] = stats['cached_tokens'] / stats['prompt_tokens'] if stats['prompt_tokens'] else 0.0
+    return stats
+
+
+def _estimate_usage(span: Span, messages: list[Message], content: str) -> None:
+    """Fills in estimated token counts when the provider didn't report usage, and only if anything is traced."""
+    if 'prompt_tokens' in span.attributes or not get_tracer().enabled:
+        return
+    span.set(
+        prompt_tokens=sum(estimate_tokens(message) for message in messages),
+        completion_tokens=count_text_tokens(content),
+        tokens_estimated=True,
+    )
+
+
+def _anthropic_kwargs(system_msg: str | None, stop_tokens: str | list[str] | None, prompt_cache: bool) -> dict:
+    kwargs: dict = {}
+    if system_msg is not None:
+        kwargs['system'] = [dict(type='text', text=system_msg, cache_control=CACHE_CONTROL)] if prompt_cache else system_msg
+    if stop_tokens: kwargs['stop_sequences'] = _stop_list(stop_tokens)
+    return kwargs
 
 
 def search_brave(query: str, api_key: str, count: int = 10) -> List[SearchResult]:
     """
     Searches the web using Brave Search API and returns structured search results.
 
+    Goes through the shared `search.BraveSearchClient`, so repeated queries are served from its TTL cache and
+    concurrent identical queries share one HTTP call.
+
     :param query: The search query string.
     :param api_key: The API key for authentication with the Brave Search service.
     :param count: The number of search results to return.
     :return: A list of SearchResult objects containing the search results.
     """
-    url = "https://api.search.brave.com/res/v1/web/search"
-    headers = {
-        "Accept": "application/json",
-        "X-Subscription-Token": api_key
-    }
-    params = {
-        "q": query,
-        "count": count
-    }
-
-    response = requests.get(url, headers=headers, params=params)
-    response.raise_for_status()  # Raises an exception for HTTP errors
-    results_json = response.json()
-    
-    results = []
-    for item in results_json.get('web', {}).get('results', []):
-        result = SearchResult(
-            title=item.get('title', ''),
-            url=item.get('url', ''),
-            description=item.get('description', ''),
-            extra_snippets=item.get('extra_snippets', [])
-        )
-        results.append(result)
-
-    return results
-
-
+    return get_search_client().search(query, api_key, count)
 
 
 def get_input_from_user() -> Message:
@@ -205,13 +438,10 @@ def get_input_from_user() -> Message:
         if image_match:
             file_path = image_match.group(1).strip()
             if os.path.exists(file_path):
-                with open(file_path, 'rb') as f:
-                    image_content = f.read()
-                    import base64
-                    base64_image = base64.b64encode(image_content).decode('utf-8')
-                # Updated line to include the image data URL prefix
-                content_list.append({"type": "image_url", "image_url": {'url': f"data:image/png;base64,{base64_image}"}})
-                #print('IMAGE:\n', base64_image)
+                try:
+                    content_list.append(get_image_store().add_file(file_path))
+                except ValueError as e:
+                    print(e)
             else:
                 print(f"File at path {file_path} does not exist.")
             user_input = read_image_pattern.sub('', user_input)
@@ -228,76 +458,256 @@ def get_input_from_user() -> Message:
     return Message(role="user", content=content_list)
 
 
+@dataclasses.dataclass
+class Rewrite:
+    """
+    A diff merged into a file, before anything is written.
+
+    :param filename: Path relative to the workspace.
+    :param before: The file contents the diff was merged into, None if the file doesn't exist yet.
+    :param after: The new contents, None if the diff couldn't be merged.
+    :param message: What happened, for the tool output.
+    """
+    filename: str
+    before: Optional[str]
+    after: Optional[str]
+    message: str
+
+
 def rewrite_file(workspace: str, filename: str, diff: str, update_logs: Callable | None = None) -> Optional[str]:
     """
-    Its job is to rewrite the file contents based on the cmd.
-    The cmd would be either ADD or REMOVE.
-      - ADD will be used to integrate the new code block into the current file
-      - REMOVE will be used to remove a certain function from the current file
+    Its job is to rewrite the file contents based on the diff.
+
+    The diff is first applied locally by fuzzy matching its hunks against the current file contents. Only the
+    hunks that cannot be placed this way are sent to the llm, which is then asked to regenerate the whole file
+    with those hunks merged in. The returned message reports which of the two paths was taken.
 
     If the filename does not exist or the file is empty, create a new file and add the contents to it directly.
-    If the file has content, then ask the llm to regenerate the whole file with either addition of the code or deletion.
+    The file is replaced atomically, a crash never leaves it half written.
     """
-    FILEPATH = f"{workspace}/{filename}"
+    rewrite = merge_diff(workspace, filename, diff, update_logs)
+    if rewrite.after is not None:
+        atomic_write(os.path.join(workspace, filename), rewrite.after)
+        print_file_diff(rewrite.before or '', rewrite.after)
+    return rewrite.message
 
-    if not os.path.exists(os.path.dirname(FILEPATH)):
-        os.makedirs(os.path.dirname(FILEPATH))
 
-    if not os.path.exists(FILEPATH):
-        with open(FILEPATH, "w") as f:
-            pass
+def rewrite_files(workspace: str, edits: list[tuple[str, str]], update_logs: Callable | None = None) -> str:
+    """
+    Applies diffs to several files as one transaction: the diffs are merged concurrently, and only if every one of
+    them could be merged are the files written, all at once (see `FileTransaction`).
 
-    # get the contents of the file
+    :param workspace: Directory the filenames are relative to.
+    :param edits: (filename, diff) pairs, one per file.
+    :param update_logs: Optional callback to surface the rewriter input and output.
+    :return: A report of what changed in each file with the combined diff, or why nothing was written.
+    """
+    filenames = [os.path.normpath(filename) for filename, _ in edits]
+    duplicates = sorted({filename for filename in filenames if filenames.count(filename) > 1})
+    if duplicates:
+        return f"Error: nothing was written, {', '.join(duplicates)} is edited more than once. Put all the changes to a file in one diff."
+
+    with get_tracer().span('rewrite_files', files=len(edits)) as span:
+        with ThreadPoolExecutor(max_workers=min(len(edits), MAX_PARALLEL_EDITS) or 1, thread_name_prefix='edit') as pool:
+            futures = [pool.submit(contextvars.copy_context().run, merge_diff, workspace, filename, diff, update_logs) for filename, diff in edits]
+            rewrites = [future.result() for future in futures]
+
+        failed = [rewrite for rewrite in rewrites if rewrite.after is None]
+        if failed:
+            span.status = 'error'
+            return "Error: nothing was written, these edits could not be applied:\n" + '\n'.join(f"- {rewrite.filename}: {rewrite.message}" for rewrite in failed)
+
+        try:
+            # aborted on any exception, the ones not caught here included
+            with FileTransaction(workspace) as transaction:
+                for rewrite in rewrites:
+                    transaction.stage(rewrite.filename, rewrite.after, rewrite.before)
+                transaction.commit()
+        except (OSError, ValueError) as e:  # e.g. a full disk, or contents the file encoding can't hold
+            span.status = 'error'
+            return f"Error: nothing was written, {e}"
+
+    report = format_edit_report(rewrites)
+    print(report)
+    if update_logs: update_logs(MessageToPrint('File Rewriter', report, "light_sky_blue3"))
+    return report
+
+
+def format_edit_report(rewrites: list[Rewrite]) -> str:
+    """One line per file, then the combined unified diff (cut at MAX_REPORT_DIFF_LINES)."""
+    lines = [f"Updated {len(rewrites)} file(s) together:"]
+    diff_lines: list[str] = []
+    for rewrite in rewrites:
+        file_diff = list(difflib.unified_diff(
+            (rewrite.before or '').splitlines(), rewrite.after.splitlines(),
+            fromfile=f"a/{rewrite.filename}" if rewrite.before is not None else '/dev/null', tofile=f"b/{rewrite.filename}", lineterm='',
+        ))
+        added = sum(1 for line in file_diff if line.startswith('+') and not line.startswith('+++'))
+        removed = sum(1 for line in file_diff if line.startswith('-') and not line.startswith('---'))
+        lines.append(f"- {rewrite.message} (+{added} -{removed})")
+        diff_lines.extend(file_diff)
+    if len(diff_lines) > MAX_REPORT_DIFF_LINES:
+        diff_lines = diff_lines[:MAX_REPORT_DIFF_LINES] + [f"... {len(diff_lines) - MAX_REPORT_DIFF_LINES} more diff lines not shown"]
+    return '\n'.join(lines) + "\n\n```diff\n" + '\n'.join(diff_lines) + "\n```"
+
+
+def merge_diff(workspace: str, filename: str, diff: str, update_logs: Callable | None = None) -> Rewrite:
+    """Merges the diff into the file's current contents (locally, else through the llm rewriter) without writing it."""
+    with get_tracer().span('rewrite_file', filename=filename, diff_chars=len(diff)) as span:
+        path = os.path.join(workspace, filename)
+        before = None
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                before = f.read()
+        init_file_contents = before or ''
+
+        hunks = parse_diff(diff)
+        patched_contents, failed_hunks, applied = apply_hunks(init_file_contents, hunks)
+        span.set(hunks=len(hunks), applied_locally=applied, failed_locally=len(failed_hunks))
+        local_rejection = None
+        if hunks and not failed_hunks:
+            # placing hunks by fuzzy matching can still go wrong (e.g. a misjudged indentation), check it like a rewrite
+            local_rejection = validate_rewrite(filename, init_file_contents, patched_contents, diff)
+            if local_rejection is None:
+                span.set(path='local')
+                out = f"{filename} was successfully updated (applied {applied} hunk(s) locally)"
+                if update_logs: update_logs(MessageToPrint('File Rewriter', out, "light_sky_blue3"))
+                return Rewrite(filename, before, patched_contents, out)
+            print(f"\033[91mLocal patch rejected: {local_rejection}\033[0m")
+            span.set(local_rejection=local_rejection)
+            patched_contents, applied = init_file_contents, 0
+
+        # whatever could not be placed locally goes to the llm, on top of the partially patched file
+        remaining_diff = '\n\n'.join(str(hunk) for hunk in failed_hunks) if hunks and local_rejection is None else diff
+        span.set(path='llm')
+        new_code, rejections = llm_rewrite(patched_contents, remaining_diff, update_logs, filename)
+        if new_code is None:
+            span.status = 'error'
+            if rejections:
+                return Rewrite(filename, before, None, "Error: was unable to modify the contents, the rewrites were rejected: " + '; '.join(rejections))
+            return Rewrite(filename, before, None, "Error: was unable to modify the contents")
+
+        if applied:
+            return Rewrite(filename, before, new_code, f"{filename} was successfully updated ({applied} hunk(s) applied locally, {len(failed_hunks)} via LLM rewriter)")
+        return Rewrite(filename, before, new_code, f"{filename} was successfully updated (via LLM rewriter)")
+
+
+def llm_rewrite(file_contents: str, diff: str, update_logs: Callable | None = None, filename: str | None = None, candidates: int = REWRITE_CANDIDATES) -> tuple[Optional[str], list[str]]:
+    """
+    Asks the llm to regenerate the whole file with the diff merged in.
+
+    Several candidates are requested concurrently and checked with `validate_rewrite` as they complete; the first
+    valid one is returned and the requests still running are abandoned, so a successful rewrite takes as long as the
+    fastest valid candidate instead of one round trip per bad answer.
+
+    :param file_contents: The current file contents.
+    :param diff: The diff that has to be merged into the file.
+    :param update_logs: Optional callback to surface the rewriter input and output.
+    :param filename: Path of the file, used to pick the syntax check.
+    :param candidates: How many rewrites to request.
+    :return: The updated file contents (None if no candidate was valid), and why the rejected candidates were rejected.
+    """
     with open("prompts/file_rewriter.txt", "r") as f:
         sys_prompt = f.read()
     history = [
         Message("system", sys_prompt),
     ]
 
-    with open(FILEPATH, "r") as f:
-        init_file_contents = f.read()
-    user_msg = f"CURRENT_FILE_CONTENTS:\n```\n{init_file_contents.strip()}\n```\n\n"
+    user_msg = f"CURRENT_FILE_CONTENTS:\n```\n{file_contents.strip()}\n```\n\n"
     user_msg += f"DIFF:\n```diff\n{diff.strip()}\n```\n\n"
 
     history.append(Message("user", user_msg))
     print("\033[92m" + str(history[-1]) + "\033[0m")
     if update_logs: update_logs(MessageToPrint('File Rewriter Input', str(history[-1]), "light_salmon3"))
 
-    code_ptrn = re.compile(
-        r"<\|UPDATED_FILE_START\|>(.*?)<\|UPDATED_FILE_END\|>", re.DOTALL
+    rejections: list[str] = []
+    stop = threading.Event()
+    with get_tracer().span('llm_rewrite', file_chars=len(file_contents), diff_chars=len(diff), candidates=candidates) as span:
+        # the candidates share one request, so they bypass the response cache and only the accepted one is recorded;
+        # recording each of them would let a rejected one overwrite it and come back on every retry or replay
+        cache_key = _cache_key('openai', REWRITE_MODEL, prepare_messages(history, 'openai'), REWRITE_TEMPERATURE, None, 4096)
+        if cache_key is not None:
+            cached = get_cache().get(cache_key)
+            if cached is not None:
+                new_code, reason = _check_rewrite(filename, file_contents, cached, diff)
+                if reason is None:
+                    span.set(cache='hit', rejected=0)
+                    return new_code, rejections
+                rejections.append(f"cached rewrite: {reason}")
+                if get_cache().mode == 'replay':
+                    span.status = 'error'
+                    return None, rejections
+
+        futures = [_rewrite_pool.submit(contextvars.copy_context().run, _rewrite_candidate, history, stop) for _ in range(candidates)]
+        try:
+            for future in as_completed(futures):
+                try:
+                    llm_res = future.result()
+                except Exception as e:
+                    rejections.append(f"request failed: {e}")
+                    continue
+                if llm_res is None:
+                    continue  # abandoned
+                print("\033[94m" + f"Assistant:{llm_res}" + "\033[0m")
+                if update_logs: update_logs(MessageToPrint('File Rewriter Output', llm_res, "light_sky_blue3"))
+                new_code, reason = _check_rewrite(filename, file_contents, llm_res, diff)
+                if reason is None:
+                    if cache_key is not None: get_cache().put(cache_key, llm_res)
+                    span.set(rejected=len(rejections))
+                    return new_code, rejections
+                print(f"\033[91mRewrite rejected: {reason}\033[0m")
+                rejections.append(reason)
+        finally:
+            stop.set()
+            for future in futures:
+                future.cancel()
+        span.set(rejected=len(rejections))
+        span.status = 'error'
+    return None, rejections
+
+
+def _rewrite_candidate(history: list[Message], stop: threading.Event) -> Optional[str]:
+    """One rewrite request, streamed so it can be dropped (closing its connection) once another one was accepted."""
+    llm_res = ''
+    stream = llm_stream(REWRITE_MODEL, history, temperature=REWRITE_TEMPERATURE, response_cache=False)
+    try:
+        for delta in stream:
+            if stop.is_set():
+                return None
+            llm_res += delta
+    finally:
+        stream.close()
+    return llm_res
+
+
+def _check_rewrite(filename: str | None, file_contents: str, llm_res: str, diff: str) -> tuple[Optional[str], Optional[str]]:
+    """The file a rewrite response contains, and why it is rejected (None if it is valid)."""
+    new_code = _extract_updated_file(llm_res)
+    if new_code is None:
+        return None, "no <|UPDATED_FILE_START|> block in the response"
+    return new_code, validate_rewrite(filename, file_contents, new_code, diff)
+
+
+def _extract_updated_file(llm_res: str) -> Optional[str]:
+    matches = list(re.finditer(r"<\|UPDATED_FILE_START\|>(.*?)<\|UPDATED_FILE_END\|>", llm_res, re.DOTALL))
+    if not matches:
+        return None
+    # Get the longest match
+    longest_match = max(matches, key=lambda match: len(match.group(0)))
+    new_code = longest_match.group(1).strip()
+    if new_code.startswith('```'): new_code = '\n'.join(new_code.split('\n')[1:])
+    if new_code.endswith('```'): new_code = '\n'.join(new_code.split('\n')[:-1])
+    return new_code
+
+
+def print_file_diff(before: str, after: str) -> None:
+    diff = difflib.unified_diff(
+        before.splitlines(),
+        after.splitlines(),
+        fromfile="before",
+        tofile="after",
     )
-    max_retries = 3
-    while max_retries > 0:
-        max_retries -= 1
-        llm_res = llm_call("gpt-4o-mini", history, temperature=0.8)
-        print("\033[94m" + f"Assistant:{llm_res}" + "\033[0m")
-        if update_logs: update_logs(MessageToPrint('File Rewriter Output', llm_res, "light_sky_blue3"))
-        matches = list(re.finditer(code_ptrn, llm_res))
-
-        if matches:
-            # Get the longest match
-            longest_match = max(matches, key=lambda match: len(match.group(0)))
-            new_code = longest_match.group(1).strip()
-            if new_code.startswith('```'): new_code = '\n'.join(new_code.split('\n')[1:])
-            if new_code.endswith('```'): new_code = '\n'.join(new_code.split('\n')[:-1])
-            
-            with open(FILEPATH, "w") as f:
-                f.write(new_code)
-
-            with open(FILEPATH, 'r') as f:
-                post_file_contents = f.read()
-
-            diff = difflib.unified_diff(
-                init_file_contents.splitlines(),
-                post_file_contents.splitlines(),
-                fromfile="before",
-                tofile="after",
-            )
-            print("\n".join(diff))
-            return f"{filename} was successfully updated"
-
-
-    return "Error: was unable to modify the contents"
+    print("\n".join(diff))
 
 
 # a funciton that will take in messages list and ask llm to summarize the conversation uptill now into 3 main sections: Main Objective, Completed Tasks, In-Progress Tasks
@@ -315,11 +725,11 @@ Keeping this in mind, I need you to summarize the conversation thats given by th
 
 Because the conversation might go on for hours on end, I need you to summarize the conversation such that the older completed tasks take up less context, compared to the most recent ongoing ones.
 
-Also, another important caveat, even with summarized context, the last 2 messages are still sent to the model, because they need to be concrete and detailed. So, when summarizing keep that in mind. You do not have to return those messages, the backend system will append them by itself. You need to just summarize.
+Also, another important caveat, even with summarized context, the most recent messages are still sent to the model verbatim, because they need to be concrete and detailed. They are not part of what you are given. You do not have to return those messages, the backend system will append them by itself. You need to just summarize.
 '''
     history = [
         Message("system", sys_prompt.strip()),
-        Message("user", json.dumps([dataclasses.asdict(x) for x in messages])),
+        Message("user", json.dumps([x.to_dict() for x in messages])),
     ]
 
     max_retries = 3
@@ -332,6 +742,35 @@ Also, another important caveat, even with summarized context, the last 2 message
     return "Error: was unable to summarize the conversation"
 
 
+def summarize_incremental(model: str, previous_summary: str | None, new_messages: list[Message], provider: str = "openai") -> str:
+    """
+    Folds newly evicted messages into the running summary, so only the delta is sent instead of the whole history.
+
+    :param model: The name of the model to call.
+    :param previous_summary: The current running summary, None on the first compaction.
+    :param new_messages: The messages being evicted from the history, with binary payloads already stripped.
+    :return: The updated summary.
+    """
+    sys_prompt = '''
+You are a language model. You maintain a running summary of a conversation between a user and an assistant which is also a LM. The reason to summarize is because of context length limit of the assistant model.
+
+You will be given the current summary (if there is one) and the messages that have just been dropped from the assistant's context. Update the summary so it also covers those messages, and return only the updated summary, organized into 3 main sections: Main Objective, Completed Tasks, In-Progress Tasks. The assistant's system prompt is always sent to it, so you don't need to restate its instructions.
+
+Because the conversation might go on for hours on end, I need you to summarize the conversation such that the older completed tasks take up less context, compared to the most recent ongoing ones.
+
+Also, another important caveat, even with summarized context, the most recent messages are still sent to the model verbatim, because they need to be concrete and detailed. They are not part of what you are given. You do not have to return those messages, the backend system will append them by itself. You need to just summarize.
+'''
+    transcript = "\n\n".join(f"[{x.role}]: {x.content}" for x in new_messages)
+    user_msg = f"CURRENT_SUMMARY:\n{previous_summary or '(none yet)'}\n\nNEW_MESSAGES:\n{transcript}"
+    history = [
+        Message("system", sys_prompt.strip()),
+        Message("user", user_msg),
+    ]
+    llm_res = llm_call(model, history, temperature=0.8, provider=provider, max_tokens=1024)
+    print("\033[94m" + f"Summarization Assistant:{llm_res}" + "\033[0m")
+    return llm_res
+
+
 if __name__ == '__main__':
     # Example usage:
     with open('conversationData.json', 'r') as f:
@@ -1,10 +1,12 @@
 import dataclasses
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Message:
     role: str
     content: str
+    # (content id, content length, token estimate), filled in lazily by context_manager.estimate_tokens
+    token_cache: tuple | None = dataclasses.field(default=None, init=False, repr=False, compare=False)
 
     def __str__(self) -> str:
         return f"[{self.role}]: {self.content}"
@@ -12,7 +14,23 @@ class Message:
     def __repr__(self) -> str:
         return str(self)
 
-@dataclasses.dataclass
+    def to_dict(self) -> dict:
+        return {'role': self.role, 'content': self.content}
+
+
+@dataclasses.dataclass(repr=False, slots=True)
+class FileContents(Message):
+    """
+    A file (or a slice of one) injected into the history by the file_reader tool.
+
+    :param file_key: The path, plus the line range for slices.
+    :param digest: Hash of the injected text, to tell whether a later read changed anything.
+    """
+    file_key: str = ''
+    digest: str = ''
+
+
+@dataclasses.dataclass(slots=True)
 class MessageToPrint:
     title: str
     content: str
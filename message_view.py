@@ -0,0 +1,203 @@
+import bisect
+import dataclasses
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+from images import ImageStore, describe_image, get_image_store
+from message import Message
+
+
+# views kept around, one per conversation (brain, composer, ...) and provider
+MAX_VIEWS = 8
+
+
+def merge_contents(contents: list[Any]) -> Any:
+    """
+    Merges the contents of consecutive same-role messages: text is joined with newlines, and once there is a
+    content list everything becomes list items.
+    """
+    if len(contents) == 1:
+        return contents[0]
+    merged: Any = None
+    pending: list[str] = []
+    for content in contents:
+        if isinstance(content, list):
+            if merged is None:
+                merged = [dict(type='text', text='\n'.join(pending))] if pending else []
+            elif pending:
+                merged.append(dict(type='text', text='\n'.join(pending)))
+            pending = []
+            merged.extend(content)
+        elif merged is None:
+            pending.append(content)
+        else:
+            merged.append(dict(type='text', text=content))
+    return '\n'.join(pending) if merged is None else merged
+
+
+class _Group:
+    """A run of same-role messages merged into one, plus what was derived from it for the provider."""
+    __slots__ = ('start', 'merged', 'images', 'formatted', 'dropped', 'json')
+
+    def __init__(self, start: int, merged: Message):
+        self.start = start
+        self.merged = merged
+        self.images = isinstance(merged.content, list) and any(c['type'] != 'text' for c in merged.content)
+        self.formatted: Optional[Message] = None
+        self.dropped = False
+        self.json: Optional[str] = None
+
+    def format(self, provider: str, dropped: bool, store: ImageStore) -> Message:
+        if self.formatted is not None and (not self.images or self.dropped == dropped):
+            return self.formatted
+        content = self.merged.content
+        if self.images:
+            content = [
+                c if c['type'] == 'text'
+                else {'type': 'text', 'text': describe_image(c) + ' (omitted)'} if dropped
+                else store.materialize(c, provider)
+                for c in content
+            ]
+        if provider == 'together' and isinstance(content, list):
+            if any(c['type'] != 'text' for c in content):
+                raise ValueError("Together doesn't have an image processor")
+            content = ('\n'.join(c['text'].strip() for c in content)).strip()
+        self.formatted = self.merged if content is self.merged.content else Message(self.merged.role, content)
+        self.dropped = dropped
+        return self.formatted
+
+    def to_json(self, dropped: bool) -> str:
+        # images are content addressed, so the reference stands in for the payload
+        if self.json is None:
+            self.json = json.dumps(self.merged.to_dict(), sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return self.json + '#dropped' if self.images and dropped else self.json
+
+
+@dataclasses.dataclass
+class PreparedMessages:
+    """
+    Messages ready to send.
+
+    :param system_msg: The system prompt, only split out for anthropic.
+    :param messages: The merged, provider formatted messages.
+    """
+    system_msg: Optional[str]
+    messages: list[Message]
+    _groups: list[_Group]
+    _dropped: list[bool]
+
+    def message_json(self) -> list[str]:
+        """One JSON string per merged message (system prompt included), cached across calls, for the response cache key."""
+        return [group.to_json(dropped) for group, dropped in zip(self._groups, self._dropped)]
+
+
+class MergedView:
+    """
+    The merged and provider formatted form of one conversation, kept up to date incrementally.
+
+    On every call the history is compared with the one seen last time, by identity of the messages and of their
+    content, and only the merged messages from the first change on are rebuilt (the last unchanged one too, as new
+    messages of the same role merge into it). Formatting and serialization are cached on the merged messages, so a
+    call only pays for what was appended since the previous one.
+
+    :param provider: The provider the messages are formatted for.
+    """
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self._sources: list[tuple[Message, Any]] = []
+        self._groups: list[_Group] = []
+        self._starts: list[int] = []
+        self._lock = threading.Lock()
+        self.reused_groups = 0
+        self.rebuilt_groups = 0
+
+    def matches(self, messages: list[Message]) -> bool:
+        return bool(self._sources) and bool(messages) and self._sources[0][0] is messages[0]
+
+    def prepare(self, messages: list[Message]) -> PreparedMessages:
+        with self._lock:
+            self._update(messages)
+            return self._format()
+
+    def _update(self, messages: list[Message]) -> None:
+        sources = self._sources
+        common = min(len(sources), len(messages))
+        prefix = 0
+        while prefix < common and sources[prefix][0] is messages[prefix] and sources[prefix][1] is messages[prefix].content:
+            prefix += 1
+        if prefix == len(sources) == len(messages):
+            self.reused_groups += len(self._groups)
+            return
+
+        first = bisect.bisect_right(self._starts, prefix - 1) - 1 if prefix else 0
+        start = self._starts[first] if first < len(self._starts) else 0
+        del self._groups[first:], self._starts[first:]
+        self.reused_groups += first
+
+        i = start
+        while i < len(messages):
+            j = i + 1
+            while j < len(messages) and messages[j].role == messages[i].role:
+                j += 1
+            merged = messages[i] if j == i + 1 else Message(messages[i].role, merge_contents([m.content for m in messages[i:j]]))
+            self._groups.append(_Group(i, merged))
+            self._starts.append(i)
+            self.rebuilt_groups += 1
+            i = j
+        self._sources[prefix:] = [(m, m.content) for m in messages[prefix:]]
+
+    def _format(self) -> PreparedMessages:
+        store = get_image_store()
+        keep_turns = store.config.keep_turns
+        groups = list(self._groups)
+        system_msg = None
+        body = groups
+        if self.provider == 'anthropic' and groups and groups[0].merged.role == 'system':
+            system_msg = groups[0].merged.content
+            body = groups[1:]
+
+        formatted = []
+        dropped_flags = []
+        user_turns = 0
+        for group in reversed(body):
+            if group.merged.role == 'user': user_turns += 1
+            dropped = bool(keep_turns) and user_turns > keep_turns
+            formatted.append(group.format(self.provider, dropped, store))
+            dropped_flags.append(dropped)
+        formatted.reverse()
+        dropped_flags.reverse()
+        if len(body) != len(groups):
+            dropped_flags.insert(0, False)
+        return PreparedMessages(system_msg, formatted, groups, dropped_flags)
+
+
+_views: OrderedDict[int, MergedView] = OrderedDict()
+_views_lock = threading.Lock()
+_next_view = 0
+
+
+def prepare_messages(messages: list[Message], provider: str) -> PreparedMessages:
+    """
+    Merges the messages and adapts them to what the provider accepts, reusing the work done for the same
+    conversation on earlier calls.
+
+    :param messages: A list of Message objects containing the conversation history.
+    :param provider: The provider the request is for.
+    """
+    global _next_view
+    with _views_lock:
+        for key, candidate in _views.items():
+            if candidate.provider == provider and candidate.matches(messages):
+                view = candidate
+                _views.move_to_end(key)
+                break
+        else:
+            view = MergedView(provider)
+            _views[_next_view] = view
+            _next_view += 1
+            if len(_views) > MAX_VIEWS:
+                _views.popitem(last=False)
+    return view.prepare(messages)
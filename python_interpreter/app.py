@@ -1,11 +1,84 @@
-from typing import Dict, Any
+import asyncio
+import dataclasses
+import json
+import os
+import queue
+import re
+import tempfile
+import time
+from typing import AsyncIterator, Dict, Any, List, Optional
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from uuid import uuid4
-from jupyter_client import KernelManager
+from jupyter_client import AsyncKernelClient, KernelManager
+
+try:
+  from .kernel_pool import KernelPool, PoolExhausted, kernel_memory
+except ImportError:  # started from inside python_interpreter/ (uvicorn app:app)
+  from kernel_pool import KernelPool, PoolExhausted, kernel_memory
 
 app = FastAPI()
-sessions: Dict[str, KernelManager] = {}
+pool = KernelPool(
+  min_ready=int(os.environ.get('KERNEL_POOL_MIN_READY', 2)),
+  max_kernels=int(os.environ.get('KERNEL_POOL_MAX_KERNELS', 16)),
+)
+# sessions not used for this many seconds get their kernel shut down
+SESSION_IDLE_TTL = float(os.environ.get('SESSION_IDLE_TTL', 1800))
+# how long to wait for the kernel to go idle after interrupting a timed out execution
+INTERRUPT_GRACE = 5.0
+ANSI_PTRN = re.compile(r'\x1b\[[0-9;]*m')
+# where session snapshots are written, kernels run on this host so they share the filesystem with us
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'python_interpreter_snapshots'))
+# run inside the kernel, dill pickles the whole interactive namespace (dump_session on dill < 0.3.6)
+SNAPSHOT_CODE = """import dill as _dill
+(_dill.dump_module if hasattr(_dill, 'dump_module') else _dill.dump_session)({path!r})
+del _dill"""
+RESTORE_CODE = """import dill as _dill
+(_dill.load_module if hasattr(_dill, 'load_module') else _dill.load_session)({path!r})
+del _dill"""
+
+
+@dataclasses.dataclass
+class Session:
+  """
+  A kernel handed out to a client, along with the one client (and zmq channels) used for all its executions.
+
+  Only one execution runs at a time per session, `lock` queues the others.
+  """
+  km: KernelManager
+  last_used: float
+  # snapshot this session was forked from
+  parent: Optional[str] = None
+  client: Optional[AsyncKernelClient] = None
+  lock: asyncio.Lock = dataclasses.field(default_factory=asyncio.Lock)
+
+  def get_client(self) -> AsyncKernelClient:
+    if self.client is None:
+      self.client = AsyncKernelClient()
+      self.client.load_connection_info(self.km.get_connection_info())
+      self.client.start_channels()
+    return self.client
+
+  def close_client(self) -> None:
+    if self.client is not None:
+      self.client.stop_channels()
+      self.client = None
+
+
+@dataclasses.dataclass
+class Snapshot:
+  path: str
+  session_id: str
+  created: float
+  size: int
+
+
+# only touched from the event loop, blocking kernel work goes through asyncio.to_thread
+sessions: Dict[str, Session] = {}
+snapshots: Dict[str, Snapshot] = {}
+reaped_sessions = 0
+reaper_task: Optional[asyncio.Task] = None
 
 
 class CreateSessionResponse(BaseModel):  # type: ignore
@@ -15,44 +88,366 @@ class CreateSessionResponse(BaseModel):  # type: ignore
 class ExecuteCodeRequest(BaseModel):  # type: ignore
   code: str
   session_id: str
+  # seconds after which the execution is interrupted, None to let it run
+  timeout: Optional[float] = None
+
+
+class InterruptRequest(BaseModel):  # type: ignore
+  session_id: str
+
+
+class ExecuteBatchRequest(BaseModel):  # type: ignore
+  session_id: str
+  cells: List[str]
+  # skip the remaining cells once one raises (or times out)
+  stop_on_error: bool = True
+  # per cell, same as ExecuteCodeRequest.timeout
+  timeout: Optional[float] = None
+
+
+class CellResult(BaseModel):  # type: ignore
+  index: int
+  status: str  # ok, error, timeout or skipped
+  output: str = ''
+  error: Optional[Dict[str, str]] = None
+  duration: float = 0.0
+
+
+class ExecuteBatchResponse(BaseModel):  # type: ignore
+  results: List[CellResult]
+  duration: float
+
+
+class SnapshotRequest(BaseModel):  # type: ignore
+  session_id: str
+
+
+class SnapshotResponse(BaseModel):  # type: ignore
+  snapshot_id: str
+  size: int
+
+
+class DeleteSnapshotRequest(BaseModel):  # type: ignore
+  snapshot_id: str
+
+
+class ForkRequest(BaseModel):  # type: ignore
+  # fork from an existing snapshot, or snapshot `session_id` first
+  snapshot_id: Optional[str] = None
+  session_id: Optional[str] = None
+  count: int = 1
+
+
+class ForkResponse(BaseModel):  # type: ignore
+  snapshot_id: str
+  session_ids: List[str]
+  # per child session, see kernel_pool.kernel_memory
+  memory: Dict[str, Optional[Dict[str, int]]]
+
+
+async def reap_idle_sessions() -> int:
+  global reaped_sessions
+  cutoff = time.time() - SESSION_IDLE_TTL
+  expired = [session_id for session_id, session in sessions.items() if session.last_used < cutoff and not session.lock.locked()]
+  reaped = 0
+  for session_id in expired:
+    # releasing the previous ones awaited, a request may have checked this one out meanwhile: check again right
+    # before taking it out of `sessions` (no await in between)
+    session = sessions.get(session_id)
+    if session is None or session.last_used >= cutoff or session.lock.locked():
+      continue
+    await release_session(session_id)
+    reaped += 1
+  reaped_sessions += reaped
+  return reaped
+
+
+async def reaper_loop() -> None:
+  while True:
+    await asyncio.sleep(min(60.0, SESSION_IDLE_TTL / 4))
+    try:
+      await reap_idle_sessions()
+    except Exception as e:
+      print(f"Failed to reap idle sessions: {e}")
+
+
+@app.on_event("startup")  # type: ignore
+async def startup_event() -> None:
+  global reaper_task
+  pool.replenish()
+  reaper_task = asyncio.create_task(reaper_loop())
+
+
+async def acquire_kernel() -> KernelManager:
+  try:
+    return await asyncio.to_thread(pool.acquire)
+  except PoolExhausted:
+    # make room before turning the request away
+    if not await reap_idle_sessions():
+      raise HTTPException(status_code=503, detail="No kernel available, try again later")
+    return await asyncio.to_thread(pool.acquire)
+
+
+async def release_session(session_id: str) -> None:
+  session = sessions.pop(session_id)
+  session.close_client()
+  await asyncio.to_thread(pool.release, session.km)
 
 
 @app.post("/create_session", response_model=CreateSessionResponse)  # type: ignore
-def create_session() -> CreateSessionResponse:
+async def create_session() -> CreateSessionResponse:
   session_id = str(uuid4())
-  km = KernelManager()
-  km.start_kernel()
-  sessions[session_id] = km
+  km = await acquire_kernel()
+  sessions[session_id] = Session(km, time.time())
   return CreateSessionResponse(session_id=session_id)
 
 
-@app.post("/execute_code")  # type: ignore
-def execute_code(request: ExecuteCodeRequest) -> Any:
-  session_id = request.session_id
-  code = request.code
-  if session_id not in sessions:
+def get_session(session_id: str) -> Session:
+  session = sessions.get(session_id)
+  if session is None:
     raise HTTPException(status_code=404, detail="Session not found")
-  km = sessions[session_id]
-  client = km.client()
-  msg_id = client.execute(code, timeout=None)
-  result = ''
-  while True:
-    reply = client.get_iopub_msg(timeout=None)
-    if reply['msg_type'] == 'status' and reply['content']['execution_state'] == 'idle':
-      break
-    elif reply['msg_type'] == 'execute_result':
-      result = reply['content']
-    elif reply['msg_type'] == 'stream':
-      result = reply['content'].get('name', '')
-      if 'text' in reply['content']:
-        result = reply['content']['text']
+  # checking a session out counts as using it, so the reaper leaves it alone until the request has started running
+  session.last_used = time.time()
+  return session
+
+
+def to_event(msg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+  """Turns an iopub message into the event sent to the client, None for the ones we don't forward."""
+  msg_type = msg['msg_type']
+  content = msg['content']
+  if msg_type == 'stream':
+    return dict(type='stream', name=content.get('name', 'stdout'), text=content.get('text', ''))
+  if msg_type in ('execute_result', 'display_data'):
+    data = content.get('data', {})
+    event = dict(type='result' if msg_type == 'execute_result' else 'display', text=data.get('text/plain', ''))
+    if 'image/png' in data:
+      event['image/png'] = data['image/png']
+    return event
+  if msg_type == 'error':
+    traceback = ANSI_PTRN.sub('', '\n'.join(content.get('traceback', [])))
+    return dict(type='error', ename=content.get('ename', ''), evalue=content.get('evalue', ''), traceback=traceback)
+  return None
+
+
+async def run_code(session: Session, code: str, timeout: Optional[float]) -> AsyncIterator[Dict[str, Any]]:
+  """
+  Executes code in the session's kernel and yields its outputs as they arrive, ending with a `done` event.
+
+  On timeout the kernel is interrupted, a `timeout` event is sent, and we wait (briefly) for the kernel to settle.
+  """
+  async with session.lock:
+    async for event in run_locked(session, code, timeout):
+      yield event
+
+
+async def run_locked(session: Session, code: str, timeout: Optional[float]) -> AsyncIterator[Dict[str, Any]]:
+  """`run_code` for a caller already holding `session.lock`."""
+  session.last_used = time.time()
+  client = session.get_client()
+  msg_id = client.execute(code)
+  deadline = time.monotonic() + timeout if timeout is not None else None
+  timed_out = False
+  try:
+    while True:
+      remaining = None if deadline is None else deadline - time.monotonic()
+      try:
+        if remaining is not None and remaining <= 0:
+          raise queue.Empty
+        msg = await client.get_iopub_msg(timeout=remaining)
+      except queue.Empty:
+        if timed_out:
+          break  # didn't settle within the grace period either
+        timed_out = True
+        await asyncio.to_thread(session.km.interrupt_kernel)
+        yield dict(type='timeout', timeout=timeout)
+        deadline = time.monotonic() + INTERRUPT_GRACE
+        continue
+      if msg['parent_header'].get('msg_id') != msg_id:
+        continue  # left over from an earlier execution that was abandoned
+      if msg['msg_type'] == 'status' and msg['content']['execution_state'] == 'idle':
+        break
+      event = to_event(msg)
+      if event is not None:
+        yield event
+  finally:
+    session.last_used = time.time()
+  yield dict(type='done', timed_out=timed_out)
+
+
+def aggregate(events: List[Dict[str, Any]]) -> str:
+  """Collects every output of an execution into one string, stream chunks are concatenated as they came."""
+  out = ''
+  for event in events:
+    if event['type'] == 'stream':
+      out += event['text']
+      continue
+    if event['type'] in ('result', 'display'):
+      text = event['text']
+    elif event['type'] == 'error':
+      text = event['traceback'] or f"{event['ename']}: {event['evalue']}"
+    elif event['type'] == 'timeout':
+      text = f"Execution timed out after {event['timeout']} seconds and was interrupted."
+    else:
+      continue
+    if out and not out.endswith('\n'):
+      out += '\n'
+    out += text + '\n'
+  return out.rstrip('\n')
+
+
+@app.post("/execute_code")  # type: ignore
+async def execute_code(request: ExecuteCodeRequest) -> Any:
+  session = get_session(request.session_id)
+  events = [event async for event in run_code(session, request.code, request.timeout)]
+  return aggregate(events)
+
+
+@app.post("/execute_code/stream")  # type: ignore
+async def execute_code_stream(request: ExecuteCodeRequest) -> StreamingResponse:
+  """Same as /execute_code, but the outputs are sent as server-sent events while the code runs."""
+  session = get_session(request.session_id)
+
+  async def events() -> AsyncIterator[str]:
+    async for event in run_code(session, request.code, request.timeout):
+      yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+  return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/execute_batch", response_model=ExecuteBatchResponse)  # type: ignore
+async def execute_batch(request: ExecuteBatchRequest) -> ExecuteBatchResponse:
+  """
+  Runs the cells back to back in one request, without another execution on the session getting in between.
+
+  Each cell gets its own result, cells after a failing one are marked skipped when `stop_on_error` is set.
+  """
+  session = get_session(request.session_id)
+  results: List[CellResult] = []
+  started = time.perf_counter()
+  async with session.lock:
+    failed = False
+    for index, code in enumerate(request.cells):
+      if failed and request.stop_on_error:
+        results.append(CellResult(index=index, status='skipped'))
+        continue
+      cell_started = time.perf_counter()
+      events = [event async for event in run_locked(session, code, request.timeout)]
+      error = next((event for event in events if event['type'] == 'error'), None)
+      if events[-1]['timed_out']:
+        status = 'timeout'
+      else:
+        status = 'error' if error is not None else 'ok'
+      failed = status != 'ok'
+      results.append(CellResult(
+        index=index,
+        status=status,
+        output=aggregate(events),
+        error={key: error[key] for key in ('ename', 'evalue', 'traceback')} if error is not None else None,
+        duration=time.perf_counter() - cell_started,
+      ))
+  return ExecuteBatchResponse(results=results, duration=time.perf_counter() - started)
+
+
+@app.post("/snapshot", response_model=SnapshotResponse)  # type: ignore
+async def snapshot(request: SnapshotRequest) -> SnapshotResponse:
+  """Saves the session's namespace (variables, functions, imported modules) so sessions can be forked from it."""
+  session = get_session(request.session_id)
+  snapshot_id = str(uuid4())
+  os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+  path = os.path.join(SNAPSHOT_DIR, f'{snapshot_id}.pkl')
+  events = [event async for event in run_code(session, SNAPSHOT_CODE.format(path=path), None)]
+  if any(event['type'] == 'error' for event in events) or not os.path.exists(path):
+    raise HTTPException(status_code=400, detail=f"Snapshot failed: {aggregate(events)}")
+  size = os.path.getsize(path)
+  snapshots[snapshot_id] = Snapshot(path, request.session_id, time.time(), size)
+  return SnapshotResponse(snapshot_id=snapshot_id, size=size)
+
+
+@app.post("/fork", response_model=ForkResponse)  # type: ignore
+async def fork(request: ForkRequest) -> ForkResponse:
+  """
+  Starts `count` new sessions with the namespace of a snapshot, restored in parallel.
+
+  Children come from the pre-started pool, so a fork costs about one unpickle instead of re-running the setup cells.
+  Only the namespace is carried over: open files, sockets and threads of the parent are not.
+  """
+  if request.snapshot_id is None:
+    if request.session_id is None:
+      raise HTTPException(status_code=400, detail="Either snapshot_id or session_id is required")
+    snapshot_id = (await snapshot(SnapshotRequest(session_id=request.session_id))).snapshot_id
+  else:
+    snapshot_id = request.snapshot_id
+  if snapshot_id not in snapshots:
+    raise HTTPException(status_code=404, detail="Snapshot not found")
+  if request.count < 1:
+    raise HTTPException(status_code=400, detail="count must be at least 1")
+
+  children: List[str] = []
+  try:
+    for _ in range(request.count):
+      session_id = str(uuid4())
+      sessions[session_id] = Session(await acquire_kernel(), time.time(), parent=snapshot_id)
+      children.append(session_id)
+
+    async def restore(session_id: str) -> List[Dict[str, Any]]:
+      code = RESTORE_CODE.format(path=snapshots[snapshot_id].path)
+      return [event async for event in run_code(sessions[session_id], code, None)]
+
+    for events in await asyncio.gather(*(restore(session_id) for session_id in children)):
+      if any(event['type'] == 'error' for event in events):
+        raise HTTPException(status_code=500, detail=f"Restoring the snapshot failed: {aggregate(events)}")
+  except BaseException:
+    for session_id in children:
+      await release_session(session_id)
+    raise
+
+  memory = {session_id: await asyncio.to_thread(kernel_memory, sessions[session_id].km) for session_id in children}
+  return ForkResponse(snapshot_id=snapshot_id, session_ids=children, memory=memory)
+
+
+@app.post("/delete_snapshot")  # type: ignore
+async def delete_snapshot(request: DeleteSnapshotRequest) -> Dict[str, bool]:
+  snapshot = snapshots.pop(request.snapshot_id, None)
+  if snapshot is None:
+    raise HTTPException(status_code=404, detail="Snapshot not found")
+  os.remove(snapshot.path)
+  return dict(deleted=True)
+
+
+@app.post("/interrupt")  # type: ignore
+async def interrupt(request: InterruptRequest) -> Dict[str, bool]:
+  session = get_session(request.session_id)
+  await asyncio.to_thread(session.km.interrupt_kernel)
+  return dict(interrupted=session.lock.locked())
+
 
-  if isinstance(result, dict) and 'data' in result and 'text/plain' in result['data']:
-    return result['data']['text/plain']
-  return result
+@app.get("/metrics")  # type: ignore
+async def metrics() -> Dict[str, Any]:
+  busy = sum(1 for session in sessions.values() if session.lock.locked())
+  memory = {}
+  for session_id, session in list(sessions.items()):
+    memory[session_id] = dict(parent=session.parent, memory=await asyncio.to_thread(kernel_memory, session.km))
+  return dict(
+    sessions=len(sessions),
+    busy_sessions=busy,
+    reaped_sessions=reaped_sessions,
+    pool=pool.stats(),
+    snapshots=len(snapshots),
+    snapshot_bytes=sum(snapshot.size for snapshot in snapshots.values()),
+    session_memory=memory,
+  )
 
 
 @app.on_event("shutdown")  # type: ignore
-def shutdown_event() -> None:
-  for session_id, km in sessions.items():
-    km.shutdown_kernel()
+async def shutdown_event() -> None:
+  if reaper_task is not None:
+    reaper_task.cancel()
+  for session in sessions.values():
+    session.close_client()
+    await asyncio.to_thread(session.km.shutdown_kernel)
+  sessions.clear()
+  for snapshot in snapshots.values():
+    if os.path.exists(snapshot.path):
+      os.remove(snapshot.path)
+  snapshots.clear()
+  pool.close()
@@ -0,0 +1,191 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional
+
+from jupyter_client import KernelManager
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+
+class PoolExhausted(Exception):
+  pass
+
+
+def percentile(values: List[float], pct: float) -> float:
+  if not values:
+    return 0.0
+  ordered = sorted(values)
+  index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+  return ordered[index]
+
+
+def kernel_pid(km: KernelManager) -> Optional[int]:
+  provisioner = getattr(km, 'provisioner', None)
+  pid = getattr(provisioner, 'pid', None)
+  if pid is None and getattr(km, 'kernel', None) is not None:
+    pid = getattr(km.kernel, 'pid', None)  # jupyter_client < 7
+  return pid
+
+
+def kernel_memory(km: KernelManager) -> Optional[Dict[str, int]]:
+  """
+  Memory used by the kernel process, in bytes.
+
+  `rss` counts pages shared with other processes as well, `uss` (only with psutil) is what shutting the kernel down
+  would give back.
+  """
+  pid = kernel_pid(km)
+  if pid is None:
+    return None
+  try:
+    if psutil is not None:
+      info = psutil.Process(pid).memory_full_info()
+      return dict(rss=info.rss, uss=info.uss)
+    with open(f'/proc/{pid}/status') as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return dict(rss=int(line.split()[1]) * 1024)
+  except Exception:  # process gone, or no access
+    return None
+  return None
+
+
+class KernelPool:
+  """
+  Keeps `min_ready` kernels started and idle, so creating a session doesn't pay the kernel boot in the request path.
+
+  Kernels handed out are never returned to the pool (their state is dirty), `release` shuts them down and the pool is
+  topped up again in the background.
+
+  :param min_ready: How many idle kernels to keep pre-started.
+  :param max_kernels: Cap on live kernels, idle and handed out together.
+  :param ready_timeout: Seconds to wait for a new kernel to answer before giving up on it.
+  """
+
+  def __init__(self, min_ready: int = 2, max_kernels: int = 16, ready_timeout: float = 60):
+    self.min_ready = min_ready
+    self.max_kernels = max_kernels
+    self.ready_timeout = ready_timeout
+    self._ready: Deque[KernelManager] = deque()
+    self._starting = 0
+    self._in_use = 0
+    self._lock = threading.Lock()
+    self._executor = ThreadPoolExecutor(max_workers=max(1, min_ready), thread_name_prefix='kernel_pool')
+    self._closed = False
+
+    self.hits = 0
+    self.misses = 0
+    self.start_failures = 0
+    # seconds spent in `acquire`, last 1000 calls
+    self.acquire_latencies: Deque[float] = deque(maxlen=1000)
+
+  def _start_kernel(self) -> KernelManager:
+    km = KernelManager()
+    km.start_kernel()
+    client = km.client()
+    client.start_channels()
+    try:
+      client.wait_for_ready(timeout=self.ready_timeout)
+    except Exception:
+      km.shutdown_kernel(now=True)
+      raise
+    finally:
+      client.stop_channels()
+    return km
+
+  def _warm_one(self) -> None:
+    try:
+      km = self._start_kernel()
+    except Exception as e:
+      print(f"Failed to pre-start kernel: {e}")
+      with self._lock:
+        self._starting -= 1
+        self.start_failures += 1
+      return
+    with self._lock:
+      self._starting -= 1
+      if not self._closed:
+        self._ready.append(km)
+        return
+    km.shutdown_kernel(now=True)
+
+  def replenish(self) -> None:
+    """Starts kernels in the background until `min_ready` are idle or starting, within `max_kernels`."""
+    with self._lock:
+      if self._closed:
+        return
+      missing = self.min_ready - len(self._ready) - self._starting
+      room = self.max_kernels - len(self._ready) - self._starting - self._in_use
+      for _ in range(max(0, min(missing, room))):
+        self._starting += 1
+        self._executor.submit(self._warm_one)
+
+  def acquire(self) -> KernelManager:
+    """
+    Hands out a ready kernel, or starts one in line if none is idle.
+
+    :raises PoolExhausted: If `max_kernels` kernels are already live.
+    """
+    started = time.perf_counter()
+    with self._lock:
+      if self._ready:
+        km = self._ready.popleft()
+        self.hits += 1
+      else:
+        if len(self._ready) + self._starting + self._in_use >= self.max_kernels:
+          raise PoolExhausted(f"All {self.max_kernels} kernels are in use")
+        km = None
+        self.misses += 1
+      self._in_use += 1
+    try:
+      if km is None:
+        km = self._start_kernel()
+    except Exception:
+      with self._lock:
+        self._in_use -= 1
+      raise
+    finally:
+      self.replenish()
+    with self._lock:
+      self.acquire_latencies.append(time.perf_counter() - started)
+    return km
+
+  def release(self, km: KernelManager) -> None:
+    """Shuts down a kernel handed out by `acquire`."""
+    try:
+      km.shutdown_kernel(now=True)
+    finally:
+      with self._lock:
+        self._in_use -= 1
+      self.replenish()
+
+  def stats(self) -> Dict[str, float]:
+    with self._lock:
+      latencies = list(self.acquire_latencies)
+      total = self.hits + self.misses
+      return dict(
+        ready=len(self._ready),
+        starting=self._starting,
+        in_use=self._in_use,
+        hits=self.hits,
+        misses=self.misses,
+        hit_rate=self.hits / total if total else 0.0,
+        start_failures=self.start_failures,
+        create_latency_p50=percentile(latencies, 50),
+        create_latency_p90=percentile(latencies, 90),
+        create_latency_p99=percentile(latencies, 99),
+      )
+
+  def close(self) -> None:
+    with self._lock:
+      self._closed = True
+      ready = list(self._ready)
+      self._ready.clear()
+    for km in ready:
+      km.shutdown_kernel(now=True)
+    self._executor.shutdown(wait=False, cancel_futures=True)
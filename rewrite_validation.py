@@ -0,0 +1,63 @@
+import ast
+import difflib
+import os
+from typing import List, Optional
+
+from diff_applier import parse_diff
+
+
+# a rewrite may drop this many lines more than the diff removes (fraction of the file, with a floor for small files)
+LOST_LINES_SLACK = 0.1
+MIN_LOST_LINES_SLACK = 10
+
+
+def requested_net_removal(diff: str) -> int:
+    """How many lines the diff removes overall (removed minus added), 0 if it grows the file."""
+    removed = added = 0
+    for hunk in parse_diff(diff):
+        for op, _ in hunk.lines:
+            if op == '-': removed += 1
+            elif op == '+': added += 1
+    return max(0, removed - added)
+
+
+def lost_lines(before: List[str], after: List[str]) -> int:
+    """Lines of `before` that are gone from `after` without a replacement, e.g. a truncated or elided section."""
+    matcher = difflib.SequenceMatcher(None, before, after, autojunk=False)
+    return sum(max(0, (i2 - i1) - (j2 - j1)) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag in ('delete', 'replace'))
+
+
+def validate_rewrite(filename: Optional[str], before: str, after: str, diff: str) -> Optional[str]:
+    """
+    Checks a file rewritten by the llm before it is written.
+
+    - Python files have to parse, unless the file didn't parse before the rewrite either.
+    - The rewrite must not drop much more than the diff asked for: models asked to return a whole file sometimes
+      elide parts of it ("rest of the file unchanged") or stop early.
+
+    :param filename: Path of the file, its extension decides the syntax check.
+    :param before: The file contents the diff was applied to.
+    :param after: The rewritten contents.
+    :param diff: The diff the llm was asked to merge.
+    :return: Why the rewrite was rejected, None if it looks fine.
+    """
+    if not after.strip() and before.strip():
+        return "the rewritten file is empty"
+
+    if filename is not None and os.path.splitext(filename)[1] in ('.py', '.pyi'):
+        try:
+            ast.parse(after)
+        except SyntaxError as e:
+            try:
+                ast.parse(before)
+            except SyntaxError:
+                pass  # it was already broken, the rewrite can't be blamed for it
+            else:
+                return f"invalid Python syntax at line {e.lineno}: {e.msg}"
+
+    before_lines, after_lines = before.splitlines(), after.splitlines()
+    allowed = requested_net_removal(diff) + max(MIN_LOST_LINES_SLACK, int(len(before_lines) * LOST_LINES_SLACK))
+    lost = lost_lines(before_lines, after_lines)
+    if lost > allowed:
+        return f"{lost} lines of the file are missing from the rewrite, the diff only removes {requested_net_removal(diff)}"
+    return None
@@ -0,0 +1,210 @@
+import dataclasses
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+BRAVE_SEARCH_URL = "https://api.search.brave.com/res/v1/web/search"
+
+
+@dataclasses.dataclass
+class SearchResult:
+    """
+    Dataclass to represent the search results from Brave Search API.
+
+    :param title: The title of the search result.
+    :param url: The URL of the search result.
+    :param description: A brief description of the search result.
+    :param extra_snippets: Additional snippets related to the search result.
+    """
+    title: str
+    url: str
+    description: str
+    extra_snippets: list
+
+    def __str__(self) -> str:
+        """
+        Returns a string representation of the search result.
+
+        :return: A string representation of the search result.
+        """
+        return (
+            f"Title: {self.title}\n"
+            f"URL: {self.url}\n"
+            f"Description: {self.description}\n"
+            f"Extra Snippets: {', '.join(self.extra_snippets)}"
+        )
+
+
+def normalize_query(query: str) -> str:
+    """Case and whitespace insensitive form of the query, used as the cache key."""
+    return ' '.join(query.lower().split())
+
+
+class BraveSearchClient:
+    """
+    Brave Search with a pooled HTTP session, a TTL cache and coalescing of identical in-flight queries.
+
+    :param base_url: Search endpoint, overridable to point at a local stub.
+    :param ttl: Seconds a cached result stays valid.
+    :param cache_path: Optional SQLite file to persist the cache across runs.
+    :param max_retries: How many times a 429 (or 5xx) response is retried.
+    :param backoff: Base delay in seconds for the exponential backoff, used when there is no Retry-After header.
+    :param pool_size: Max connections kept open by the session.
+    """
+
+    def __init__(self, base_url: str = BRAVE_SEARCH_URL, ttl: float = 3600, cache_path: Optional[str] = None,
+                 max_retries: int = 3, backoff: float = 1.0, pool_size: int = 10):
+        self.base_url = base_url
+        self.ttl = ttl
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
+
+        self._lock = threading.Lock()
+        self._memory: Dict[Tuple[str, int], Tuple[float, List[Dict[str, Any]]]] = {}
+        self._inflight: Dict[Tuple[str, int], Future] = {}
+        self._db: Optional[sqlite3.Connection] = None
+        if cache_path:
+            self._db = sqlite3.connect(cache_path, check_same_thread=False, isolation_level=None)
+            self._db.execute('CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, expires REAL NOT NULL, items TEXT NOT NULL)')
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.http_calls = 0
+
+    def search(self, query: str, api_key: str, count: int = 10) -> List[SearchResult]:
+        """
+        Searches the web using Brave Search API and returns structured search results.
+
+        :param query: The search query string.
+        :param api_key: The API key for authentication with the Brave Search service.
+        :param count: The number of search results to return.
+        :return: A list of SearchResult objects containing the search results.
+        """
+        key = (normalize_query(query), count)
+        with self._lock:
+            cached = self._cached(key)
+            if cached is not None:
+                self.hits += 1
+                return _to_results(cached)
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                self.misses += 1
+                owner = True
+                inflight = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+                owner = False
+
+        if not owner:
+            return _to_results(inflight.result())
+
+        try:
+            items = self._fetch(query, api_key, count)
+            with self._lock:
+                self._store(key, items)
+            inflight.set_result(items)
+            return _to_results(items)
+        except BaseException as e:
+            inflight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def _cached(self, key: Tuple[str, int]) -> Optional[List[Dict[str, Any]]]:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                return entry[1]
+            del self._memory[key]
+        if self._db is not None:
+            row = self._db.execute('SELECT expires, items FROM searches WHERE key = ?', (json.dumps(key),)).fetchone()
+            if row is not None and row[0] > now:
+                items = json.loads(row[1])
+                self._memory[key] = (row[0], items)
+                return items
+        return None
+
+    def _store(self, key: Tuple[str, int], items: List[Dict[str, Any]]) -> None:
+        expires = time.time() + self.ttl
+        self._memory[key] = (expires, items)
+        if self._db is not None:
+            self._db.execute('INSERT OR REPLACE INTO searches (key, expires, items) VALUES (?, ?, ?)', (json.dumps(key), expires, json.dumps(items)))
+
+    def _fetch(self, query: str, api_key: str, count: int) -> List[Dict[str, Any]]:
+        headers = {
+            "Accept": "application/json",
+            "X-Subscription-Token": api_key
+        }
+        params = {
+            "q": query,
+            "count": count
+        }
+        for attempt in range(self.max_retries + 1):
+            with self._lock:
+                self.http_calls += 1
+            response = self.session.get(self.base_url, headers=headers, params=params)
+            if (response.status_code == 429 or response.status_code >= 500) and attempt < self.max_retries:
+                retry_after = response.headers.get('Retry-After')
+                delay = float(retry_after) if retry_after and retry_after.replace('.', '', 1).isdigit() else self.backoff * 2 ** attempt
+                time.sleep(delay)
+                continue
+            response.raise_for_status()  # Raises an exception for HTTP errors
+            return response.json().get('web', {}).get('results', [])
+        return []
+
+    def stats(self) -> Dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses, coalesced=self.coalesced, http_calls=self.http_calls)
+
+
+def _to_results(items: List[Dict[str, Any]]) -> List[SearchResult]:
+    return [
+        SearchResult(
+            title=item.get('title', ''),
+            url=item.get('url', ''),
+            description=item.get('description', ''),
+            extra_snippets=item.get('extra_snippets', [])
+        )
+        for item in items
+    ]
+
+
+_client: Optional[BraveSearchClient] = None
+_client_lock = threading.Lock()
+
+
+def configure_search(**kwargs: Any) -> BraveSearchClient:
+    """
+    Replaces the shared search client used by `search_brave`.
+
+    :param kwargs: Any of the `BraveSearchClient` arguments.
+    """
+    global _client
+    with _client_lock:
+        _client = BraveSearchClient(**kwargs)
+    return _client
+
+
+def get_search_client() -> BraveSearchClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = BraveSearchClient(
+                base_url=os.environ.get('BRAVE_SEARCH_URL', BRAVE_SEARCH_URL),
+                ttl=float(os.environ.get('BRAVE_SEARCH_TTL', 3600)),
+                cache_path=os.environ.get('BRAVE_SEARCH_CACHE_PATH'),
+            )
+        return _client
@@ -0,0 +1,151 @@
+"""
+Append-only journal of a session's message lists, so saving after a turn costs the size of the change rather than the
+size of the session.
+
+    python session_journal.py <journal> [--compact]
+"""
+import argparse
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from message import FileContents, Message, MessageToPrint
+
+
+# default journal file name inside a workspace
+JOURNAL_FILE = '.brain_journal.jsonl'
+# journals with more records than this are compacted when a session is resumed
+COMPACT_AFTER_RECORDS = 1000
+
+
+def to_record(item: Any) -> Dict[str, Any]:
+    if isinstance(item, FileContents):
+        return dict(type='FileContents', role=item.role, content=item.content, file_key=item.file_key, digest=item.digest)
+    if isinstance(item, Message):
+        return dict(type='Message', role=item.role, content=item.content)
+    if isinstance(item, MessageToPrint):
+        return dict(type='MessageToPrint', title=item.title, content=item.content, color=item.color)
+    raise TypeError(f"Can't journal {type(item).__name__}")
+
+
+def from_record(record: Dict[str, Any]) -> Any:
+    kind = record.pop('type')
+    if kind == 'FileContents':
+        return FileContents(**record)
+    if kind == 'Message':
+        return Message(**record)
+    if kind == 'MessageToPrint':
+        return MessageToPrint(**record)
+    raise ValueError(f"Unknown journal item type {kind}")
+
+
+class SessionJournal:
+    """
+    Keeps named lists of messages (the brain history, the TUI message list) in an append-only JSONL file.
+
+    Each `sync` diffs the list against what was last written, by object identity, and appends a single splice record
+    (start, how many items to delete, items to insert) covering the change. Appending messages, a compaction folding
+    the middle of the history into a summary, or a message replaced in place all come down to one small record.
+    A crash can at worst leave a partial last line, which `load` skips.
+
+    :param path: The JSONL file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # stream -> [(item, its content when written)], what the journal currently holds
+        self._written: Dict[str, List[Tuple[Any, Any]]] = {}
+        self.records = 0
+
+    def load(self) -> Dict[str, List[Any]]:
+        """Replays the journal and starts tracking the returned lists, so the next `sync` only writes changes."""
+        streams: Dict[str, List[Any]] = {}
+        self.records = 0
+        if os.path.exists(self.path):
+            good_until = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn write at the end of the file
+                    items = streams.setdefault(record['stream'], [])
+                    start = record['start']
+                    items[start:start + record['delete']] = [from_record(item) for item in record['items']]
+                    self.records += 1
+                    good_until += len(line)
+            if good_until < os.path.getsize(self.path):
+                # drop the torn tail, or records appended after it would never be replayed
+                with open(self.path, 'r+b') as f:
+                    f.truncate(good_until)
+        self._written = {stream: [(item, item.content) for item in items] for stream, items in streams.items()}
+        return streams
+
+    def sync(self, stream: str, items: List[Any]) -> bool:
+        """
+        Writes whatever changed in `items` since the last sync.
+
+        :return: Whether a record was written.
+        """
+        written = self._written.get(stream, [])
+        unchanged = lambda old, new: old[0] is new and old[1] is new.content
+        prefix = 0
+        while prefix < min(len(written), len(items)) and unchanged(written[prefix], items[prefix]):
+            prefix += 1
+        suffix = 0
+        while suffix < min(len(written), len(items)) - prefix and unchanged(written[-1 - suffix], items[-1 - suffix]):
+            suffix += 1
+        delete = len(written) - prefix - suffix
+        inserted = items[prefix:len(items) - suffix]
+        if not delete and not inserted:
+            return False
+
+        record = dict(stream=stream, start=prefix, delete=delete, items=[to_record(item) for item in inserted])
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._written[stream] = [(item, item.content) for item in items]
+        self.records += 1
+        return True
+
+    def compact(self, streams: Optional[Dict[str, List[Any]]] = None) -> None:
+        """
+        Rewrites the journal as one record per stream, atomically.
+
+        :param streams: The current lists, by default what the journal holds.
+        """
+        if streams is None:
+            streams = {stream: [item for item, _ in written] for stream, written in self._written.items()}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for stream, items in streams.items():
+                f.write(json.dumps(dict(stream=stream, start=0, delete=0, items=[to_record(item) for item in items])) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._written = {stream: [(item, item.content) for item in items] for stream, items in streams.items()}
+        self.records = len(streams)
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._written = {}
+        self.records = 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or compact a session journal.')
+    parser.add_argument('journal', type=str, help='Path of the journal, e.g. <workspace>/.brain_journal.jsonl')
+    parser.add_argument('--compact', action='store_true', help='Rewrite the journal as a single record per stream.')
+    args = parser.parse_args()
+
+    journal = SessionJournal(args.journal)
+    streams = journal.load()
+    size = os.path.getsize(args.journal) if os.path.exists(args.journal) else 0
+    print(f"{args.journal}: {journal.records} records, {size / 1024:.1f} KB")
+    for stream, items in streams.items():
+        print(f"  {stream}: {len(items)} items")
+    if args.compact:
+        journal.compact()
+        print(f"compacted to {os.path.getsize(args.journal) / 1024:.1f} KB")
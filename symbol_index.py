@@ -0,0 +1,235 @@
+import ast
+import dataclasses
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+SKIP_DIRS = {'.git', '.hg', '.svn', '__pycache__', 'node_modules', '.venv', 'venv', '.mypy_cache', '.pytest_cache', 'build', 'dist'}
+
+# regex fallback for languages we don't parse, (kind, pattern with the name in group 1)
+REGEX_SYMBOLS: Dict[str, List[Tuple[str, re.Pattern]]] = {
+    '.js': [
+        ('class', re.compile(r'^\s*(?:export\s+)?(?:default\s+)?class\s+([A-Za-z_$][\w$]*)')),
+        ('function', re.compile(r'^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*([A-Za-z_$][\w$]*)')),
+        ('function', re.compile(r'^\s*(?:export\s+)?(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*=\s*(?:async\s+)?(?:function|\([^)]*\)\s*=>|[A-Za-z_$][\w$]*\s*=>)')),
+        ('method', re.compile(r'^\s+(?:static\s+)?(?:async\s+)?([A-Za-z_$][\w$]*)\s*\([^)]*\)\s*\{')),
+    ],
+    '.go': [
+        ('function', re.compile(r'^func\s+(?:\([^)]*\)\s*)?([A-Za-z_]\w*)')),
+        ('type', re.compile(r'^type\s+([A-Za-z_]\w*)')),
+    ],
+    '.rs': [
+        ('function', re.compile(r'^\s*(?:pub(?:\([^)]*\))?\s+)?(?:async\s+)?fn\s+([A-Za-z_]\w*)')),
+        ('type', re.compile(r'^\s*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait)\s+([A-Za-z_]\w*)')),
+        ('impl', re.compile(r'^\s*impl(?:<[^>]*>)?\s+(?:[\w:<>]+\s+for\s+)?([A-Za-z_]\w*)')),
+    ],
+    '.java': [
+        ('class', re.compile(r'^\s*(?:public|private|protected)?\s*(?:static\s+)?(?:final\s+)?(?:abstract\s+)?(?:class|interface|enum)\s+([A-Za-z_]\w*)')),
+        ('method', re.compile(r'^\s*(?:public|private|protected)\s+(?:static\s+)?(?:final\s+)?[\w<>\[\], ]+\s+([A-Za-z_]\w*)\s*\(')),
+    ],
+    '.c': [
+        ('function', re.compile(r'^[A-Za-z_][\w\s\*]*?\b([A-Za-z_]\w*)\s*\([^;]*$')),
+        ('type', re.compile(r'^\s*(?:typedef\s+)?(?:struct|enum|union)\s+([A-Za-z_]\w*)\s*\{')),
+    ],
+    '.rb': [
+        ('class', re.compile(r'^\s*(?:class|module)\s+([A-Z]\w*)')),
+        ('method', re.compile(r'^\s*def\s+(?:self\.)?([A-Za-z_]\w*[?!=]?)')),
+    ],
+}
+for alias, lang in (('.jsx', '.js'), ('.ts', '.js'), ('.tsx', '.js'), ('.mjs', '.js'), ('.h', '.c'), ('.cpp', '.c'),
+                    ('.cc', '.c'), ('.hpp', '.c'), ('.kt', '.java'), ('.cs', '.java')):
+    REGEX_SYMBOLS[alias] = REGEX_SYMBOLS[lang]
+
+
+@dataclasses.dataclass
+class Symbol:
+    """
+    A named block of code.
+
+    :param name: Qualified name, e.g. `Brain.run`.
+    :param kind: class, function, method, ...
+    :param start: First line (1-based, including decorators).
+    :param end: Last line (1-based, inclusive).
+    :param depth: Nesting depth, used to indent the outline.
+    """
+    name: str
+    kind: str
+    start: int
+    end: int
+    depth: int = 0
+
+
+def _python_symbols(source: str) -> List[Symbol]:
+    symbols: List[Symbol] = []
+
+    def visit(node: ast.AST, prefix: str, depth: int) -> None:
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                start = min([child.lineno] + [d.lineno for d in child.decorator_list])
+                if isinstance(child, ast.ClassDef):
+                    kind = 'class'
+                else:
+                    kind = 'method' if isinstance(node, ast.ClassDef) else 'function'
+                symbols.append(Symbol(prefix + child.name, kind, start, child.end_lineno or child.lineno, depth))
+                visit(child, f"{prefix}{child.name}.", depth + 1)
+
+    visit(ast.parse(source), '', 0)
+    return symbols
+
+
+def _block_end(lines: List[str], start: int) -> int:
+    """Finds the last line of a block starting at `start` (0-based), by brace matching or else by indentation."""
+    first = lines[start]
+    window = ''.join(lines[start:start + 3])
+    if '{' in window:
+        depth = 0
+        seen_open = False
+        for i in range(start, len(lines)):
+            depth += lines[i].count('{') - lines[i].count('}')
+            seen_open = seen_open or '{' in lines[i]
+            if seen_open and depth <= 0:
+                return i
+        return len(lines) - 1
+    indent = len(first) - len(first.lstrip())
+    end = start
+    for i in range(start + 1, len(lines)):
+        if not lines[i].strip():
+            continue
+        if len(lines[i]) - len(lines[i].lstrip()) <= indent:
+            # ruby style blocks close with an `end` at the same indent
+            return i if lines[i].strip() == 'end' else end
+        end = i
+    return end
+
+
+def _regex_symbols(source: str, ext: str) -> List[Symbol]:
+    lines = source.split('\n')
+    symbols = []
+    for i, line in enumerate(lines):
+        for kind, ptrn in REGEX_SYMBOLS[ext]:
+            match = ptrn.match(line)
+            if match and match.group(1) not in ('if', 'for', 'while', 'switch', 'return', 'catch'):
+                depth = (len(line) - len(line.lstrip())) // 2
+                symbols.append(Symbol(match.group(1), kind, i + 1, _block_end(lines, i) + 1, min(depth, 4)))
+                break
+    return symbols
+
+
+def extract_symbols(path: str, source: str) -> List[Symbol]:
+    """
+    Extracts the symbols of a source file, AST based for Python and regex based for other known languages.
+
+    :param path: Used for the extension.
+    :param source: The file contents.
+    :return: The symbols in file order, empty if the language isn't supported or the file doesn't parse.
+    """
+    ext = os.path.splitext(path)[1]
+    if ext == '.py':
+        try:
+            return _python_symbols(source)
+        except SyntaxError:
+            return []
+    if ext in REGEX_SYMBOLS:
+        return _regex_symbols(source, ext)
+    return []
+
+
+class SymbolIndex:
+    """
+    Symbols of every supported source file in the workspace.
+
+    The workspace is walked on first use, and again when a lookup finds nothing (the symbol may be in a file created
+    since); files are only re-parsed when their mtime changes.
+
+    :param workspace: Root directory to index.
+    """
+
+    def __init__(self, workspace: str):
+        self.workspace = workspace
+        self._files: Dict[str, Tuple[float, List[Symbol]]] = {}
+        self._built = False
+        self._lock = threading.Lock()
+
+    def _supported(self, path: str) -> bool:
+        ext = os.path.splitext(path)[1]
+        return ext == '.py' or ext in REGEX_SYMBOLS
+
+    def build(self) -> None:
+        for root, dirs, files in os.walk(self.workspace):
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS and not d.startswith('.')]
+            for name in files:
+                rel_path = os.path.relpath(os.path.join(root, name), self.workspace)
+                if self._supported(rel_path):
+                    self.symbols(rel_path)
+        self._built = True
+
+    def symbols(self, rel_path: str) -> List[Symbol]:
+        """
+        Returns the symbols of a file, re-parsing it only if it changed since it was last indexed.
+
+        :param rel_path: Path relative to the workspace.
+        """
+        rel_path = os.path.normpath(rel_path)
+        abs_path = os.path.join(self.workspace, rel_path)
+        if not os.path.exists(abs_path) or not self._supported(rel_path):
+            with self._lock:
+                self._files.pop(rel_path, None)
+            return []
+        mtime = os.path.getmtime(abs_path)
+        with self._lock:
+            cached = self._files.get(rel_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(abs_path, 'r', errors='replace') as f:
+            symbols = extract_symbols(rel_path, f.read())
+        with self._lock:
+            self._files[rel_path] = (mtime, symbols)
+        return symbols
+
+    def find(self, name: str, rel_path: Optional[str] = None) -> List[Tuple[str, Symbol]]:
+        """
+        Looks a symbol up by qualified name (`Brain.run`) or plain name (`run`).
+
+        :param name: The symbol name.
+        :param rel_path: Restrict the lookup to this file, otherwise the whole workspace is searched.
+        :return: (path, symbol) pairs, exact qualified matches first.
+        """
+        if rel_path is not None:
+            return self._match(name, [(os.path.normpath(rel_path), s) for s in self.symbols(rel_path)])
+        if not self._built:
+            self.build()
+            return self._match(name, self._indexed_symbols())
+        matches = self._match(name, self._indexed_symbols())
+        if not matches:
+            # the file may have been created since the workspace was walked, walk it again (unchanged files aren't
+            # re-parsed)
+            self.build()
+            matches = self._match(name, self._indexed_symbols())
+        return matches
+
+    def _indexed_symbols(self) -> List[Tuple[str, Symbol]]:
+        with self._lock:
+            paths = list(self._files)
+        return [(path, s) for path in paths for s in self.symbols(path)]
+
+    @staticmethod
+    def _match(name: str, candidates: List[Tuple[str, Symbol]]) -> List[Tuple[str, Symbol]]:
+        exact = [(p, s) for p, s in candidates if s.name == name]
+        partial = [(p, s) for p, s in candidates if s.name != name and s.name.split('.')[-1] == name.split('.')[-1]]
+        return exact + partial
+
+    def outline(self, rel_path: str, exclude: Optional[Tuple[int, int]] = None) -> str:
+        """
+        Compact outline of a file, one line per symbol with its line range.
+
+        :param rel_path: Path relative to the workspace.
+        :param exclude: Line range (1-based, inclusive) already shown in full; symbols inside it are left out.
+        """
+        lines = []
+        for s in self.symbols(rel_path):
+            if exclude and exclude[0] <= s.start and s.end <= exclude[1]:
+                continue
+            lines.append(f"{'  ' * s.depth}{s.kind} {s.name.split('.')[-1]} (lines {s.start}-{s.end})")
+        return '\n'.join(lines)
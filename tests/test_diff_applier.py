@@ -0,0 +1,30 @@
+from diff_applier import apply_hunks, parse_diff
+
+SOURCE = 'def a():\n    return 1\n\n\ndef b():\n    y = 2\n    return y'
+
+
+def test_no_newline_marker_is_not_context():
+    diff = (
+        '--- a/mod.py\n'
+        '+++ b/mod.py\n'
+        '@@ -5,3 +5,3 @@\n'
+        ' def b():\n'
+        '-    y = 2\n'
+        '-    return y\n'
+        '\\ No newline at end of file\n'
+        '+    y = 3\n'
+        '+    return y\n'
+        '\\ No newline at end of file\n'
+    )
+    hunks = parse_diff(diff)
+    assert all(not text.startswith('\\') for hunk in hunks for _, text in hunk.lines)
+    patched, failed, applied = apply_hunks(SOURCE, hunks)
+    assert (failed, applied) == ([], 1)
+    assert patched == SOURCE.replace('y = 2', 'y = 3')
+
+
+def test_added_lines_follow_the_indentation_of_their_nearest_anchor():
+    # sloppy diff without indentation: only the body lines are off, by 4 spaces
+    patched, failed, _ = apply_hunks(SOURCE, parse_diff(' def b():\n-y = 2\n+y = 3\n return y'))
+    assert failed == []
+    assert patched.endswith('def b():\n    y = 3\n    return y')
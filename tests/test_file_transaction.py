@@ -0,0 +1,45 @@
+import json
+import os
+
+import pytest
+
+from file_transaction import TXN_JOURNAL, FileTransaction, recover
+
+
+def workspace_files(workspace):
+    return sorted(os.path.relpath(os.path.join(root, name), workspace) for root, _, names in os.walk(workspace) for name in names)
+
+
+def test_commit_writes_every_file(tmp_path):
+    (tmp_path / 'a.py').write_text('a = 1\n')
+    with FileTransaction(str(tmp_path)) as transaction:
+        transaction.stage('a.py', 'a = 2\n', 'a = 1\n')
+        transaction.stage('pkg/b.py', 'b = 1\n', None)
+        transaction.commit()
+    assert (tmp_path / 'a.py').read_text() == 'a = 2\n'
+    assert (tmp_path / 'pkg' / 'b.py').read_text() == 'b = 1\n'
+    assert workspace_files(tmp_path) == ['a.py', os.path.join('pkg', 'b.py')]
+
+
+@pytest.mark.parametrize('error', [UnicodeEncodeError, KeyboardInterrupt])
+def test_failure_while_staging_leaves_no_trace(tmp_path, error):
+    (tmp_path / 'a.py').write_text('a = 1\n')
+    with pytest.raises(error):
+        with FileTransaction(str(tmp_path)) as transaction:
+            transaction.stage('a.py', 'a = 2\n', 'a = 1\n')
+            if error is KeyboardInterrupt:
+                raise KeyboardInterrupt
+            transaction.stage('b.py', 'b = "\udc80"\n', None)  # a lone surrogate can't be encoded
+    assert (tmp_path / 'a.py').read_text() == 'a = 1\n'
+    assert workspace_files(tmp_path) == ['a.py']
+
+
+def test_recover_completes_an_interrupted_commit(tmp_path):
+    transaction = FileTransaction(str(tmp_path))
+    transaction.stage('a.py', 'a = 2\n', None)
+    # what commit writes before renaming, as if the process died right after
+    with open(tmp_path / TXN_JOURNAL, 'w') as f:
+        json.dump([dict(target=path, staged=staged) for path, (staged, _) in transaction._staged.items()], f)
+    assert recover(str(tmp_path)) == [str(tmp_path / 'a.py')]
+    assert (tmp_path / 'a.py').read_text() == 'a = 2\n'
+    assert workspace_files(tmp_path) == ['a.py']
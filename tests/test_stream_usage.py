@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from benchmarks.stub_server import StubServer
+from llm_functions import allm_stream, llm_stream
+from message import Message
+from tracing import configure_tracing, load_spans
+
+REPLY = 'Hello there, the answer is forty two.'
+MESSAGES = [Message('system', 'You are terse.'), Message('user', 'Say hello.')]
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = StubServer(reply=REPLY).start()
+    monkeypatch.setenv('OPENAI_API_KEY', 'stub')
+    monkeypatch.setenv('OPENAI_BASE_URL', server.base_url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def trace_path(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    configure_tracing(path)
+    yield path
+    configure_tracing(None)
+
+
+def llm_call_attributes(trace_path):
+    spans = [span for span in load_spans(trace_path) if span['name'] == 'llm_call']
+    assert len(spans) == 1
+    return spans[0]['attributes']
+
+
+def assert_reported_usage(attributes, stub):
+    # the counts the server reported, not the local estimate
+    assert 'tokens_estimated' not in attributes
+    assert attributes['prompt_tokens'] == stub.prompt_tokens > 0
+    assert attributes['completion_tokens'] == stub.completion_tokens > 0
+    assert attributes['cached_tokens'] == stub.cached_tokens
+    assert attributes['finish_reason'] == 'stop'
+
+
+def test_llm_stream_records_reported_usage(stub, trace_path):
+    assert ''.join(llm_stream('gpt-4o-mini', MESSAGES, temperature=0)) == REPLY
+    assert_reported_usage(llm_call_attributes(trace_path), stub)
+
+
+def test_allm_stream_records_reported_usage(stub, trace_path):
+    async def collect():
+        return ''.join([delta async for delta in allm_stream('gpt-4o-mini', MESSAGES, temperature=0)])
+
+    assert asyncio.run(collect()) == REPLY
+    assert_reported_usage(llm_call_attributes(trace_path), stub)
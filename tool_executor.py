@@ -0,0 +1,121 @@
+import contextvars
+import dataclasses
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Sequence, Union
+
+
+@dataclasses.dataclass
+class TimedResult:
+    """
+    The outcome of a tool call along with when it ran.
+
+    :param label: Short description of the call, used in the timing logs.
+    :param result: Whatever the tool function returned.
+    :param started: `time.perf_counter()` when the call started running.
+    :param finished: `time.perf_counter()` when the call finished.
+    """
+    label: str
+    result: Any
+    started: float
+    finished: float
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
+class ToolExecutor:
+    """
+    Runs tool calls concurrently on a bounded thread pool.
+
+    Calls submitted with the same key (e.g. the path of the file they touch) run one after another in submission
+    order, calls with different keys or no key run in parallel. A call touching several files passes all their keys,
+    and waits for the previous call on each of them.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tool')
+        self._lock = threading.Lock()
+        self._last_by_key: Dict[str, Future] = {}
+
+    def submit(self, label: str, fn: Callable, *args: Any, key: Union[str, Sequence[str], None] = None) -> Future:
+        """
+        Schedules `fn(*args)`, in a copy of the caller's context (so tracing spans opened by the tool nest under the
+        caller's span).
+
+        :param label: Short description of the call, used in the timing logs.
+        :param fn: The tool function.
+        :param key: Calls sharing a key are serialized, a sequence of keys serializes with the calls on any of them.
+        :return: A future resolving to a `TimedResult`.
+        """
+        future: Future = Future()
+        context = contextvars.copy_context()
+
+        def start(_: Optional[Future] = None) -> None:
+            if not future.set_running_or_notify_cancel():
+                return  # cancelled before it got to run
+            inner = self.pool.submit(context.run, self._run, label, fn, args)
+            inner.add_done_callback(lambda f: _forward(f, future))
+
+        keys = [key] if isinstance(key, str) else list(key or ())
+        with self._lock:
+            previous = list({id(f): f for f in (self._last_by_key.get(k) for k in keys) if f is not None}.values())
+            for k in keys:
+                self._last_by_key[k] = future
+            if keys:
+                future.add_done_callback(lambda f: self._release(keys, f))
+        # queued calls don't occupy a worker, they only reach the pool once the previous calls with their keys are done
+        if not previous:
+            start()
+        else:
+            waiting = [len(previous)]
+            waiting_lock = threading.Lock()
+
+            def previous_done(_: Future) -> None:
+                with waiting_lock:
+                    waiting[0] -= 1
+                    ready = waiting[0] == 0
+                if ready: start()
+
+            for f in previous:
+                f.add_done_callback(previous_done)
+        return future
+
+    def _release(self, keys: list[str], future: Future) -> None:
+        with self._lock:
+            for key in keys:
+                if self._last_by_key.get(key) is future:
+                    del self._last_by_key[key]
+
+    @staticmethod
+    def _run(label: str, fn: Callable, args: tuple) -> TimedResult:
+        started = time.perf_counter()
+        result = fn(*args)
+        return TimedResult(label, result, started, time.perf_counter())
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=True)
+
+
+def _forward(source: Future, target: Future) -> None:
+    exception = source.exception()
+    if exception is not None:
+        target.set_exception(exception)
+    else:
+        target.set_result(source.result())
+
+
+def format_timings(results: list[TimedResult], origin: float) -> str:
+    """
+    Renders the timings of a batch of tool calls relative to `origin`, so overlapping calls are easy to spot.
+
+    :param results: The timed results, in call order.
+    :param origin: `time.perf_counter()` value the offsets are relative to.
+    """
+    width = max(len(r.label) for r in results)
+    return '\n'.join(
+        f"{r.label.ljust(width)}  +{r.started - origin:.2f}s -> +{r.finished - origin:.2f}s  ({r.duration:.2f}s)"
+        for r in results
+    )
@@ -0,0 +1,268 @@
+"""
+Spans for LLM calls, tool calls, file rewrites and compactions, written to a JSONL trace file.
+
+    python tracing.py <trace.jsonl> [--by stage|model]
+"""
+import argparse
+import contextlib
+import contextvars
+import dataclasses
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # spans only go to the JSONL file
+    otel_trace = None
+
+
+# span the code is currently running in, per thread / asyncio task
+_current: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar('current_span', default=None)
+
+
+@dataclasses.dataclass(slots=True)
+class Span:
+    """
+    One timed operation.
+
+    :param name: What kind of operation it is (llm_call, tool, rewrite_file, ...), spans are summarized by name.
+    :param trace_id: Shared by a root span and everything below it.
+    :param parent_id: The span this one ran in, None for a root span.
+    :param start: Wall clock time it started at.
+    :param attributes: Whatever describes the operation (model, tokens, filename, ...), JSON serializable.
+    """
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start: float
+    attributes: Dict[str, Any]
+    started: float = dataclasses.field(default_factory=time.perf_counter, repr=False)
+    duration: Optional[float] = None
+    status: str = 'ok'
+    error: Optional[str] = None
+    otel: Any = dataclasses.field(default=None, repr=False)
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        record = dict(
+            name=self.name, trace_id=self.trace_id, span_id=self.span_id, parent_id=self.parent_id,
+            start=self.start, duration=self.duration, status=self.status, attributes=self.attributes,
+        )
+        if self.error is not None: record['error'] = self.error
+        return record
+
+
+class Tracer:
+    """
+    Records spans to a JSONL file, one line per finished span, and optionally mirrors them to OpenTelemetry.
+
+    Spans nest through a context variable, so a span opened in an asyncio task or in a thread started with a copy of
+    the context (`asyncio.to_thread`, the `ToolExecutor`) becomes the child of the span it was started from.
+
+    With `otel` set, every span is also created on the global OpenTelemetry tracer provider, so whatever SDK and
+    exporter the process configured (e.g. OTLP through `opentelemetry-instrument`) receives them.
+
+    :param path: The JSONL file spans are appended to, None to not record them.
+    :param otel: Also emit spans through the OpenTelemetry API, if it is installed.
+    """
+
+    def __init__(self, path: Optional[str] = None, otel: bool = False):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+        self._otel = otel_trace.get_tracer('llm_engineer') if otel and otel_trace is not None else None
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = open(path, 'a')
+
+    @property
+    def enabled(self) -> bool:
+        """Whether spans go anywhere, callers skip computing costly attributes otherwise."""
+        return self._file is not None or self._otel is not None
+
+    def start_span(self, name: str, **attributes: Any) -> Span:
+        """
+        Starts a span as a child of the current one, without making it current. Used for spans that are not closed
+        in the scope they were opened in, like the ones covering a stream; finish it with `end_span`.
+        """
+        parent = _current.get()
+        span = Span(
+            name=name,
+            trace_id=parent.trace_id if parent is not None else uuid.uuid4().hex,
+            span_id=uuid.uuid4().hex[:16],
+            parent_id=parent.span_id if parent is not None else None,
+            start=time.time(),
+            attributes=attributes,
+        )
+        if self._otel is not None:
+            context = otel_trace.set_span_in_context(parent.otel) if parent is not None and parent.otel is not None else None
+            span.otel = self._otel.start_span(name, context=context, start_time=time.time_ns())
+        return span
+
+    def end_span(self, span: Span, error: Optional[BaseException] = None) -> None:
+        span.duration = time.perf_counter() - span.started
+        if error is not None:
+            span.status = 'cancelled' if isinstance(error, (GeneratorExit, KeyboardInterrupt)) or type(error).__name__ == 'CancelledError' else 'error'
+            span.error = f"{type(error).__name__}: {error}"
+        if span.otel is not None:
+            for key, value in span.attributes.items():
+                if value is not None: span.otel.set_attribute(key, value if isinstance(value, (str, bool, int, float)) else json.dumps(value))
+            if span.status == 'error':
+                span.otel.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, span.error))
+            span.otel.end()
+        if self._file is not None:
+            line = json.dumps(span.to_dict(), default=str) + '\n'
+            with self._lock:
+                self._file.write(line)
+                self._file.flush()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """Times the block as a span, which is the current span (the parent of spans started in it) meanwhile."""
+        span = self.start_span(name, **attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            self.end_span(span, e)
+            raise
+        else:
+            self.end_span(span)
+        finally:
+            try:
+                _current.reset(token)
+            except ValueError:  # a generator finalized from another context
+                pass
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_tracer = Tracer()
+
+
+def configure_tracing(path: Optional[str], otel: bool = False) -> Tracer:
+    """
+    Sets the process-wide tracer.
+
+    :param path: The JSONL trace file, None to only emit OpenTelemetry spans (or none at all).
+    :param otel: Also emit spans through the OpenTelemetry API.
+    """
+    global _tracer
+    _tracer.close()
+    _tracer = Tracer(path, otel)
+    return _tracer
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+if os.environ.get('LLM_TRACE_PATH') or os.environ.get('LLM_TRACE_OTEL'):
+    configure_tracing(os.environ.get('LLM_TRACE_PATH') or None, os.environ.get('LLM_TRACE_OTEL', '') not in ('', '0'))
+
+
+# -- summaries ------------------------------------------------------------------------------------------------------
+
+def load_spans(path: str) -> List[Dict[str, Any]]:
+    spans = []
+    with open(path) as f:
+        for line in f:
+            try:
+                spans.append(json.loads(line))
+            except json.JSONDecodeError:
+                break  # torn write at the end of the file
+    return spans
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def stage_of(span: Dict[str, Any], by_id: Dict[str, Dict[str, Any]]) -> str:
+    """
+    The operation an LLM call was made for: the name of its parent span (brain.turn, rewrite_file, summarize,
+    plan.iteration for the composer, ...), or 'root' when it wasn't made inside one.
+    """
+    parent = by_id.get(span['parent_id'])
+    return parent['name'] if parent is not None else 'root'
+
+
+def summarize_spans(spans: List[Dict[str, Any]], by: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Groups spans and computes latency percentiles and token spend per group.
+
+    :param by: None to group all spans by name, 'stage' or 'model' to group only the LLM calls by what they were made
+        for, or by model.
+    """
+    by_id = {span['span_id']: span for span in spans}
+    groups: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for span in spans:
+        if by is None:
+            groups[span['name']].append(span)
+        elif span['name'] == 'llm_call':
+            key = stage_of(span, by_id) if by == 'stage' else f"{span['attributes'].get('provider')}/{span['attributes'].get('model')}"
+            groups[key].append(span)
+
+    rows = []
+    for key, members in groups.items():
+        durations = [span['duration'] for span in members]
+        ttfts = [span['attributes']['ttft'] for span in members if span['attributes'].get('ttft') is not None]
+        rows.append(dict(
+            group=key,
+            count=len(members),
+            errors=sum(1 for span in members if span['status'] == 'error'),
+            cancelled=sum(1 for span in members if span['status'] == 'cancelled'),
+            total=sum(durations),
+            p50=percentile(durations, 0.5),
+            p90=percentile(durations, 0.9),
+            p99=percentile(durations, 0.99),
+            ttft_p50=percentile(ttfts, 0.5) if ttfts else None,
+            prompt_tokens=sum(span['attributes'].get('prompt_tokens') or 0 for span in members),
+            completion_tokens=sum(span['attributes'].get('completion_tokens') or 0 for span in members),
+            cached_tokens=sum(span['attributes'].get('cached_tokens') or 0 for span in members),
+        ))
+    return sorted(rows, key=lambda row: row['total'], reverse=True)
+
+
+def format_summary(rows: List[Dict[str, Any]], title: str) -> str:
+    width = max([len(title)] + [len(row['group']) for row in rows])
+    lines = [
+        f"{title:<{width}}  {'count':>6} {'errors':>6} {'cancel':>6} {'total s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'ttft ms':>9} {'prompt tok':>11} {'cached tok':>11} {'compl tok':>10}",
+    ]
+    for row in rows:
+        ttft = f"{row['ttft_p50'] * 1000:9.0f}" if row['ttft_p50'] is not None else f"{'-':>9}"
+        lines.append(
+            f"{row['group']:<{width}}  {row['count']:6d} {row['errors']:6d} {row['cancelled']:6d} {row['total']:9.2f} {row['p50'] * 1000:9.0f} "
+            f"{row['p90'] * 1000:9.0f} {row['p99'] * 1000:9.0f} {ttft} {row['prompt_tokens']:11d} {row['cached_tokens']:11d} {row['completion_tokens']:10d}"
+        )
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize a trace into latency percentiles and token spend.')
+    parser.add_argument('trace', type=str, help='Path of the trace, e.g. <workspace>/.llm_trace.jsonl')
+    parser.add_argument('--by', choices=('stage', 'model'), default=None, help='Only show the LLM calls, grouped by what they were made for or by model.')
+    args = parser.parse_args()
+
+    spans = load_spans(args.trace)
+    print(f"{args.trace}: {len(spans)} spans, {len({span['trace_id'] for span in spans})} traces\n")
+    if args.by is None:
+        print(format_summary(summarize_spans(spans), 'span'))
+        print()
+        print(format_summary(summarize_spans(spans, 'stage'), 'llm_call by stage'))
+    else:
+        print(format_summary(summarize_spans(spans, args.by), f'llm_call by {args.by}'))
@@ -1,60 +1,210 @@
-import pickle  # Importing pickle to handle serialization
 import os  # Importing os for file path operations
 import re
-import base64
+import threading
+from collections import deque
 
+from bisect import bisect_right
+from collections import OrderedDict
+
+from textual import events, work
 from textual.app import App, ComposeResult
-from textual.containers import Container, Horizontal, ScrollableContainer
+from textual.containers import Container, Horizontal
 from textual.geometry import Size
-from textual.reactive import reactive
-from textual.widget import Widget
-from textual.widgets import Button, Header, TextArea, Static, Pretty, ListView, ListItem
+from textual.scroll_view import ScrollView
+from textual.strip import Strip
+from textual.widgets import Button, Header, TextArea, Pretty
+from textual.worker import Worker, WorkerState
 from rich import panel, text
 
 from brain import Brain
+from images import describe_image, get_image_store
+from llm_clients import aclose_clients
 from message import Message, MessageToPrint
-
-
-
-class MessageLabel(Static):
-    def __init__(self, message: MessageToPrint):
-        super().__init__()
-        self.msg = message
-
-    def render(self):
-        if isinstance(self.msg.content, list):
-            content = []
-            for item in self.msg.content:
-                if item['type'] == 'text': content.append(item['text'])
-                elif item['type'] == 'image_url': content.append('Image: ' + item['image_url']['url'][:50] + ' ...')
-            content = '\n'.join(content)
-        else:
-            content = str(self.msg.content)
-        return panel.Panel(
-            f'[{self.msg.color}]{content}[/{self.msg.color}]',
-            border_style=f"bold {self.msg.color}",
-            title=self.msg.title,
-        )
-
-
-class BrainWidget(Widget):
-    message_list = reactive([])
+from session_journal import COMPACT_AFTER_RECORDS, JOURNAL_FILE, SessionJournal
+
+
+# payloads longer than this are collapsed until clicked
+COLLAPSE_LINES = 40
+COLLAPSE_CHARS = 8000
+# rendered panels kept around, the others are rendered again when scrolled back into view
+STRIP_CACHE_ITEMS = 256
+DATA_URL_PTRN = re.compile(r"data:([\w/+.-]+);base64,([A-Za-z0-9+/=]+)")
+
+
+def display_text(msg: MessageToPrint) -> str:
+    """Plain text of a message, with images and inline base64 payloads replaced by their size."""
+    if isinstance(msg.content, list):
+        parts = []
+        for item in msg.content:
+            if item['type'] == 'text': parts.append(item['text'])
+            elif item['type'] == 'image_url': parts.append(item['image_url']['url'])
+            elif item['type'] == 'image_ref': parts.append(describe_image(item))
+        content = '\n'.join(parts)
+    else:
+        content = str(msg.content)
+    return DATA_URL_PTRN.sub(lambda m: f"[{m.group(1)}, {len(m.group(2)) * 3 // 4 / 1024:.1f} KB]", content)
+
+
+def collapse(content: str) -> tuple[str, int]:
+    """Cuts a long payload down to its first lines, returns the kept text and how many lines were hidden."""
+    lines = content.split('\n')
+    kept = '\n'.join(lines[:COLLAPSE_LINES])
+    if len(kept) > COLLAPSE_CHARS:
+        kept = kept[:COLLAPSE_CHARS]
+    hidden = len(lines) - kept.count('\n') - 1
+    if hidden == 0 and len(kept) == len(content):
+        return content, 0
+    return kept, max(hidden, 1)
+
+
+class BrainWidget(ScrollView):
+    """
+    The conversation log, drawn with the line API.
+
+    Messages are kept as data and rendered into panels only when needed: appending renders just the new message, and
+    of the rendered panels only the last `STRIP_CACHE_ITEMS` used are kept, so painting touches the visible lines only.
+    Long payloads are collapsed, clicking a message expands (or collapses) it.
+    """
 
     def __init__(self):
         super().__init__()
         self.styles.height = "1fr"
         self.styles.width = "100%"
-        self.virtual_size = Size(0, 8)
-
-    def compose(self):
-        with ScrollableContainer():
-            yield ListView()
-
-    def watch_message_list(self, new_msgs):
-        list_view = self.query_one(ListView)
-        list_view.clear()
-        for msg in new_msgs:
-            list_view.append(ListItem(MessageLabel(msg)))
+        self.message_list: list[MessageToPrint] = []
+        self._index_of: dict[int, int] = {}  # id() of each message -> its index, to find a message updated in place
+        self._heights: list[int] = []
+        self._offsets: list[int] = []  # first line of each message
+        self._total_lines = 0
+        self._strips: OrderedDict[int, list[Strip]] = OrderedDict()
+        self._expanded: set[int] = set()
+        self._width = 0
+        self.panels_rendered = 0
+
+    def set_messages(self, messages: list[MessageToPrint]) -> None:
+        self.message_list = list(messages)
+        self._index_of = {id(msg): index for index, msg in enumerate(self.message_list)}
+        self._expanded.clear()
+        self._relayout(0)
+
+    def append_message(self, msg: MessageToPrint) -> None:
+        follow = self._at_end()
+        self.message_list.append(msg)
+        index = len(self.message_list) - 1
+        self._index_of[id(msg)] = index
+        self._offsets.append(self._total_lines)
+        self._heights.append(0)
+        self._set_height(index, self._measure(index))
+        self._update_size(follow)
+
+    def index_of(self, msg: MessageToPrint) -> int | None:
+        """Where `msg` (this very object) is in the list, None if it isn't."""
+        index = self._index_of.get(id(msg))
+        return index if index is not None and self.message_list[index] is msg else None
+
+    def refresh_message(self, index: int) -> None:
+        """
+        Re-renders a message whose content changed, used while it is still streaming in. That is usually the last one,
+        but tool logs posted meanwhile can come after it: those only move by the change in height, their rendered
+        panels are kept.
+        """
+        follow = self._at_end()
+        self._strips.pop(index, None)
+        previous = self._heights[index]
+        self._set_height(index, self._measure(index))
+        shift = self._heights[index] - previous
+        if shift:
+            for later in range(index + 1, len(self._offsets)):
+                self._offsets[later] += shift
+        self._update_size(follow)
+
+    def _at_end(self) -> bool:
+        return self.scroll_offset.y >= self.max_scroll_y
+
+    def _set_height(self, index: int, height: int) -> None:
+        self._total_lines += height - self._heights[index]
+        self._heights[index] = height
+
+    def _relayout(self, start: int) -> None:
+        """Re-measures the messages from `start` on, after a resize or when one of them changed height."""
+        follow = self._at_end()
+        for index in [i for i in self._strips if i >= start]:
+            del self._strips[index]
+        del self._heights[start:], self._offsets[start:]
+        self._total_lines = self._offsets[-1] + self._heights[-1] if start else 0
+        for index in range(start, len(self.message_list)):
+            self._offsets.append(self._total_lines)
+            self._heights.append(0)
+            self._set_height(index, self._measure(index))
+        self._update_size(follow)
+
+    def _update_size(self, follow: bool) -> None:
+        self.virtual_size = Size(self._width, self._total_lines)
+        self.refresh()
+        if follow:
+            self.scroll_end(animate=False)
+
+    def _measure(self, index: int) -> int:
+        return len(self._render_message(index)) if self._width else 0
+
+    def _render_message(self, index: int) -> list[Strip]:
+        strips = self._strips.get(index)
+        if strips is not None:
+            self._strips.move_to_end(index)
+            return strips
+
+        msg = self.message_list[index]
+        content = display_text(msg)
+        hidden = 0
+        if index not in self._expanded:
+            content, hidden = collapse(content)
+        body = text.Text(content, style=msg.color)
+        if hidden:
+            body.append(f"\n... {hidden} more line(s), click to expand", style="italic grey50")
+        elif index in self._expanded:
+            body.append("\nclick to collapse", style="italic grey50")
+        renderable = panel.Panel(body, border_style=f"bold {msg.color}", title=msg.title)
+        console = self.app.console
+        lines = console.render_lines(renderable, console.options.update_width(self._width), pad=True)
+        strips = [Strip(line, self._width) for line in lines]
+        self.panels_rendered += 1
+
+        self._strips[index] = strips
+        if len(self._strips) > STRIP_CACHE_ITEMS:
+            self._strips.popitem(last=False)
+        return strips
+
+    def _message_at(self, line: int) -> int:
+        return bisect_right(self._offsets, line) - 1
+
+    def render_line(self, y: int) -> Strip:
+        scroll_x, scroll_y = self.scroll_offset
+        line = scroll_y + y
+        width = self.scrollable_content_region.width
+        if line >= self._total_lines or not self.message_list:
+            return Strip.blank(width, self.rich_style)
+        index = self._message_at(line)
+        strip = self._render_message(index)[line - self._offsets[index]]
+        return strip.crop(scroll_x, scroll_x + width)
+
+    def on_resize(self, event: events.Resize) -> None:
+        width = self.scrollable_content_region.width
+        if width != self._width:
+            self._width = width
+            self._relayout(0)
+
+    def on_click(self, event: events.Click) -> None:
+        line = self.scroll_offset.y + event.y
+        if line >= self._total_lines:
+            return
+        index = self._message_at(line)
+        content = display_text(self.message_list[index])
+        if index in self._expanded:
+            self._expanded.discard(index)
+        elif collapse(content)[1]:
+            self._expanded.add(index)
+        else:
+            return
+        self._relayout(index)
 
 
 class LLMEngineer(App):
@@ -64,22 +214,18 @@ class LLMEngineer(App):
         super().__init__()
         self.workspace = workspace
         self.brain = Brain(workspace)
-        self.history_file = os.path.join(workspace, '.brain_history')  # Path to store brain history
-        self.message_list_file = os.path.join(workspace, '.brain_message_list')  # Path to store message list
-
-    def load_brain_history(self):
-        """Load brain history from a file if it exists."""
-        if os.path.exists(self.history_file):
-            with open(self.history_file, 'rb') as f:
-                self.brain.history = pickle.load(f)
-
-    def load_message_list(self):
-        """Load message list from a file if it exists."""
-        if os.path.exists(self.message_list_file):
-            with open(self.message_list_file, 'rb') as f:
-                self.brain_widget.message_list = pickle.load(f)
-        else:
-            self.brain_widget.message_list = []  # Initialize with an empty list if no file exists
+        self.journal = SessionJournal(os.path.join(workspace, JOURNAL_FILE))  # brain history and message list
+        self.pending_inputs: deque[Message] = deque()  # inputs submitted while a turn is still running
+        self.brain_worker: Worker | None = None
+
+    def load_session(self):
+        """Restore the brain history and message list from the journal, if there is one."""
+        streams = self.journal.load()
+        if streams.get('history'):
+            self.brain.history = streams['history']
+        self.brain_widget.set_messages(streams.get('messages', []))
+        if self.journal.records > COMPACT_AFTER_RECORDS:
+            self.journal.compact()
 
     def compose(self) -> ComposeResult:
         self.brain_widget = BrainWidget()
@@ -89,39 +235,77 @@ class LLMEngineer(App):
         with Horizontal(id="chatbar"):
             yield TextArea(tooltip="Please enter your command...", id="input")
             yield Button("Submit", id="submit_button")
+            yield Button("Cancel", id="cancel_button")
 
     def on_mount(self):
-        self.load_brain_history()  # Load historical data on initialization
-        self.load_message_list()  # Load previous messages on initialization
+        self.load_session()  # Load the previous session on initialization
         self.log_container = self.query_one(BrainWidget).message_list
+        self.ui_thread_id = threading.get_ident()
+
+    async def on_unmount(self) -> None:
+        self.brain.close()
+        await aclose_clients()  # the async clients the Brain's turns pooled on this loop
 
     def on_button_pressed(self, event: Button.Pressed) -> None:
         if event.button.id == "submit_button":
             self.process_input()
+        elif event.button.id == "cancel_button":
+            self.cancel_turn()
 
     def update_message_list(self, new_item):
-        self.brain_widget.message_list = self.brain_widget.message_list + [new_item,]
+        # an item already in the list coming in again means its content was updated in place (streamed tokens)
+        index = self.brain_widget.index_of(new_item)
+        if index is not None:
+            self.brain_widget.refresh_message(index)
+            return
+        self.brain_widget.append_message(new_item)
 
     def process_input(self) -> None:
         user_input = self.query_one("#input", TextArea).text.strip()
         if user_input:
             msg = Message('user', preprocess_user_input(user_input))
-            self.update_message_list(MessageToPrint('User', msg.content, 'cyan'))
-            res = self.brain.run(msg, update_logs=self.update_message_list)
-            self.update_message_list(MessageToPrint('Brain', res, 'bright_green'))
             self.query_one("#input", TextArea).clear()
-            self.save_brain_history()  # Save the brain history after processing input
-            self.save_message_list()  # Save the message list after processing input
+            self.pending_inputs.append(msg)
+            if self.brain_worker is None or self.brain_worker.is_finished:
+                self.start_next_turn()
+            else:
+                self.update_message_list(MessageToPrint('Queued', msg.content, 'grey50'))
+
+    def start_next_turn(self) -> None:
+        msg = self.pending_inputs.popleft()
+        self.update_message_list(MessageToPrint('User', msg.content, 'cyan'))
+        self.brain_worker = self.run_brain(msg)
+
+    @work(group="brain")
+    async def run_brain(self, msg: Message) -> None:
+        """Runs a Brain turn on the event loop, so the UI stays responsive and tokens render as they arrive."""
+        res = await self.brain.arun(msg, update_logs=self.log_from_any_thread)
+        self.update_message_list(MessageToPrint('Brain', res, 'bright_green'))
+
+    def log_from_any_thread(self, item) -> None:
+        # tool calls report from worker threads, everything else from the event loop
+        if threading.get_ident() == self.ui_thread_id:
+            self.update_message_list(item)
+        else:
+            self.call_from_thread(self.update_message_list, item)
+
+    def cancel_turn(self) -> None:
+        if self.brain_worker is not None and not self.brain_worker.is_finished:
+            self.brain_worker.cancel()
 
-    def save_brain_history(self):
-        """Save brain history to a file."""
-        with open(self.history_file, 'wb') as f:
-            pickle.dump(self.brain.history, f)
+    def on_worker_state_changed(self, event: Worker.StateChanged) -> None:
+        if event.worker is not self.brain_worker or not event.worker.is_finished:
+            return
+        if event.state == WorkerState.CANCELLED:
+            self.update_message_list(MessageToPrint('Brain', 'Turn cancelled.', 'red'))
+        self.save_session()  # Save what changed after processing input
+        if self.pending_inputs:
+            self.start_next_turn()
 
-    def save_message_list(self):
-        """Save message list to a file."""
-        with open(self.message_list_file, 'wb') as f:
-            pickle.dump(self.brain_widget.message_list, f)
+    def save_session(self):
+        """Append the changes to the brain history and message list to the journal."""
+        self.journal.sync('history', self.brain.history)
+        self.journal.sync('messages', self.brain_widget.message_list)
 
 
 def preprocess_user_input(user_input):
@@ -164,11 +348,11 @@ def preprocess_user_input(user_input):
             if image_match:
                 file_path = image_match.group(1).strip()
                 if os.path.exists(file_path):
-                    with open(file_path, 'rb') as f:
-                        image_content = f.read()
-                        base64_image = base64.b64encode(image_content).decode('utf-8')
-                    # Add the image content as a separate item
-                    content_list.append({"type": "image_url", "image_url": {'url': f"data:image/png;base64,{base64_image}"}})
+                    try:
+                        # Add a reference to the (downscaled) image as a separate item
+                        content_list.append(get_image_store().add_file(file_path))
+                    except ValueError as e:
+                        content_list.append({"type": "text", "text": str(e)})
 
         # Update the last index to the end of the current match
         last_index = match.end()